@@ -0,0 +1,68 @@
+"""
+Benchmark the cold start of a backend worker.
+
+Each run starts a fresh interpreter, which imports the app, as a worker does at startup, then
+loads litellm, as the first question or the background preload does. Both times are reported,
+with litellm loading its bundled model cost map (`CHAT_OFFLINE`) and downloading it.
+
+Usage:
+    python -m benchmarks.cold_start [--runs 5]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+# Run in a fresh interpreter: prints the import times as JSON
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import frontend.frontend
+app_imported = time.perf_counter()
+litellm_on_import = 'litellm' in sys.modules
+from frontend.provider import load_litellm
+load_litellm()
+print(json.dumps({
+    'app': app_imported - started,
+    'litellm': time.perf_counter() - app_imported,
+    'litellm_on_import': litellm_on_import,
+}))
+"""
+
+
+def probe(offline: bool) -> dict:
+    """
+    Start a fresh interpreter and measure its import times.
+    """
+
+    env = {**os.environ, 'CHAT_OFFLINE': '1' if offline else '0', 'CHAT_WARMUP': 'false'}
+    output = subprocess.run(
+        [sys.executable, '-c', PROBE], env=env, capture_output=True, text=True, check=True,
+    ).stdout
+
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5, help='Interpreters started per mode')
+    parser.add_argument('--offline-only', action='store_true', help='Skip the runs downloading the cost map')
+    args = parser.parse_args()
+
+    modes = [True] if args.offline_only else [True, False]
+    print(f'{"mode":<8} {"app import":>11} {"litellm load":>13}  litellm imported by the app')
+    for offline in modes:
+        runs = [probe(offline) for _ in range(args.runs)]
+        print(
+            f'{"offline" if offline else "online":<8}'
+            f' {statistics.median(r["app"] for r in runs) * 1000:>9.0f}ms'
+            f' {statistics.median(r["litellm"] for r in runs) * 1000:>11.0f}ms'
+            f'  {any(r["litellm_on_import"] for r in runs)}'
+        )
+
+
+if __name__ == '__main__':
+    main()
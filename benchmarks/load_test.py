@@ -0,0 +1,292 @@
+"""
+Load test the chat backend over websockets with the offline mock provider.
+
+Opens N concurrent sessions against a running backend, as the browser would, asks each one
+a question through `ChatState.handle_query_submission` and reports the time to first token,
+the end-to-end latency, the frames per answer and the backend CPU and memory per session.
+
+Start the backend with the mock provider, then run the test:
+
+    CHAT_MOCK_PROVIDER=1 CHAT_MODEL=mock/bench CHAT_CACHE_BACKEND=none \\
+        reflex run --env prod --backend-only
+    python -m benchmarks.load_test --sessions 100
+
+or let the test start (and stop) the backend itself with `--spawn`. The CPU and memory
+figures are read from /proc, so they are only reported on Linux.
+"""
+import argparse
+import asyncio
+import os
+import signal
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+import uuid
+from dataclasses import dataclass, field
+
+import socketio
+
+from frontend.state import ChatState
+
+
+# Socket.IO path and namespace of the Reflex event endpoint
+EVENT_ENDPOINT = '/_event'
+# Name of the event handler asking a question, as sent by the browser
+SUBMIT_EVENT = f'{ChatState.get_full_name()}.handle_query_submission'
+# Environment of a backend started with --spawn: mock provider, no response cache
+SPAWN_ENV = {
+    'CHAT_MOCK_PROVIDER': '1',
+    'CHAT_MODEL': 'mock/bench',
+    'CHAT_CACHE_BACKEND': 'none',
+    'CHAT_OFFLINE': '1',
+}
+
+
+@dataclass
+class SessionResult:
+    """
+    What one session observed.
+    """
+
+    started: float = 0.0
+    first_token: float | None = None
+    finished: float | None = None
+    frames: int = 0
+    error: str | None = None
+    done: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+def _state_delta(update: dict) -> dict:
+    return (update.get('delta') or {}).get(ChatState.get_full_name(), {})
+
+
+async def run_session(url: str, question: str, result: SessionResult, timeout: float):
+    """
+    Connect a websocket session, ask a question and record the streamed updates.
+    """
+
+    client = socketio.AsyncClient(reconnection=False)
+    token = str(uuid.uuid4())
+
+    @client.on('event', namespace=EVENT_ENDPOINT)
+    async def on_update(update):
+        delta = _state_delta(update)
+        for key, value in delta.items():
+            if key.startswith(('streaming_content', 'streaming_blocks')) and value:
+                result.frames += 1
+                if result.first_token is None:
+                    result.first_token = time.perf_counter()
+            elif key.startswith('is_processing') and value is False and result.started:
+                result.finished = time.perf_counter()
+                result.done.set()
+
+    try:
+        await client.connect(
+            f'{url}?token={token}',
+            socketio_path=EVENT_ENDPOINT,
+            namespaces=[EVENT_ENDPOINT],
+            transports=['websocket'],
+        )
+        result.started = time.perf_counter()
+        await client.emit('event', {
+            'name': SUBMIT_EVENT,
+            'payload': {'form_data': {'input_query': question}},
+            'router_data': {'pathname': '/', 'query': {}},
+        }, namespace=EVENT_ENDPOINT)
+        await asyncio.wait_for(result.done.wait(), timeout)
+    except Exception as e:
+        result.error = repr(e)
+    finally:
+        await client.disconnect()
+
+
+def _process_tree(pid: int) -> list[int]:
+    """
+    Get a process and its descendants from /proc.
+    """
+
+    children: dict[int, list[int]] = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open(f'/proc/{entry}/stat') as f:
+                    ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            except OSError:
+                continue
+            children.setdefault(ppid, []).append(int(entry))
+
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+
+    return tree
+
+
+def read_usage(pid: int) -> tuple[float, int]:
+    """
+    Get the CPU seconds and the resident memory in bytes of a process tree.
+    """
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    page = os.sysconf('SC_PAGE_SIZE')
+    cpu, rss = 0.0, 0
+    for member in _process_tree(pid):
+        try:
+            with open(f'/proc/{member}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        # utime and stime are fields 14 and 15 of stat, rss is field 24
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page
+
+    return cpu, rss
+
+
+def percentiles(values: list[float]) -> str:
+    """
+    Format the p50, p95 and p99 of a list of durations in milliseconds.
+    """
+
+    if len(values) < 2:
+        return 'n/a'
+
+    cuts = statistics.quantiles(values, n=100, method='inclusive')
+    return ' '.join(f'p{p}={cuts[p - 1] * 1000:.0f}ms' for p in (50, 95, 99))
+
+
+def spawn_backend(port: int, env: dict[str, str] | None = None) -> subprocess.Popen:
+    """
+    Start the backend with the mock provider and wait until it answers.
+
+    Args:
+        port: The backend port.
+        env: Environment variables set on top of `SPAWN_ENV`.
+    """
+
+    process = subprocess.Popen(
+        ['reflex', 'run', '--env', 'prod', '--backend-only', '--backend-port', str(port)],
+        env={**os.environ, **SPAWN_ENV, **(env or {})},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        # In its own process group, so that its workers are stopped with it
+        start_new_session=True,
+    )
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(f'http://localhost:{port}/ping', timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.5)
+
+    stop_backend(process)
+    raise RuntimeError('The backend did not start within 120 seconds')
+
+
+def stop_backend(process: subprocess.Popen):
+    """
+    Stop a backend started by `spawn_backend`, with its workers.
+    """
+
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+
+
+async def run_sessions(
+        url: str,
+        sessions: int,
+        question: str,
+        distinct: int,
+        timeout: float,
+) -> list[SessionResult]:
+    """
+    Run concurrent sessions, each asking one question.
+
+    Args:
+        url: The backend URL.
+        sessions: The number of sessions.
+        question: The question, numbered so that there are `distinct` different ones.
+        distinct: The number of distinct questions.
+        timeout: Seconds to wait for an answer.
+
+    Returns:
+        list[SessionResult]: What each session observed.
+    """
+
+    results = [SessionResult() for _ in range(sessions)]
+    await asyncio.gather(*[
+        run_session(url, f'{question} #{i % distinct}', result, timeout)
+        for i, result in enumerate(results)
+    ])
+
+    return results
+
+
+async def run(args) -> int:
+    """
+    Run the load test and print the report.
+
+    Returns:
+        int: The number of sessions that failed.
+    """
+
+    usage_before = read_usage(args.pid) if args.pid and sys.platform == 'linux' else None
+    results = await run_sessions(
+        f'http://localhost:{args.port}', args.sessions, args.question, args.distinct, args.timeout)
+
+    ok = [r for r in results if r.error is None and r.finished is not None]
+    failed = len(results) - len(ok)
+    print(f'sessions: {len(ok)} ok, {failed} failed')
+    if ok:
+        print('time to first token:', percentiles([r.first_token - r.started for r in ok if r.first_token]))
+        print('end-to-end latency: ', percentiles([r.finished - r.started for r in ok]))
+        print(f'frames per answer:   {statistics.mean(r.frames for r in ok):.1f}')
+    if usage_before is not None:
+        cpu, rss = read_usage(args.pid)
+        print(f'backend CPU/session: {(cpu - usage_before[0]) / args.sessions * 1000:.1f} ms')
+        print(f'backend RSS/session: {(rss - usage_before[1]) / args.sessions / 1024:.1f} kB'
+              f' (total {rss / 2 ** 20:.0f} MB)')
+    for r in results:
+        if r.error:
+            print('error:', r.error)
+            break
+
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sessions', type=int, default=50, help='Concurrent sessions')
+    parser.add_argument('--port', type=int, default=9000, help='Backend port')
+    parser.add_argument('--pid', type=int, help='Backend process id, to report CPU and memory')
+    parser.add_argument('--spawn', action='store_true', help='Start the backend with the mock provider')
+    parser.add_argument('--question', default='Tell me about load testing', help='Question asked')
+    parser.add_argument('--distinct', type=int, default=10 ** 9, help='Number of distinct questions')
+    parser.add_argument('--timeout', type=float, default=120, help='Seconds to wait for an answer')
+    args = parser.parse_args()
+
+    process = None
+    if args.spawn:
+        process = spawn_backend(args.port)
+        args.pid = process.pid
+
+    try:
+        failed = asyncio.run(run(args))
+    finally:
+        if process is not None:
+            stop_backend(process)
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Benchmark the serialization of the chat history, as the `Message` dictionaries it is kept as
+and as records of a slotted dataclass.
+
+The history is encoded to JSON whenever it changes, as Reflex does for the state update sent
+to the client, and pickled with the session state by the disk and Redis state managers.
+
+Usage:
+    python -m benchmarks.message_serialization [--sizes 10,100,1000] [--repeat 20]
+"""
+import argparse
+import dataclasses
+import json
+import pickle
+import random
+import time
+
+from reflex.utils.format import json_dumps
+
+from frontend.messages import Message, MessageRole, new_message
+
+
+# Words used to synthesize the messages
+WORDS = 'the quick brown fox jumps over a lazy dog while streaming tokens to the client'.split()
+
+
+@dataclasses.dataclass(slots=True)
+class MessageRecord:
+    """
+    A message as a record, for comparison.
+    """
+
+    role: str
+    content: str
+    id: int = 0
+
+
+def make_history(count: int, seed: int = 0) -> list[Message]:
+    """
+    Create a conversation of `count` messages, alternating short questions and longer answers.
+    """
+
+    rng = random.Random(seed)
+    history = []
+    for i in range(count):
+        role = MessageRole.ASSISTANT if i % 2 else MessageRole.USER
+        words = rng.randint(150, 400) if role == MessageRole.ASSISTANT else rng.randint(5, 25)
+        content = ' '.join(rng.choice(WORDS) for _ in range(words))
+        history.append(new_message(role, content, id=i + 1))
+
+    return history
+
+
+def encode_records(history: list[MessageRecord]) -> str:
+    """
+    Encode the records field by field, as Reflex does for dataclasses.
+    """
+
+    return json.dumps(history, default=dataclasses.asdict, ensure_ascii=False)
+
+
+def measure(encode, history, repeat: int) -> tuple[float, int]:
+    """
+    Time an encoding of the history.
+
+    Returns:
+        The median seconds per encoding and the size of the encoded history in bytes.
+    """
+
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        payload = encode(history)
+        timings.append(time.perf_counter() - started)
+    if isinstance(payload, str):
+        payload = payload.encode()
+
+    return sorted(timings)[len(timings) // 2], len(payload)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', default='10,100,1000', help='Messages of the histories')
+    parser.add_argument('--repeat', type=int, default=20, help='Encodings timed per figure')
+    args = parser.parse_args()
+
+    print(f'{"messages":>8} {"history":<12} {"JSON":>10} {"JSON size":>11} {"pickle":>10} {"pickle size":>12}')
+    for size in (int(s) for s in args.sizes.split(',')):
+        messages = make_history(size)
+        rows = (
+            ('dicts', messages, json_dumps),
+            ('records', [MessageRecord(**m) for m in messages], encode_records),
+        )
+        for name, history, encode in rows:
+            json_time, json_size = measure(encode, history, args.repeat)
+            pickle_time, pickle_size = measure(pickle.dumps, history, args.repeat)
+            print(
+                f'{size:>8} {name:<12} {json_time * 1000:>8.2f}ms {json_size:>11,}'
+                f' {pickle_time * 1000:>8.2f}ms {pickle_size:>12,}'
+            )
+
+
+if __name__ == '__main__':
+    main()
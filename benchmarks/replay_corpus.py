@@ -0,0 +1,227 @@
+"""
+Replay an archive of conversations through the completion pipeline, for offline regression
+and cost benchmarking.
+
+Each question of the archive (see `frontend.transfer`) is asked again, with the conversation
+before it as recorded, through the same context builder, scheduler, retries and coalescing as
+the app. Up to `--concurrency` conversations are replayed at a time, the questions of each in
+order. The archive is read as the replay progresses, so its size is not bound by memory. The
+stored answers are bypassed unless `--cached` is given.
+
+The model and the provider are configured as for the app, e.g. offline with the mock provider:
+
+    CHAT_MOCK_PROVIDER=1 CHAT_OFFLINE=1 \\
+        python -m benchmarks.replay_corpus conversations.jsonl.gz --model mock/replay
+
+Usage:
+    python -m benchmarks.replay_corpus ARCHIVE [--model MODEL] [--concurrency 8]
+        [--output answers.jsonl.gz] [--cached]
+"""
+import argparse
+import asyncio
+import gzip
+import itertools
+import json
+import statistics
+import time
+from dataclasses import dataclass, field
+from typing import Iterator
+
+from frontend.context import count_message_tokens
+from frontend.llm import estimate_tokens, stream_completion
+from frontend.provider import load_litellm
+from frontend.state import CONTEXT_BUILDER, DEFAULT_MODEL, MAX_OUTPUT_TOKENS, TEMPERATURE
+from frontend.streaming import StreamBuffer
+from frontend.transfer import read_messages
+
+
+# Session id of the calls replaying a conversation, so that the per-session limit of the
+# scheduler applies to each conversation rather than to the whole replay
+SESSION_ID = 'replay-{conversation_id}'
+
+
+@dataclass
+class ReplayStats:
+    """
+    What the replay observed.
+    """
+
+    conversations: int = 0
+    errors: int = 0
+    # Answers identical to the recorded ones
+    unchanged: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    first_token: list[float] = field(default_factory=list)
+    latency: list[float] = field(default_factory=list)
+
+
+def iter_conversations(file) -> Iterator[tuple[str, list[dict[str, str]]]]:
+    """
+    Group the messages of an archive by conversation, one conversation in memory at a time.
+
+    Yields:
+        The conversation id and its messages, with their role and content.
+    """
+
+    messages = read_messages(file)
+    for conversation_id, group in itertools.groupby(messages, key=lambda m: m[1]):
+        yield conversation_id, [{'role': role, 'content': content} for _, _, role, content, _ in group]
+
+
+async def replay_conversation(
+        model: str,
+        conversation_id: str,
+        history: list[dict[str, str]],
+        refresh: bool,
+        stats: ReplayStats,
+        output,
+):
+    """
+    Ask the questions of a recorded conversation again, in order.
+    """
+
+    stats.conversations += 1
+    for turn, message in enumerate(history):
+        if message['role'] != 'user':
+            continue
+
+        messages = CONTEXT_BUILDER.build(model, history[:turn + 1], max_output_tokens=MAX_OUTPUT_TOKENS)
+        recorded = history[turn + 1]['content'] if turn + 1 < len(history) else None
+        started = time.perf_counter()
+        first_token = None
+        buffer = StreamBuffer()
+        error = None
+        try:
+            async for delta in stream_completion(
+                    model,
+                    messages,
+                    TEMPERATURE,
+                    MAX_OUTPUT_TOKENS,
+                    session_id=SESSION_ID.format(conversation_id=conversation_id),
+                    conversation_id=conversation_id,
+                    refresh=refresh,
+            ):
+                if isinstance(delta, str):
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                    buffer.append(delta)
+        except Exception as e:
+            error = str(e)
+
+        answer = buffer.getvalue()
+        stats.latency.append(time.perf_counter() - started)
+        if first_token is not None:
+            stats.first_token.append(first_token)
+        if error is not None:
+            stats.errors += 1
+        elif answer == recorded:
+            stats.unchanged += 1
+        stats.prompt_tokens += estimate_tokens(model, messages, 0)
+        stats.completion_tokens += count_message_tokens(model, 'assistant', answer)
+
+        if output is not None:
+            output.write(json.dumps({
+                'conversation_id': conversation_id,
+                'turn': turn,
+                'model': model,
+                'question': message['content'],
+                'answer': answer,
+                'recorded': recorded,
+                'first_token': first_token,
+                'error': error,
+            }, ensure_ascii=False) + '\n')
+
+
+async def replay(path: str, model: str, concurrency: int, refresh: bool, output) -> ReplayStats:
+    """
+    Replay the conversations of an archive with at most `concurrency` at a time.
+    """
+
+    stats = ReplayStats()
+    # Bounded, so that the archive is only read ahead of the replay by a few conversations
+    queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency)
+
+    async def read():
+        with open(path, 'rb') as file:
+            for conversation in iter_conversations(file):
+                await queue.put(conversation)
+        for _ in range(concurrency):
+            await queue.put(None)
+
+    async def work():
+        while (item := await queue.get()) is not None:
+            await replay_conversation(model, *item, refresh, stats, output)
+
+    tasks = [asyncio.create_task(read())] + [asyncio.create_task(work()) for _ in range(concurrency)]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    return stats
+
+
+def estimate_cost(model: str, stats: ReplayStats) -> float | None:
+    """
+    Estimate the provider cost of the replay from the litellm price list.
+
+    Returns:
+        The cost in US dollars, or None if the price of the model is unknown.
+    """
+
+    litellm = load_litellm()
+    try:
+        prompt, completion = litellm.cost_per_token(
+            model=model, prompt_tokens=stats.prompt_tokens, completion_tokens=stats.completion_tokens)
+    except Exception:
+        return None
+
+    return prompt + completion
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('archive', help='Conversations exported as JSON lines, gzipped or not')
+    parser.add_argument('--model', default=DEFAULT_MODEL, help='Model answering the questions')
+    parser.add_argument('--concurrency', type=int, default=8, help='Conversations replayed at a time')
+    parser.add_argument('--output', help='Write the answers as JSON lines, gzipped if ending in .gz')
+    parser.add_argument('--cached', action='store_true', help='Reuse the stored answers')
+    args = parser.parse_args()
+
+    load_litellm().suppress_debug_info = True
+    output = None
+    if args.output:
+        output = (gzip.open if args.output.endswith('.gz') else open)(args.output, 'wt', encoding='utf-8')
+
+    started = time.perf_counter()
+    try:
+        stats = asyncio.run(replay(args.archive, args.model, args.concurrency, not args.cached, output))
+    finally:
+        if output is not None:
+            output.close()
+    elapsed = time.perf_counter() - started
+
+    questions = len(stats.latency)
+    print(f'{stats.conversations} conversations, {questions} questions in {elapsed:.1f} s, {stats.errors} errors')
+    print(f'{stats.unchanged} answers identical to the recorded ones')
+    if stats.first_token:
+        print(
+            f'time to first token: p50 {statistics.median(stats.first_token) * 1000:.0f} ms,'
+            f' max {max(stats.first_token) * 1000:.0f} ms'
+        )
+    if stats.latency:
+        print(
+            f'latency: p50 {statistics.median(stats.latency) * 1000:.0f} ms,'
+            f' max {max(stats.latency) * 1000:.0f} ms'
+        )
+    cost = estimate_cost(args.model, stats)
+    print(
+        f'{stats.prompt_tokens} prompt tokens, {stats.completion_tokens} completion tokens, cost '
+        + (f'${cost:.4f}' if cost is not None else 'unknown')
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+"""
+Measure how the answer throughput of the backend scales with the number of workers.
+
+For each worker count, starts the backend with the mock provider and the Redis state manager,
+runs the same number of concurrent sessions as `benchmarks.load_test`, and reports the
+answers per second. Needs a Redis server, e.g. `docker run -p 6379:6379 redis`.
+
+Usage:
+    python -m benchmarks.scale_out [--workers 1,2,4] [--sessions 200]
+"""
+import argparse
+import asyncio
+import time
+
+from benchmarks.load_test import run_sessions, spawn_backend, stop_backend
+
+
+# Short delays, so that the backend rather than the mock provider limits the throughput
+SCALE_OUT_ENV = {
+    'CHAT_MOCK_FIRST_TOKEN_MS': '50',
+    'CHAT_MOCK_TOKEN_MS': '2',
+    'CHAT_MOCK_TOKENS': '300',
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--workers', default='1,2,4', help='Comma-separated worker counts')
+    parser.add_argument('--sessions', type=int, default=200, help='Concurrent sessions')
+    parser.add_argument('--port', type=int, default=9000, help='Backend port')
+    parser.add_argument('--redis-url', default='redis://localhost:6379', help='Redis server')
+    parser.add_argument('--timeout', type=float, default=300, help='Seconds to wait for an answer')
+    args = parser.parse_args()
+
+    baseline = None
+    print(f'{"workers":>7} {"answers/s":>10} {"speed-up":>9} {"failed":>7}')
+    for workers in [int(w) for w in args.workers.split(',')]:
+        process = spawn_backend(args.port, {
+            **SCALE_OUT_ENV,
+            'REDIS_URL': args.redis_url,
+            'CHAT_WORKERS': str(workers),
+        })
+        try:
+            started = time.perf_counter()
+            results = asyncio.run(run_sessions(
+                f'http://localhost:{args.port}',
+                args.sessions,
+                'Tell me about scaling out',
+                args.sessions,
+                args.timeout,
+            ))
+            elapsed = time.perf_counter() - started
+        finally:
+            stop_backend(process)
+
+        ok = sum(1 for r in results if r.error is None and r.finished is not None)
+        throughput = ok / elapsed
+        baseline = baseline or throughput
+        print(f'{workers:>7} {throughput:>10.1f} {throughput / baseline:>8.2f}x {len(results) - ok:>7}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+"""
+Micro-benchmark assembling a streamed answer by string concatenation versus `StreamBuffer`,
+read on every flush or only split into markdown blocks as the chat state does.
+
+The flushes are decided once by a `StreamFlusher`, outside the timings, so that every variant
+only pays for assembling the answer at the same flush points.
+
+Usage:
+    python -m benchmarks.stream_buffer [--repeat 5]
+"""
+import argparse
+import time
+
+from benchmarks.streaming_frames import make_tokens
+from frontend.streaming import FlushPolicy, MarkdownBlocks, StreamBuffer, StreamFlusher
+
+
+# Output lengths in tokens
+SIZES = (512, 4096, 32768)
+
+
+def flush_points(tokens: list[str]) -> list[bool]:
+    """
+    Decide after which tokens the answer is flushed, at 20 ms per token.
+    """
+
+    now = [0.0]
+    flusher = StreamFlusher(FlushPolicy(), clock=lambda: now[0])
+    flushes = []
+    for token in tokens:
+        now[0] += 0.02
+        flushes.append(flusher.should_flush(token))
+    if flusher.pending:
+        flushes[-1] = True
+
+    return flushes
+
+
+def concatenate(tokens: list[str], flushes: list[bool]) -> str:
+    """
+    Assemble the answer the way the chat state used to, appending to a dict entry, read on
+    every flush.
+    """
+
+    message = {'role': 'assistant', 'content': ''}
+    text = ''
+    for token, flush in zip(tokens, flushes):
+        message['content'] += token
+        if flush:
+            text = message['content']
+
+    return text
+
+
+def buffered(tokens: list[str], flushes: list[bool]) -> str:
+    """
+    Assemble the answer with a `StreamBuffer`, joining it on every flush.
+    """
+
+    buffer = StreamBuffer()
+    text = ''
+    for token, flush in zip(tokens, flushes):
+        buffer.append(token)
+        if flush:
+            text = buffer.getvalue()
+
+    return text
+
+
+def blocks(tokens: list[str], flushes: list[bool]) -> str:
+    """
+    Assemble the answer with a `StreamBuffer`, passing only the chunks of each flush to
+    `MarkdownBlocks` and joining the answer once at the end.
+    """
+
+    buffer = StreamBuffer()
+    splitter = MarkdownBlocks()
+    pending = []
+    for token, flush in zip(tokens, flushes):
+        buffer.append(token)
+        pending.append(token)
+        if flush:
+            splitter.update(''.join(pending))
+            pending.clear()
+
+    return buffer.getvalue()
+
+
+def timeit(fn, tokens: list[str], flushes: list[bool], repeat: int) -> float:
+    """
+    Return the best wall time in milliseconds of `repeat` runs.
+    """
+
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(tokens, flushes)
+        best = min(best, time.perf_counter() - start)
+
+    return best * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--repeat', type=int, default=5, help='Runs per measurement')
+    args = parser.parse_args()
+
+    for size in SIZES:
+        tokens = make_tokens(size)
+        flushes = flush_points(tokens)
+        assert concatenate(tokens, flushes) == buffered(tokens, flushes) == blocks(tokens, flushes)
+        print(
+            f'{size:>6} tokens: concatenate {timeit(concatenate, tokens, flushes, args.repeat):8.2f} ms,'
+            f' buffered {timeit(buffered, tokens, flushes, args.repeat):8.2f} ms,'
+            f' blocks {timeit(blocks, tokens, flushes, args.repeat):8.2f} ms'
+        )
+
+
+if __name__ == '__main__':
+    main()
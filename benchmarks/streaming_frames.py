@@ -0,0 +1,91 @@
+"""
+Benchmark the number of client frames and the backend CPU spent per streamed answer.
+
+Tokens arrive on a simulated clock, so the run is deterministic and needs no network. Each
+frame serializes the chat history to JSON, which approximates the state diff Reflex sends
+over the websocket on every `yield`.
+
+Usage:
+    python -m benchmarks.streaming_frames [--tokens 512] [--history 20] [--answers 50]
+"""
+import argparse
+import json
+import random
+import time
+
+from frontend.streaming import FlushPolicy, StreamFlusher
+
+
+# Policy equivalent to yielding after every delta
+PER_TOKEN_POLICY = FlushPolicy(interval_ms=1, max_tokens=1, sentence_boundary=False)
+# Words used to synthesize the streamed answer
+WORDS = 'the quick brown fox jumps over a lazy dog while streaming tokens to the client'.split()
+
+
+def make_tokens(count: int, seed: int = 0) -> list[str]:
+    """
+    Create a synthetic answer of `count` tokens with occasional sentence endings.
+    """
+
+    rng = random.Random(seed)
+    tokens = []
+    for i in range(count):
+        token = ' ' + rng.choice(WORDS)
+        if i % 17 == 16:
+            token += '.'
+        tokens.append(token)
+
+    return tokens
+
+
+def run(policy: FlushPolicy, tokens: list[str], history: list[dict], answers: int) -> tuple[int, float]:
+    """
+    Stream `answers` answers with the given policy.
+
+    Returns:
+        The number of frames per answer and the CPU seconds spent per answer.
+    """
+
+    frames = 0
+    start = time.process_time()
+
+    for _ in range(answers):
+        now = [0.0]
+        flusher = StreamFlusher(policy, clock=lambda: now[0])
+        chat_history = history + [{'role': 'assistant', 'content': ''}]
+
+        for token in tokens:
+            # Tokens arrive every 10-30 ms
+            now[0] += random.uniform(0.01, 0.03)
+            chat_history[-1]['content'] += token
+            if flusher.should_flush(token):
+                json.dumps(chat_history)
+                frames += 1
+
+        if flusher.pending:
+            json.dumps(chat_history)
+            frames += 1
+
+    return frames // answers, (time.process_time() - start) / answers
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tokens', type=int, default=512, help='Tokens per answer')
+    parser.add_argument('--history', type=int, default=20, help='Messages already in the chat')
+    parser.add_argument('--answers', type=int, default=50, help='Answers to stream')
+    args = parser.parse_args()
+
+    tokens = make_tokens(args.tokens)
+    history = [
+        {'role': 'user' if i % 2 == 0 else 'assistant', 'content': ''.join(tokens)}
+        for i in range(args.history)
+    ]
+
+    for name, policy in (('per token', PER_TOKEN_POLICY), ('coalesced', FlushPolicy())):
+        frames, cpu = run(policy, tokens, history, args.answers)
+        print(f'{name:>10}: {frames:5d} frames/answer, {cpu * 1000:8.2f} ms CPU/answer')
+
+
+if __name__ == '__main__':
+    main()
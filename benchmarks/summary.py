@@ -0,0 +1,114 @@
+"""
+Benchmark the prompt tokens and the time to first token of a long conversation, with and
+without the rolling summary.
+
+The conversation is answered by the mock provider, whose time to first token grows with the
+prompt (`CHAT_MOCK_PREFILL_MS`). With the summary, the older turns are folded between two
+questions, as the app does once an answer is shown; the time spent summarizing is reported
+apart, since it is off the critical path.
+
+Usage:
+    python -m benchmarks.summary [--turns 40] [--trigger 2000] [--prefill-ms 200]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import time
+
+# Read by the app modules when they are imported
+os.environ.update({
+    'CHAT_OFFLINE': '1',
+    'CHAT_CACHE_BACKEND': 'none',
+    'CHAT_REPLAY_DELAY_MS': '0',
+})
+
+from frontend.context import ContextBuilder  # noqa: E402
+from frontend.llm import estimate_tokens, stream_completion  # noqa: E402
+from frontend.mock_provider import MockSettings, register_mock_provider  # noqa: E402
+from frontend.provider import load_litellm  # noqa: E402
+from frontend.summary import SummaryPolicy, summarize, summary_message  # noqa: E402
+
+
+# The model of the conversation
+MODEL = 'mock/summary'
+# Tokens of each answer
+ANSWER_TOKENS = 150
+
+
+async def converse(turns: int, policy: SummaryPolicy | None) -> dict[str, list[float]]:
+    """
+    Ask `turns` questions in one conversation, summarizing it if a policy is given.
+    """
+
+    # The whole conversation fits: only the summary shortens it
+    builder = ContextBuilder(budgets={MODEL: 1_000_000})
+    history: list[dict[str, str]] = []
+    summary = ''
+    covered = 0
+    figures = {'prompt_tokens': [], 'first_token': [], 'summarize': []}
+    for turn in range(turns):
+        history.append({'role': 'user', 'content': f'Question {turn}: what about the point {turn}?'})
+        messages = history[covered:]
+        if summary:
+            messages = [summary_message(summary)] + messages
+        messages = builder.build(MODEL, messages, max_output_tokens=ANSWER_TOKENS)
+        figures['prompt_tokens'].append(estimate_tokens(MODEL, messages, 0))
+
+        started = time.perf_counter()
+        first_token = None
+        answer = []
+        async for delta in stream_completion(MODEL, messages, 0.0, ANSWER_TOKENS):
+            if isinstance(delta, str):
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                answer.append(delta)
+        figures['first_token'].append(first_token)
+        history.append({'role': 'assistant', 'content': ''.join(answer)})
+
+        fold = policy.fold_count(MODEL, history[covered:]) if policy else 0
+        if fold:
+            started = time.perf_counter()
+            summary = await summarize(MODEL, summary, history[covered:covered + fold], policy.max_tokens)
+            figures['summarize'].append(time.perf_counter() - started)
+            covered += fold
+
+    return figures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--turns', type=int, default=40, help='Questions of the conversation')
+    parser.add_argument('--trigger', type=int, default=2000, help='Summary threshold, in tokens')
+    parser.add_argument('--keep', type=int, default=6, help='Latest messages kept as they are')
+    parser.add_argument('--prefill-ms', type=float, default=200, help='Delay per 1000 prompt tokens')
+    args = parser.parse_args()
+
+    load_litellm()
+    register_mock_provider(MockSettings(
+        first_token_ms=100, token_ms=0, jitter=0, tokens=ANSWER_TOKENS, prefill_ms=args.prefill_ms))
+
+    tail = max(1, args.turns // 4)
+    print(
+        f'{"summary":<8} {"prompt tokens":>14} {"last prompt":>12} {"TTFT p50":>9} '
+        f'{f"TTFT last {tail}":>13} {"summaries":>10} {"summary p50":>12}'
+    )
+    baseline = None
+    for enabled in (False, True):
+        policy = SummaryPolicy(trigger_tokens=args.trigger, keep_messages=args.keep) if enabled else None
+        figures = asyncio.run(converse(args.turns, policy))
+        total = sum(figures['prompt_tokens'])
+        baseline = baseline or total
+        summaries = figures['summarize']
+        print(
+            f'{"on" if enabled else "off":<8} {total:>14.0f} {figures["prompt_tokens"][-1]:>12.0f}'
+            f' {statistics.median(figures["first_token"]) * 1000:>7.0f}ms'
+            f' {statistics.median(figures["first_token"][-tail:]) * 1000:>11.0f}ms'
+            f' {len(summaries):>10}'
+            f' {(statistics.median(summaries) * 1000 if summaries else 0):>10.0f}ms'
+            + (f'  ({1 - total / baseline:.0%} fewer prompt tokens)' if enabled else '')
+        )
+
+
+if __name__ == '__main__':
+    main()
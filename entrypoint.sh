@@ -0,0 +1,22 @@
+#!/bin/sh
+# Start the app, and on SIGTERM let the backend workers finish the answers being generated
+# before the container stops.
+
+# Always apply migrations before starting the backend.
+[ -d alembic ] && reflex db migrate
+
+# In a process group of its own, so that its servers and their workers are signaled together,
+# whether Reflex runs the backend with Granian or Gunicorn
+setsid reflex run --env prod &
+app=$!
+
+drain() {
+    # The backend server stops accepting connections, then waits for its workers to shut down,
+    # which run the drain of the answers (see CHAT_DRAIN_TIMEOUT)
+    kill -TERM -"$app" 2> /dev/null
+    wait "$app"
+    exit 0
+}
+trap drain TERM INT
+
+wait "$app"
@@ -0,0 +1,4 @@
+from dotenv import load_dotenv
+
+# Load the configuration before any module reads the environment
+load_dotenv()
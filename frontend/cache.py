@@ -0,0 +1,438 @@
+"""
+Response cache in front of the LLM.
+
+Answers are keyed on the model, the normalized messages and the sampling parameters. Two
+backends are available: an in-process LRU dictionary and an SQLite file shared by the
+workers of a host. Both evict entries by age (TTL) and by least recent use. Optionally, a
+local embedding model also matches near-duplicate questions asked in the same context.
+"""
+import abc
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable
+
+
+# Default number of answers kept by a cache
+DEFAULT_MAX_ENTRIES = 1024
+# Default lifetime of a cached answer, in seconds
+DEFAULT_TTL = 3600
+# Default minimum cosine similarity for a near-duplicate question to hit the cache
+DEFAULT_SIMILARITY = 0.92
+# Default location of the on-disk cache
+DEFAULT_CACHE_PATH = '.cache/responses.db'
+
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_messages(messages: list[dict[str, str]]) -> list[tuple[str, str]]:
+    """
+    Reduce messages to (role, text) pairs with collapsed whitespace.
+
+    Args:
+        messages: The messages sent to the model.
+
+    Returns:
+        list[tuple[str, str]]: The normalized messages.
+    """
+
+    return [(m['role'], _WHITESPACE.sub(' ', m['content']).strip()) for m in messages]
+
+
+def make_cache_key(
+        model: str,
+        messages: list[dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+) -> str:
+    """
+    Compute the cache key of a completion request.
+
+    Args:
+        model: The litellm model name.
+        messages: The messages sent to the model.
+        temperature: The sampling temperature.
+        max_tokens: The maximum number of tokens in the answer.
+
+    Returns:
+        str: A hex digest identifying the request.
+    """
+
+    payload = json.dumps([model, normalize_messages(messages), temperature, max_tokens])
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache(abc.ABC):
+    """
+    Base class of the response cache backends.
+
+    Subclasses implement `_get` and `_set`; this class keeps the hit and miss counters and
+    the optional near-duplicate index.
+    """
+
+    # Whether `_get` and `_set` do I/O, and are called in a worker thread from the event loop
+    blocking = False
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        """
+        Args:
+            max_entries: Number of answers kept before the least recently used is evicted.
+            ttl: Lifetime of an answer, in seconds.
+        """
+
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.semantic_index: SemanticIndex | None = None
+
+    @abc.abstractmethod
+    def _get(self, key: str) -> str | None:
+        """
+        Get the answer cached under a key, unless it expired.
+        """
+
+    @abc.abstractmethod
+    def _set(self, key: str, value: str):
+        """
+        Cache an answer under a key, evicting the least recently used beyond the limit.
+        """
+
+    def lookup(
+            self,
+            model: str,
+            messages: list[dict[str, str]],
+            temperature: float,
+            max_tokens: int,
+    ) -> str | None:
+        """
+        Find the cached answer to a request, or to a near-duplicate of it.
+
+        Args:
+            model: The litellm model name.
+            messages: The messages sent to the model.
+            temperature: The sampling temperature.
+            max_tokens: The maximum number of tokens in the answer.
+
+        Returns:
+            str | None: The cached answer, or None on a miss.
+        """
+
+        value = self._get(make_cache_key(model, messages, temperature, max_tokens))
+        if value is None and self.semantic_index is not None:
+            context = make_cache_key(model, messages[:-1], temperature, max_tokens)
+            similar_key = self.semantic_index.find(context, messages[-1]['content'])
+            if similar_key is not None:
+                value = self._get(similar_key)
+
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+
+        return value
+
+    async def alookup(
+            self,
+            model: str,
+            messages: list[dict[str, str]],
+            temperature: float,
+            max_tokens: int,
+    ) -> str | None:
+        """
+        Find the cached answer to a request, as `lookup` does, from the event loop.
+
+        With a near-duplicate index or a blocking backend, the lookup runs in a worker thread,
+        so that the embedding model or the disk does not block the other sessions.
+        """
+
+        if self.semantic_index is None and not self.blocking:
+            return self.lookup(model, messages, temperature, max_tokens)
+
+        return await asyncio.to_thread(self.lookup, model, messages, temperature, max_tokens)
+
+    def store(
+            self,
+            model: str,
+            messages: list[dict[str, str]],
+            temperature: float,
+            max_tokens: int,
+            value: str,
+    ):
+        """
+        Cache the answer to a request.
+
+        Args:
+            model: The litellm model name.
+            messages: The messages sent to the model.
+            temperature: The sampling temperature.
+            max_tokens: The maximum number of tokens in the answer.
+            value: The complete answer.
+        """
+
+        key = make_cache_key(model, messages, temperature, max_tokens)
+        self._set(key, value)
+        if self.semantic_index is not None:
+            context = make_cache_key(model, messages[:-1], temperature, max_tokens)
+            self.semantic_index.add(context, key, messages[-1]['content'])
+
+    async def astore(
+            self,
+            model: str,
+            messages: list[dict[str, str]],
+            temperature: float,
+            max_tokens: int,
+            value: str,
+    ):
+        """
+        Cache the answer to a request, as `store` does, from the event loop, in a worker
+        thread as for `alookup`.
+        """
+
+        if self.semantic_index is None and not self.blocking:
+            self.store(model, messages, temperature, max_tokens, value)
+        else:
+            await asyncio.to_thread(self.store, model, messages, temperature, max_tokens, value)
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get the hit and miss counters.
+
+        Returns:
+            dict[str, int]: The number of hits and misses since the cache was created.
+        """
+
+        return {'hits': self.hits, 'misses': self.misses}
+
+
+class MemoryCache(ResponseCache):
+    """
+    In-process LRU cache with a TTL.
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL):
+        super().__init__(max_entries, ttl)
+        self._entries: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> str | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if time.time() - entry[0] > self.ttl:
+                del self._entries[key]
+                return None
+
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def _set(self, key: str, value: str):
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+class DiskCache(ResponseCache):
+    """
+    SQLite-backed LRU cache with a TTL, shared by the processes of a host.
+    """
+
+    blocking = True
+
+    def __init__(
+            self,
+            path: str = DEFAULT_CACHE_PATH,
+            max_entries: int = DEFAULT_MAX_ENTRIES,
+            ttl: float = DEFAULT_TTL,
+    ):
+        """
+        Args:
+            path: The SQLite database file; its directory is created if needed.
+            max_entries: Number of answers kept before the least recently used is evicted.
+            ttl: Lifetime of an answer, in seconds.
+        """
+
+        super().__init__(max_entries, ttl)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            'key TEXT PRIMARY KEY, value TEXT, created REAL, used REAL)'
+        )
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_used ON responses (used)')
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> str | None:
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value, created FROM responses WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                self._db.execute('DELETE FROM responses WHERE key = ?', (key,))
+                return None
+
+            self._db.execute('UPDATE responses SET used = ? WHERE key = ?', (now, key))
+            return row[0]
+
+    def _set(self, key: str, value: str):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, value, now, now)
+            )
+            self._db.execute(
+                'DELETE FROM responses WHERE key IN ('
+                'SELECT key FROM responses ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,),
+            )
+
+
+class SemanticIndex:
+    """
+    Match a question to a cached near-duplicate asked in the same context.
+
+    Only the last message is compared by embedding similarity; the model, the earlier
+    messages and the sampling parameters (the context) must match exactly.
+    """
+
+    def __init__(
+            self,
+            embed: Callable[[str], list[float]],
+            threshold: float = DEFAULT_SIMILARITY,
+            max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        """
+        Args:
+            embed: Returns the embedding vector of a text.
+            threshold: Minimum cosine similarity for two questions to match.
+            max_entries: Number of questions kept in the index.
+        """
+
+        self.embed = embed
+        self.threshold = threshold
+        self.max_entries = max_entries
+        # Context -> cache key -> normalized embedding of the last message
+        self._entries: OrderedDict[str, dict[str, list[float]]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def _vector(self, text: str) -> list[float]:
+        vector = list(self.embed(_WHITESPACE.sub(' ', text).strip()))
+        norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+        return [x / norm for x in vector]
+
+    def add(self, context: str, key: str, text: str):
+        """
+        Index the last message of a cached request.
+
+        Args:
+            context: The cache key of the request without its last message.
+            key: The cache key of the request.
+            text: The last message of the request.
+        """
+
+        vector = self._vector(text)
+        with self._lock:
+            bucket = self._entries.setdefault(context, {})
+            self._size += key not in bucket
+            bucket[key] = vector
+            self._entries.move_to_end(context)
+            while self._size > self.max_entries and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+
+    def find(self, context: str, text: str) -> str | None:
+        """
+        Find the key of the most similar cached request in the same context.
+
+        Args:
+            context: The cache key of the request without its last message.
+            text: The last message of the request.
+
+        Returns:
+            str | None: The key of the best match above the threshold, if any.
+        """
+
+        with self._lock:
+            bucket = dict(self._entries.get(context, {}))
+        if not bucket:
+            return None
+
+        vector = self._vector(text)
+        best_key, best_score = None, self.threshold
+        for other_key, other in bucket.items():
+            score = sum(a * b for a, b in zip(vector, other))
+            if score >= best_score:
+                best_key, best_score = other_key, score
+
+        return best_key
+
+
+def load_embedding_model(name: str) -> Callable[[str], list[float]]:
+    """
+    Load a local sentence-transformers model to embed questions.
+
+    Args:
+        name: The sentence-transformers model name, e.g. `all-MiniLM-L6-v2`.
+
+    Returns:
+        Callable[[str], list[float]]: A function returning the embedding of a text.
+    """
+
+    try:
+        from sentence_transformers import SentenceTransformer
+    except ImportError as e:
+        raise ImportError(
+            'Near-duplicate caching requires `pip install sentence-transformers`'
+        ) from e
+
+    model = SentenceTransformer(name)
+    return lambda text: model.encode(text).tolist()
+
+
+def create_cache_from_env() -> ResponseCache | None:
+    """
+    Create the response cache configured by the `CHAT_CACHE_*` environment variables.
+
+    Returns:
+        ResponseCache | None: The cache, or None if caching is disabled.
+    """
+
+    backend = os.getenv('CHAT_CACHE_BACKEND', 'memory').lower()
+    max_entries = int(os.getenv('CHAT_CACHE_MAX_ENTRIES', DEFAULT_MAX_ENTRIES))
+    ttl = float(os.getenv('CHAT_CACHE_TTL', DEFAULT_TTL))
+
+    if backend == 'memory':
+        cache = MemoryCache(max_entries, ttl)
+    elif backend == 'disk':
+        cache = DiskCache(os.getenv('CHAT_CACHE_PATH', DEFAULT_CACHE_PATH), max_entries, ttl)
+    elif backend == 'none':
+        return None
+    else:
+        raise ValueError(f'Unknown CHAT_CACHE_BACKEND: {backend}')
+
+    embedding_model = os.getenv('CHAT_CACHE_EMBEDDING_MODEL')
+    if embedding_model:
+        cache.semantic_index = SemanticIndex(
+            load_embedding_model(embedding_model),
+            threshold=float(os.getenv('CHAT_CACHE_SIMILARITY', DEFAULT_SIMILARITY)),
+            max_entries=max_entries,
+        )
+
+    return cache
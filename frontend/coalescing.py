@@ -0,0 +1,144 @@
+"""
+Single-flight coalescing of identical concurrent provider streams.
+
+When many sessions ask the same question at once, for instance by clicking the same template
+card, only the first one calls the provider. The others attach to its stream: each subscriber
+receives every chunk from the start, at its own pace, and may leave at any time. The upstream
+stream is only stopped when its last subscriber leaves.
+"""
+import asyncio
+import contextlib
+from typing import AsyncIterator, Callable, Generic, TypeVar
+
+
+T = TypeVar('T')
+
+
+class SharedStream(Generic[T]):
+    """
+    An async stream read once and replayed to any number of subscribers.
+    """
+
+    def __init__(self, source: AsyncIterator[T], on_close: Callable[['SharedStream'], None]):
+        """
+        Args:
+            source: The upstream stream, read in a task of its own.
+            on_close: Called once the stream has ended or been stopped, after which no new
+                subscriber should attach to it.
+        """
+
+        self.items: list[T] = []
+        self.error: BaseException | None = None
+        self.done = False
+        self.subscribers = 0
+        self._on_close = on_close
+        self._closed = False
+        self._changed = asyncio.Event()
+        self._task = asyncio.create_task(self._pump(source))
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _close(self):
+        if not self._closed:
+            self._closed = True
+            self._on_close(self)
+
+    async def _pump(self, source: AsyncIterator[T]):
+        try:
+            async with contextlib.aclosing(source) as stream:
+                async for item in stream:
+                    self.items.append(item)
+                    self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._close()
+            self._notify()
+
+    async def subscribe(self) -> AsyncIterator[T]:
+        """
+        Read the stream from its start.
+
+        Yields:
+            T: The items of the upstream stream.
+
+        Raises:
+            Exception: The error that ended the upstream stream.
+        """
+
+        self.subscribers += 1
+        index = 0
+        try:
+            while True:
+                changed = self._changed
+                while index < len(self.items):
+                    yield self.items[index]
+                    index += 1
+
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+
+                await changed.wait()
+        finally:
+            self.subscribers -= 1
+            if not self.subscribers and not self.done:
+                # Nobody is reading anymore: stop the upstream stream
+                self._close()
+                self._task.cancel()
+
+
+class StreamCoalescer:
+    """
+    Share the streams of identical concurrent requests.
+    """
+
+    def __init__(self):
+        self._streams: dict[str, SharedStream] = {}
+
+    def subscribe(
+            self,
+            key: str,
+            open_stream: Callable[[], AsyncIterator[T]],
+    ) -> tuple[AsyncIterator[T], bool]:
+        """
+        Attach to the stream of a request, opening it if no identical request is in flight.
+
+        Args:
+            key: Identifies the request.
+            open_stream: Opens the upstream stream of the request.
+
+        Returns:
+            tuple[AsyncIterator[T], bool]: The stream, and whether it was already in flight.
+        """
+
+        shared = self._streams.get(key)
+        joined = shared is not None
+        if shared is None:
+            shared = SharedStream(open_stream(), on_close=lambda s: self._forget(key, s))
+            self._streams[key] = shared
+
+        return shared.subscribe(), joined
+
+    def _forget(self, key: str, shared: SharedStream):
+        if self._streams.get(key) is shared:
+            del self._streams[key]
+
+    def stats(self) -> dict[str, int]:
+        """
+        Get the number of streams in flight and of their subscribers.
+
+        Returns:
+            dict[str, int]: The `streams` and `subscribers` counts.
+        """
+
+        return {
+            'streams': len(self._streams),
+            'subscribers': sum(s.subscribers for s in self._streams.values()),
+        }
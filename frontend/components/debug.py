@@ -0,0 +1,29 @@
+import os
+
+import reflex as rx
+from frontend.state import ChatState
+
+
+# Whether to show the figures of the latest answer below the input field
+DEBUG_PANEL = os.getenv("CHAT_DEBUG_PANEL", "false").lower() in ("1", "true", "yes")
+
+
+def debug_panel() -> rx.Component:
+    """
+    Show the latency and throughput figures of the latest answer of the session.
+
+    Returns:
+        rx.Component: A single line of figures, hidden until the first answer, or nothing
+            unless `CHAT_DEBUG_PANEL` is set.
+    """
+
+    if not DEBUG_PANEL:
+        return rx.fragment()
+
+    return rx.cond(
+        ChatState.answer_stats,
+        rx.text(
+            ChatState.answer_stats,
+            class_name="font-mono text-slate-10 text-xs text-center",
+        ),
+    )
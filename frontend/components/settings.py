@@ -1,6 +1,6 @@
 import reflex as rx
 from reflex.style import set_color_mode, color_mode
-from frontend.state import SettingsState
+from frontend.state import ChatState, FANOUT_ENABLED, SettingsState
 from frontend.components.hint import hint
 
 
@@ -49,6 +49,26 @@ def font_item(font: str) -> rx.Component:
     )
 
 
+def answer_mode_selector() -> rx.Component:
+
+    return rx.box(
+        rx.text(
+            "Answers",
+            class_name="font-medium text-base text-slate-12",
+        ),
+        rx.segmented_control.root(
+            rx.segmented_control.item("Auto", value="auto", class_name="cursor-pointer"),
+            rx.segmented_control.item("Fastest", value="fastest", class_name="cursor-pointer"),
+            rx.segmented_control.item("Compare", value="compare", class_name="cursor-pointer"),
+            on_change=ChatState.set_answer_mode,
+            variant="classic",
+            radius="large",
+            value=ChatState.answer_mode,
+        ),
+        class_name="flex flex-col gap-2",
+    )
+
+
 def settings_icon() -> rx.Component:
 
     colors = ["violet", "amber", "green", "blue", "orange", "red"]
@@ -128,6 +148,8 @@ def settings_icon() -> rx.Component:
                     ),
                     class_name="flex flex-col gap-2",
                 ),
+                # How the questions are answered, when other models are configured
+                *([answer_mode_selector()] if FANOUT_ENABLED else []),
                 class_name="flex flex-col gap-8 border-slate-5 bg-slate-1 shadow-lg px-[0.875rem] py-4 border border-box rounded-xl overflow-hidden",
             ),
             side="top",
@@ -0,0 +1,153 @@
+"""
+Build the list of messages sent to the LLM within a token budget.
+
+Sending the whole chat history on every turn makes long sessions slower and more expensive
+until they overflow the model's context window. The context builder keeps the system
+messages and as many of the most recent turns as fit in the budget of the model.
+"""
+import functools
+import os
+
+from frontend.provider import load_litellm
+
+
+# Tokens available for the prompt when neither the environment nor litellm knows the model
+DEFAULT_CONTEXT_TOKENS = 16_000
+
+
+@functools.lru_cache(maxsize=8192)
+def count_message_tokens(model: str, role: str, content: str) -> int:
+    """
+    Count the tokens of a single message with the model's tokenizer.
+
+    The result is cached, so the messages of a conversation are only counted once rather
+    than on every turn.
+
+    Args:
+        model: The litellm model name.
+        role: The role of the message author.
+        content: The message text.
+
+    Returns:
+        int: The number of prompt tokens used by the message.
+    """
+
+    return load_litellm().token_counter(model=model, messages=[{'role': role, 'content': content}])
+
+
+def parse_model_map(spec: str) -> dict[str, int]:
+    """
+    Parse per-model settings of the form `model=value,model=value`.
+
+    Args:
+        spec: The settings specification.
+
+    Returns:
+        dict[str, int]: The value of each listed model.
+    """
+
+    values = {}
+    for item in spec.split(','):
+        if item.strip():
+            model, value = item.rsplit('=', 1)
+            values[model.strip()] = int(value)
+
+    return values
+
+
+class ContextBuilder:
+    """
+    Select the messages to send to a model so that the prompt fits its token budget.
+    """
+
+    def __init__(self, budgets: dict[str, int] | None = None, max_tokens: int = DEFAULT_CONTEXT_TOKENS):
+        """
+        Args:
+            budgets: Prompt token budgets of specific models.
+            max_tokens: Upper bound on the prompt tokens of any model without an explicit
+                budget; the model's own input limit applies when it is lower.
+        """
+
+        self.budgets = budgets or {}
+        self.max_tokens = max_tokens
+
+    @classmethod
+    def from_env(cls) -> 'ContextBuilder':
+        """
+        Build a context builder from the `CHAT_CONTEXT_*` environment variables.
+
+        Returns:
+            ContextBuilder: The configured context builder.
+        """
+
+        return cls(
+            budgets=parse_model_map(os.getenv('CHAT_CONTEXT_BUDGETS', '')),
+            max_tokens=int(os.getenv('CHAT_CONTEXT_MAX_TOKENS', DEFAULT_CONTEXT_TOKENS)),
+        )
+
+    def get_budget(self, model: str, max_output_tokens: int = 0) -> int:
+        """
+        Get the number of prompt tokens available for a model.
+
+        Args:
+            model: The litellm model name.
+            max_output_tokens: Tokens reserved for the answer.
+
+        Returns:
+            int: The prompt token budget.
+        """
+
+        if model in self.budgets:
+            return self.budgets[model]
+
+        budget = self.max_tokens
+        try:
+            max_input_tokens = load_litellm().get_model_info(model).get('max_input_tokens')
+        except Exception:
+            max_input_tokens = None
+
+        if max_input_tokens:
+            budget = min(budget, max_input_tokens - max_output_tokens)
+
+        return budget
+
+    def build(
+            self,
+            model: str,
+            messages: list[dict[str, str]],
+            max_output_tokens: int = 0,
+    ) -> list[dict[str, str]]:
+        """
+        Select the messages to send, dropping the oldest turns that do not fit the budget.
+
+        System messages are always kept, and so is the latest message even if it alone
+        exceeds the budget. The kept history never starts with an assistant message.
+
+        Args:
+            model: The litellm model name.
+            messages: The conversation, oldest message first.
+            max_output_tokens: Tokens reserved for the answer.
+
+        Returns:
+            list[dict[str, str]]: The system messages followed by the kept turns.
+        """
+
+        budget = self.get_budget(model, max_output_tokens)
+        messages = [m for m in messages if m['content']]
+        system = [m for m in messages if m['role'] == 'system']
+        turns = [m for m in messages if m['role'] != 'system']
+
+        used = sum(count_message_tokens(model, m['role'], m['content']) for m in system)
+        start = len(turns)
+        for i in range(len(turns) - 1, -1, -1):
+            tokens = count_message_tokens(model, turns[i]['role'], turns[i]['content'])
+            if used + tokens > budget and start < len(turns):
+                break
+            used += tokens
+            start = i
+
+        # Do not open the kept history with a dangling answer
+        while start < len(turns) - 1 and turns[start]['role'] == 'assistant':
+            start += 1
+
+        return system + turns[start:]
@@ -0,0 +1,270 @@
+"""
+Sending one question to several models at once.
+
+In the hedged mode, the models race: the answer of the first one to stream a token is kept
+and the others are cancelled, trading extra provider calls for a lower time to the first
+token. In the compare mode, every answer is streamed side by side. Whether a question is
+hedged by default is decided from the recent times to the first token of its model.
+"""
+import asyncio
+import contextlib
+import os
+import statistics
+from collections import deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Callable, Generic, TypeVar
+
+
+T = TypeVar('T')
+
+
+@dataclass
+class Finished:
+    """
+    Marks the end of one of the streams of a `StreamGroup`.
+    """
+
+    # The error that ended the stream, if any
+    error: Exception | None = None
+
+
+class StreamGroup(Generic[T]):
+    """
+    Read several async streams concurrently, as one stream of `(name, item)` pairs.
+    """
+
+    def __init__(self, streams: dict[str, AsyncIterator[T]]):
+        """
+        Args:
+            streams: The streams by name, each read in a task of its own.
+        """
+
+        self._queue: asyncio.Queue[tuple[str, T | Finished]] = asyncio.Queue()
+        self._tasks = {
+            name: asyncio.create_task(self._pump(name, stream)) for name, stream in streams.items()
+        }
+        self._running = set(self._tasks)
+
+    async def _pump(self, name: str, stream: AsyncIterator[T]):
+        error = None
+        try:
+            async with contextlib.aclosing(stream):
+                async for item in stream:
+                    self._queue.put_nowait((name, item))
+        except Exception as e:
+            error = e
+        self._queue.put_nowait((name, Finished(error)))
+
+    def cancel(self, name: str):
+        """
+        Stop reading a stream; its pending items are discarded.
+
+        Args:
+            name: The name of the stream.
+        """
+
+        self._running.discard(name)
+        self._tasks[name].cancel()
+
+    async def __aiter__(self) -> AsyncIterator[tuple[str, T | Finished]]:
+        """
+        Yields:
+            tuple[str, T | Finished]: The items of the streams as they arrive, and a `Finished`
+                item at the end of each stream that was not cancelled.
+        """
+
+        while self._running:
+            name, item = await self._queue.get()
+            if name not in self._running:
+                continue
+            if isinstance(item, Finished):
+                self._running.discard(name)
+            yield name, item
+
+    async def aclose(self):
+        """
+        Cancel the streams still being read.
+        """
+
+        for name in list(self._running):
+            self.cancel(name)
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+
+
+async def first_responder(
+        streams: dict[str, AsyncIterator[T]],
+        started: Callable[[T], bool],
+) -> AsyncIterator[tuple[str, T]]:
+    """
+    Race several streams and follow the first one to start, cancelling the others.
+
+    Until a stream starts, the items of the first stream are passed through, such as the
+    queue positions of the preferred model. A stream ending before it starts leaves the race.
+
+    Args:
+        streams: The competing streams by name, the preferred one first.
+        started: Tells whether an item starts its stream, such as the first text token.
+
+    Yields:
+        tuple[str, T]: The name of the stream and its items.
+
+    Raises:
+        Exception: The error that ended the winning stream, or the last error if every
+            stream ended before starting.
+    """
+
+    preferred = next(iter(streams))
+    group = StreamGroup(streams)
+    remaining = set(streams)
+    winner = None
+    error = None
+    try:
+        async for name, item in group:
+            if isinstance(item, Finished):
+                remaining.discard(name)
+                if name == winner:
+                    error = item.error
+                else:
+                    error = item.error or error
+                if name == winner or not remaining:
+                    if error is not None:
+                        raise error
+                    return
+                continue
+
+            if winner is None:
+                if not started(item):
+                    if name == preferred:
+                        yield name, item
+                    continue
+                winner = name
+                for other in streams:
+                    if other != winner:
+                        group.cancel(other)
+
+            yield name, item
+    finally:
+        await group.aclose()
+
+
+class LatencyTracker:
+    """
+    The recent times to the first token of each model.
+    """
+
+    def __init__(self, window: int = 50):
+        """
+        Args:
+            window: The number of latest samples kept per model.
+        """
+
+        self._window = window
+        self._samples: dict[str, deque[float]] = {}
+
+    def observe(self, model: str, seconds: float):
+        """
+        Record the time to the first token of an answer.
+
+        Args:
+            model: The litellm model name.
+            seconds: The time from the call to the first token.
+        """
+
+        self._samples.setdefault(model, deque(maxlen=self._window)).append(seconds)
+
+    def percentile(self, model: str, percent: int, min_samples: int = 1) -> float | None:
+        """
+        Get a percentile of the recent times to the first token of a model.
+
+        Args:
+            model: The litellm model name.
+            percent: The percentile, from 1 to 99.
+            min_samples: The samples required for the figure to be meaningful.
+
+        Returns:
+            float | None: The percentile in seconds, or None without enough samples.
+        """
+
+        samples = self._samples.get(model, ())
+        if len(samples) < max(min_samples, 2):
+            return None
+
+        return statistics.quantiles(samples, n=100)[percent - 1]
+
+
+@dataclass
+class FanoutPolicy:
+    """
+    The models sent the same question, and when questions are hedged.
+    """
+
+    # Models raced or compared with the session model
+    models: list[str] = field(default_factory=list)
+    # When questions are hedged: `off`, `always`, or `auto` from the latency statistics
+    hedge: str = 'auto'
+    # Time to the first token of a model, at the 90th percentile, above which `auto` hedges
+    # its questions, in seconds
+    hedge_threshold: float = 2.0
+    # Answers of a model observed before `auto` relies on its statistics
+    min_samples: int = 5
+
+    @classmethod
+    def from_env(cls) -> 'FanoutPolicy':
+        """
+        Build the policy from the `CHAT_FANOUT_MODELS`, `CHAT_HEDGE`, `CHAT_HEDGE_THRESHOLD`
+        and `CHAT_HEDGE_MIN_SAMPLES` environment variables.
+
+        Returns:
+            FanoutPolicy: The configured policy.
+        """
+
+        return cls(
+            models=[m.strip() for m in os.getenv('CHAT_FANOUT_MODELS', '').split(',') if m.strip()],
+            hedge=os.getenv('CHAT_HEDGE', cls.hedge).lower(),
+            hedge_threshold=float(os.getenv('CHAT_HEDGE_THRESHOLD', cls.hedge_threshold)),
+            min_samples=int(os.getenv('CHAT_HEDGE_MIN_SAMPLES', cls.min_samples)),
+        )
+
+    def compared_models(self, model: str) -> list[str]:
+        """
+        Get the models answering a question in the compare mode.
+
+        Args:
+            model: The model of the session.
+
+        Returns:
+            list[str]: The session model followed by the other fan-out models.
+        """
+
+        return [model] + [m for m in self.models if m != model]
+
+    def hedged_models(self, model: str, tracker: LatencyTracker, force: bool = False) -> list[str]:
+        """
+        Get the models racing to answer a question.
+
+        In the `auto` mode, a question is hedged when the model of the session has been slow
+        to start its recent answers, and only with the models that have not been slower.
+
+        Args:
+            model: The model of the session.
+            tracker: The recent latencies of the models.
+            force: Hedge even if the policy would not, as requested by the session.
+
+        Returns:
+            list[str]: The session model, followed by the models racing it if hedged.
+        """
+
+        others = [m for m in self.models if m != model]
+        if not others or self.hedge == 'off' and not force:
+            return [model]
+        if force or self.hedge == 'always':
+            return [model] + others
+
+        slow = tracker.percentile(model, 90, self.min_samples)
+        if slow is None or slow <= self.hedge_threshold:
+            return [model]
+
+        # Models without statistics yet join the race, which measures them
+        return [model] + [
+            m for m in others if (tracker.percentile(m, 50, self.min_samples) or 0) < slow
+        ]
@@ -1,11 +1,18 @@
 import reflex as rx
 
 from frontend import style
-from frontend.state import SettingsState
+from frontend.state import DEFAULT_MODEL, ChatState, SettingsState, drain_generations
 from frontend.components.settings import settings_icon
 from frontend.components.reset import reset
+from frontend.metrics import metrics_app, serve_worker_metrics, worker_metrics_port
+from frontend.http_pool import prewarm_http_pool
+from frontend.llm import ensure_response_cache, get_retry_policy
+from frontend.provider import offline_mode, preload_enabled, preload_litellm
+from frontend.sessions import evict_sessions
+from frontend.transfer import transfer_app, transfer_token
 from frontend.views.templates import templates
 from frontend.views.chat import chat, action_bar
+from frontend.warmup import warm_up_templates, warmup_enabled
 
 
 def index() -> rx.Component:
@@ -37,7 +44,35 @@ def index() -> rx.Component:
     )
 
 
-app = rx.App(stylesheets=style.STYLESHEETS, style={"font_family": "var(--font-family)"})
+app = rx.App(
+    stylesheets=style.STYLESHEETS,
+    style={"font_family": "var(--font-family)"},
+    # Serve the Prometheus metrics at /metrics on the backend, and the conversation export and
+    # import routes if enabled
+    api_transformer=[metrics_app, transfer_app] if transfer_token() else metrics_app,
+)
 app.add_page(
-    index, title="Chatbot", description="A chatbot powered by Reflex and LlamaIndex!"
+    index,
+    title="Chatbot",
+    description="A chatbot powered by Reflex and LlamaIndex!",
+    on_load=ChatState.start_session,
 )
+
+# Let the answers being generated finish on shutdown
+app.register_lifespan_task(drain_generations)
+# Evict the idle sessions, and the least recently used ones above the memory high-water mark
+app.register_lifespan_task(evict_sessions, rx_app=app, state_cls=ChatState)
+
+if preload_enabled():
+    app.register_lifespan_task(preload_litellm)
+# Create the response cache, and load its embedding model if any, before the first question
+app.register_lifespan_task(ensure_response_cache)
+if worker_metrics_port():
+    # Lets a scraper collect each worker, rather than whichever answers the /metrics route
+    app.register_lifespan_task(serve_worker_metrics)
+if not offline_mode():
+    # Open the connections to the providers of the app model and its fallbacks
+    app.register_lifespan_task(
+        prewarm_http_pool, models=get_retry_policy().models(DEFAULT_MODEL))
+if warmup_enabled():
+    app.register_lifespan_task(warm_up_templates)
@@ -0,0 +1,263 @@
+"""
+Durable storage of the conversations.
+
+Messages are appended to an SQLite file one at a time, as they are finalized, so that the
+conversations survive a restart of the backend. A reconnecting session only loads the latest
+page of its conversation; older pages are read back on demand.
+"""
+import functools
+import os
+import sqlite3
+import threading
+import time
+from typing import Iterable, Iterator, NamedTuple
+
+
+# Default location of the conversation store
+DEFAULT_HISTORY_PATH = '.data/conversations.db'
+# Default number of messages loaded at a time
+DEFAULT_PAGE_SIZE = 50
+# Messages read or written at a time when conversations are exported or imported
+TRANSFER_BATCH_SIZE = 500
+
+
+class StoredMessage(NamedTuple):
+    """
+    A message read from the store.
+    """
+
+    # Increases with the order in which the messages were stored
+    id: int
+    role: str
+    content: str
+    # When the message was stored, in seconds since the epoch
+    created: float
+
+
+class ExportedMessage(NamedTuple):
+    """
+    A message read from the store with the ids of its session and conversation.
+    """
+
+    id: int
+    session_id: str
+    conversation_id: str
+    role: str
+    content: str
+    created: float
+
+
+class ConversationStore:
+    """
+    SQLite-backed store of the messages of every conversation, shared by the processes of a
+    host.
+    """
+
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH):
+        """
+        Args:
+            path: The SQLite database file; its directory is created if needed.
+        """
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, conversation_id TEXT, '
+            'role TEXT, content TEXT, created REAL)'
+        )
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS messages_conversation ON messages (conversation_id, id)'
+        )
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS summaries ('
+            'conversation_id TEXT PRIMARY KEY, content TEXT, through_id INTEGER, created REAL)'
+        )
+        self._lock = threading.Lock()
+
+    def append(self, session_id: str, conversation_id: str, role: str, content: str) -> int:
+        """
+        Store a finalized message at the end of its conversation.
+
+        Args:
+            session_id: The id of the browser session.
+            conversation_id: The id of the conversation.
+            role: Who wrote the message.
+            content: The text of the message.
+
+        Returns:
+            int: The id of the stored message.
+        """
+
+        with self._lock:
+            cursor = self._db.execute(
+                'INSERT INTO messages (session_id, conversation_id, role, content, created) '
+                'VALUES (?, ?, ?, ?, ?)',
+                (session_id, conversation_id, role, content, time.time()),
+            )
+            return cursor.lastrowid
+
+    def load_page(
+            self,
+            conversation_id: str,
+            before: int | None = None,
+            limit: int = DEFAULT_PAGE_SIZE,
+    ) -> tuple[list[StoredMessage], bool]:
+        """
+        Read the latest messages of a conversation, older than a given message if any.
+
+        Args:
+            conversation_id: The id of the conversation.
+            before: Only read the messages stored before the message with this id.
+            limit: The maximum number of messages read.
+
+        Returns:
+            tuple[list[StoredMessage], bool]: The messages in chronological order, and whether
+                there are older ones.
+        """
+
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT id, role, content, created FROM messages WHERE conversation_id = ? AND id < ? '
+                'ORDER BY id DESC LIMIT ?',
+                (conversation_id, before if before is not None else 2 ** 63 - 1, limit + 1),
+            ).fetchall()
+
+        return [StoredMessage(*row) for row in reversed(rows[:limit])], len(rows) > limit
+
+    def append_many(self, messages: Iterable[tuple[str, str, str, str, float]]) -> int:
+        """
+        Store a batch of messages in a single transaction, at the end of their conversations.
+
+        Args:
+            messages: The session id, conversation id, role, content and creation time of each
+                message, in the order of their conversations.
+
+        Returns:
+            int: The number of stored messages.
+        """
+
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                cursor = self._db.executemany(
+                    'INSERT INTO messages (session_id, conversation_id, role, content, created) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    messages,
+                )
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+            return cursor.rowcount
+
+    def iter_messages(
+            self,
+            conversation_id: str | None = None,
+            batch_size: int = TRANSFER_BATCH_SIZE,
+    ) -> Iterator[ExportedMessage]:
+        """
+        Read the messages of every conversation, or of one, a batch at a time.
+
+        The store is only locked while a batch is read, so the messages stored in the meantime
+        may or may not be included.
+
+        Args:
+            conversation_id: Only read the messages of this conversation.
+            batch_size: The number of messages read at a time.
+
+        Yields:
+            ExportedMessage: The messages, grouped by conversation in chronological order.
+        """
+
+        after = ('', 0) if conversation_id is None else (conversation_id, 0)
+        while True:
+            with self._lock:
+                if conversation_id is None:
+                    rows = self._db.execute(
+                        'SELECT id, session_id, conversation_id, role, content, created FROM messages '
+                        'WHERE (conversation_id, id) > (?, ?) ORDER BY conversation_id, id LIMIT ?',
+                        (*after, batch_size),
+                    ).fetchall()
+                else:
+                    rows = self._db.execute(
+                        'SELECT id, session_id, conversation_id, role, content, created FROM messages '
+                        'WHERE conversation_id = ? AND id > ? ORDER BY id LIMIT ?',
+                        (*after, batch_size),
+                    ).fetchall()
+
+            for row in rows:
+                yield ExportedMessage(*row)
+            if len(rows) < batch_size:
+                return
+            after = (rows[-1][2], rows[-1][0])
+
+    def save_summary(self, conversation_id: str, content: str, through_id: int):
+        """
+        Store the running summary of a conversation, replacing the previous one.
+
+        Args:
+            conversation_id: The id of the conversation.
+            content: The summary.
+            through_id: The id of the latest message the summary covers.
+        """
+
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO summaries (conversation_id, content, through_id, created) '
+                'VALUES (?, ?, ?, ?)',
+                (conversation_id, content, through_id, time.time()),
+            )
+
+    def load_summary(self, conversation_id: str) -> tuple[str, int] | None:
+        """
+        Read the running summary of a conversation.
+
+        Args:
+            conversation_id: The id of the conversation.
+
+        Returns:
+            tuple[str, int] | None: The summary and the id of the latest message it covers, or
+                None if the conversation has no summary.
+        """
+
+        with self._lock:
+            row = self._db.execute(
+                'SELECT content, through_id FROM summaries WHERE conversation_id = ?',
+                (conversation_id,),
+            ).fetchone()
+
+        return tuple(row) if row else None
+
+
+def create_store_from_env() -> ConversationStore | None:
+    """
+    Create the conversation store configured by the `CHAT_HISTORY_*` environment variables.
+
+    Returns:
+        ConversationStore | None: The store, or None if the conversations are not persisted.
+    """
+
+    backend = os.getenv('CHAT_HISTORY_BACKEND', 'sqlite').lower()
+    if backend == 'sqlite':
+        return ConversationStore(os.getenv('CHAT_HISTORY_PATH', DEFAULT_HISTORY_PATH))
+    if backend == 'none':
+        return None
+
+    raise ValueError(f'Unknown CHAT_HISTORY_BACKEND: {backend}')
+
+
+@functools.cache
+def get_conversation_store() -> ConversationStore | None:
+    """
+    Get the process-wide conversation store, created on first use from the environment.
+
+    Returns:
+        ConversationStore | None: The store, or None if the conversations are not persisted.
+    """
+
+    return create_store_from_env()
@@ -0,0 +1,184 @@
+"""
+The HTTP connection pool shared by the provider calls.
+
+litellm keeps HTTP clients per provider in a cache whose entries expire, and the OpenAI SDK
+may create a client per call, so a question can pay for a new TCP and TLS handshake before
+its first token. A single keep-alive client, optionally over HTTP/2, is instead handed to every
+completion call, and its connections to the providers are opened at startup.
+"""
+import functools
+import importlib.util
+import logging
+import os
+from dataclasses import dataclass
+
+import httpx
+
+from frontend import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# Hosts of the providers, to open connections to at startup
+PROVIDER_URLS = {
+    'gemini': 'https://generativelanguage.googleapis.com/',
+    'anthropic': 'https://api.anthropic.com/',
+    'openai': 'https://api.openai.com/',
+}
+# Providers called through the OpenAI SDK, which takes the client from `litellm.aclient_session`
+# rather than from the `client` argument
+OPENAI_SDK_PROVIDERS = ('openai', 'azure', 'text-completion-openai')
+
+
+@dataclass
+class PoolSettings:
+    """
+    Limits and protocol of the connection pool.
+    """
+
+    # Connections open at the same time
+    max_connections: int = 100
+    # Idle connections kept open
+    max_keepalive: int = 20
+    # Seconds an idle connection is kept open
+    keepalive_expiry: float = 60.0
+    # Whether to use HTTP/2 with the providers supporting it (requires the h2 package)
+    http2: bool = True
+
+    @classmethod
+    def from_env(cls) -> 'PoolSettings':
+        """
+        Build the settings from the `CHAT_HTTP_*` environment variables.
+
+        Returns:
+            PoolSettings: The configured settings.
+        """
+
+        return cls(
+            max_connections=int(os.getenv('CHAT_HTTP_MAX_CONNECTIONS', cls.max_connections)),
+            max_keepalive=int(os.getenv('CHAT_HTTP_MAX_KEEPALIVE', cls.max_keepalive)),
+            keepalive_expiry=float(os.getenv('CHAT_HTTP_KEEPALIVE_EXPIRY', cls.keepalive_expiry)),
+            http2=os.getenv('CHAT_HTTP2', 'true').lower() in ('1', 'true', 'yes'),
+        )
+
+
+# The settings of this process
+POOL_SETTINGS = PoolSettings.from_env()
+
+
+@functools.cache
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Get the process-wide HTTP client, created on first use.
+
+    Returns:
+        httpx.AsyncClient: The client.
+    """
+
+    http2 = POOL_SETTINGS.http2
+    if http2 and importlib.util.find_spec('h2') is None:
+        logger.warning('HTTP/2 requires `pip install h2`; using HTTP/1.1')
+        http2 = False
+
+    return httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=POOL_SETTINGS.max_connections,
+            max_keepalive_connections=POOL_SETTINGS.max_keepalive,
+            keepalive_expiry=POOL_SETTINGS.keepalive_expiry,
+        ),
+        # The timeouts of the answers are enforced by the retry policy
+        timeout=httpx.Timeout(600.0, connect=5.0),
+    )
+
+
+@functools.cache
+def get_http_handler():
+    """
+    Get the litellm HTTP handler wrapping the process-wide client.
+
+    Returns:
+        AsyncHTTPHandler: The handler, to be passed as the `client` of the completion calls.
+    """
+
+    from litellm.llms.custom_httpx.http_handler import AsyncHTTPHandler
+
+    # Set up as `AsyncHTTPHandler.__init__` does, which would create a client of its own
+    handler = AsyncHTTPHandler.__new__(AsyncHTTPHandler)
+    handler.timeout = None
+    handler.event_hooks = None
+    handler.client_alias = None
+    handler.client = get_http_client()
+    return handler
+
+
+@functools.cache
+def completion_client(model: str):
+    """
+    Get the client to pass to the completion calls of a model.
+
+    Args:
+        model: The litellm model name.
+
+    Returns:
+        AsyncHTTPHandler | None: The shared handler, or None for the custom providers and the
+            providers called through the OpenAI SDK, which use the shared client through
+            `litellm.aclient_session`.
+    """
+
+    import litellm
+
+    # Custom providers, such as the mock one, make no HTTP calls through litellm
+    if model.split('/')[0] in {p['provider'] for p in litellm.custom_provider_map}:
+        return None
+
+    try:
+        provider = litellm.get_llm_provider(model)[1]
+    except Exception:
+        return None
+
+    if provider in OPENAI_SDK_PROVIDERS or provider in litellm.openai_compatible_providers:
+        return None
+
+    return get_http_handler()
+
+
+def _connection_counts() -> dict[tuple[str, ...], int]:
+    counts = {('active',): 0, ('idle',): 0}
+    if get_http_client.cache_info().currsize == 0:
+        return counts
+
+    # The connections of the pool are not part of the public API of httpx
+    pool = getattr(getattr(get_http_client(), '_transport', None), '_pool', None)
+    for connection in getattr(pool, 'connections', ()):
+        counts[('idle',) if connection.is_idle() else ('active',)] += 1
+
+    return counts
+
+
+metrics.Gauge(
+    'chat_http_connections', 'Connections of the provider HTTP pool by state.', ('state',),
+    collect=_connection_counts,
+)
+metrics.Gauge(
+    'chat_http_max_connections', 'Connections the provider HTTP pool may open.',
+    collect=lambda: {(): POOL_SETTINGS.max_connections},
+)
+
+
+async def prewarm_http_pool(models: list[str]):
+    """
+    Open connections to the providers of the models, so that the first questions do not wait
+    for the handshakes.
+
+    Args:
+        models: The litellm model names.
+    """
+
+    client = get_http_client()
+    urls = {PROVIDER_URLS[m.split('/')[0]] for m in models if m.split('/')[0] in PROVIDER_URLS}
+    for url in urls:
+        try:
+            await client.head(url)
+        except httpx.HTTPError as e:
+            logger.warning('Could not open a connection to %s: %r', url, e)
@@ -0,0 +1,543 @@
+"""
+The completion pipeline between the chat state and litellm.
+
+The chat state consumes answers as an async stream of text deltas, whether they come from
+the provider or from the response cache.
+"""
+import asyncio
+import contextlib
+import functools
+import inspect
+import logging
+import os
+import re
+import threading
+import time
+from typing import TYPE_CHECKING, AsyncIterator
+
+from frontend import metrics
+from frontend.cache import ResponseCache, create_cache_from_env, make_cache_key
+from frontend.coalescing import StreamCoalescer
+from frontend.context import count_message_tokens
+from frontend.fanout import FanoutPolicy, Finished, LatencyTracker, StreamGroup, first_responder
+from frontend.http_pool import completion_client
+from frontend.provider import ensure_litellm, load_litellm
+from frontend.retry import Attempt, RetryPolicy, is_retryable
+from frontend.scheduler import LLMScheduler, QueuePosition
+from frontend.streaming import StreamBuffer
+
+if TYPE_CHECKING:
+    from litellm.types.utils import ModelResponseStream
+
+
+logger = logging.getLogger(__name__)
+
+# Splits a cached answer into word-sized chunks for replay
+_REPLAY_CHUNK = re.compile(r'\S+\s*|\s+')
+# Pause between replayed chunks, so that stored answers stream at a readable pace
+REPLAY_DELAY = float(os.getenv('CHAT_REPLAY_DELAY_MS', 10)) / 1000
+# Whether identical concurrent requests share one provider stream
+COALESCE = os.getenv('CHAT_COALESCE', 'true').lower() in ('1', 'true', 'yes')
+
+# Answers computed ahead of time (see `precompute`), keyed like the response cache
+_precomputed: dict[str, str] = {}
+
+
+class _NoCache:
+    """
+    Stands in for a disabled, or not yet created, response cache in the metrics.
+    """
+
+    @staticmethod
+    def stats() -> dict[str, int]:
+        return {}
+
+
+# Lets a single thread create the response cache, which may load an embedding model
+_cache_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache | None:
+    """
+    Get the process-wide response cache, created on first use from the environment.
+
+    From the event loop, await `ensure_response_cache` instead: with near-duplicate matching,
+    creating the cache loads an embedding model, which takes seconds.
+
+    Returns:
+        ResponseCache | None: The cache, or None if caching is disabled.
+    """
+
+    with _cache_lock:
+        return _create_response_cache()
+
+
+@functools.cache
+def _create_response_cache() -> ResponseCache | None:
+    return create_cache_from_env()
+
+
+def response_cache_created() -> bool:
+    """
+    Tell whether the response cache is created already.
+
+    Returns:
+        bool: True if `get_response_cache` returns at once.
+    """
+
+    return _create_response_cache.cache_info().currsize > 0
+
+
+async def ensure_response_cache() -> ResponseCache | None:
+    """
+    Get the response cache, creating it in a thread on first use.
+
+    Returns:
+        ResponseCache | None: The cache, or None if caching is disabled.
+    """
+
+    if not response_cache_created():
+        return await asyncio.to_thread(get_response_cache)
+
+    return get_response_cache()
+
+
+@functools.cache
+def get_scheduler() -> LLMScheduler:
+    """
+    Get the process-wide scheduler of the provider calls, created on first use.
+
+    Returns:
+        LLMScheduler: The scheduler.
+    """
+
+    return LLMScheduler.from_env()
+
+
+metrics.Gauge(
+    'chat_queue_depth', 'Provider calls waiting for a scheduler slot.', ('model',),
+    collect=lambda: {(model,): stats['queued'] for model, stats in get_scheduler().stats().items()},
+)
+metrics.Gauge(
+    'chat_active_calls', 'Provider calls holding a scheduler slot.', ('model',),
+    collect=lambda: {(model,): stats['active'] for model, stats in get_scheduler().stats().items()},
+)
+metrics.Gauge(
+    'chat_coalesced_streams', 'Shared provider streams in flight, and their subscribers.', ('kind',),
+    collect=lambda: {(kind,): count for kind, count in get_coalescer().stats().items()},
+)
+metrics.Gauge(
+    'chat_cache_lookups', 'Response cache lookups by result.', ('result',),
+    # Not created by a scrape, which would load the embedding model on the event loop
+    collect=lambda: {
+        (result,): count for result, count in (
+            (get_response_cache() if response_cache_created() else None) or _NoCache
+        ).stats().items()
+    },
+)
+
+
+@functools.cache
+def get_coalescer() -> StreamCoalescer:
+    """
+    Get the process-wide registry of the provider streams in flight.
+
+    Returns:
+        StreamCoalescer: The registry.
+    """
+
+    return StreamCoalescer()
+
+
+@functools.cache
+def get_fanout_policy() -> FanoutPolicy:
+    """
+    Get the models sent the same question, and when questions are hedged.
+
+    Returns:
+        FanoutPolicy: The policy configured by the environment.
+    """
+
+    return FanoutPolicy.from_env()
+
+
+@functools.cache
+def get_latency_tracker() -> LatencyTracker:
+    """
+    Get the process-wide record of the recent times to the first token of each model.
+
+    Returns:
+        LatencyTracker: The record.
+    """
+
+    return LatencyTracker()
+
+
+@functools.cache
+def get_retry_policy() -> RetryPolicy:
+    """
+    Get the timeouts, retries and fallback models of the provider calls.
+
+    Returns:
+        RetryPolicy: The policy configured by the environment.
+    """
+
+    return RetryPolicy.from_env()
+
+
+def estimate_tokens(model: str, messages: list[dict[str, str]], max_tokens: int) -> int:
+    """
+    Estimate the tokens a call uses: the prompt plus the longest possible answer.
+
+    Args:
+        model: The litellm model name.
+        messages: The messages sent to the model.
+        max_tokens: The maximum number of tokens in the answer.
+
+    Returns:
+        int: The estimated number of tokens.
+    """
+
+    return max_tokens + sum(count_message_tokens(model, m['role'], m['content']) for m in messages)
+
+
+async def replay(text: str) -> AsyncIterator[str]:
+    """
+    Stream a stored answer in chunks resembling a provider response.
+
+    Args:
+        text: The answer.
+
+    Yields:
+        str: Word-sized chunks, which concatenate to `text`.
+    """
+
+    for i, chunk in enumerate(_REPLAY_CHUNK.findall(text)):
+        if i and REPLAY_DELAY:
+            await asyncio.sleep(REPLAY_DELAY)
+        yield chunk
+
+
+async def close_stream(response):
+    """
+    Release the provider connection of a stream that was not read to the end.
+
+    litellm does not close the underlying HTTP response when iteration stops early, so the
+    provider would keep generating (and billing) the rest of the answer.
+
+    Args:
+        response: The stream returned by `litellm.acompletion`.
+    """
+
+    stream = getattr(response, 'completion_stream', None)
+    for target in (stream, getattr(stream, 'streaming_response', None), getattr(stream, 'response', None)):
+        close = getattr(target, 'aclose', None) or getattr(target, 'close', None)
+        if close is None:
+            continue
+        try:
+            result = close()
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            pass
+
+
+async def stream_completion(
+        model: str,
+        messages: list[dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        session_id: str = '',
+        conversation_id: str = '',
+        refresh: bool = False,
+        attempts: list[Attempt] | None = None,
+) -> AsyncIterator[str | QueuePosition]:
+    """
+    Stream the answer to a list of messages, from a precomputed answer or the response
+    cache when possible.
+
+    Identical concurrent requests share one provider stream (see `StreamCoalescer`), unless
+    `attempts` are recorded: each consumer receives the whole answer and may stop reading
+    without affecting the others.
+
+    Provider calls go through the process-wide scheduler; while a call waits for a slot,
+    its queue position is yielded. Failed calls are retried, then the fallback models are
+    tried, as long as no token has been yielded (see `RetryPolicy`). A complete answer from
+    the requested model is added to the cache. An answer cut short, because of an error or
+    because the consumer stopped iterating, is not.
+
+    Args:
+        model: The litellm model name.
+        messages: The messages sent to the model.
+        temperature: The sampling temperature.
+        max_tokens: The maximum number of tokens in the answer.
+        session_id: The id of the browser session asking.
+        conversation_id: The id of the conversation the messages belong to.
+        refresh: Always ask the provider, bypassing stored answers.
+        attempts: If given, a record of each provider call is appended to it.
+
+    Yields:
+        str | QueuePosition: The queue positions while waiting, then the text deltas of the
+            answer.
+
+    Raises:
+        Exception: The error of the last attempt if every model failed, or the error that
+            interrupted the answer.
+    """
+
+    cache = await ensure_response_cache()
+    if not refresh:
+        stored = _precomputed.get(make_cache_key(model, messages, temperature, max_tokens))
+        if stored is None and cache is not None:
+            stored = await cache.alookup(model, messages, temperature, max_tokens)
+
+        if stored is not None:
+            async for chunk in replay(stored):
+                yield chunk
+            return
+
+    args = (model, messages, temperature, max_tokens, session_id, conversation_id)
+    if not COALESCE or attempts is not None:
+        stream = _stream_provider(*args, [] if attempts is None else attempts)
+    else:
+        stream, joined = get_coalescer().subscribe(
+            make_cache_key(model, messages, temperature, max_tokens),
+            lambda: _stream_provider(*args, []),
+        )
+        if joined:
+            metrics.COALESCED.inc(model=model)
+
+    async with contextlib.aclosing(stream):
+        async for delta in stream:
+            yield delta
+
+
+async def stream_hedged(
+        models: list[str],
+        messages: list[dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        session_id: str = '',
+        conversation_id: str = '',
+) -> AsyncIterator[tuple[str, str | QueuePosition]]:
+    """
+    Send the same messages to several models at once and stream the answer of the first one
+    to produce a token, cancelling the other calls.
+
+    Args:
+        models: The litellm model names, the preferred one first.
+        messages: The messages sent to the models.
+        temperature: The sampling temperature.
+        max_tokens: The maximum number of tokens in the answer.
+        session_id: The id of the browser session asking.
+        conversation_id: The id of the conversation the messages belong to.
+
+    Yields:
+        tuple[str, str | QueuePosition]: The model answering, with the queue positions of the
+            preferred model while waiting, then the text deltas of the answer.
+
+    Raises:
+        Exception: The error that interrupted the answer, or the last error if every model
+            failed.
+    """
+
+    streams = {
+        model: stream_completion(model, messages, temperature, max_tokens, session_id, conversation_id)
+        for model in models
+    }
+    winner = None
+    async with contextlib.aclosing(
+            first_responder(streams, started=lambda item: isinstance(item, str))) as stream:
+        async for model, delta in stream:
+            if winner is None and isinstance(delta, str):
+                winner = model
+                if len(models) > 1:
+                    metrics.HEDGE_WINS.inc(model=model)
+                    logger.debug('Hedged question answered first by %s', model)
+            yield model, delta
+
+
+async def stream_compared(
+        models: list[str],
+        messages: list[dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        session_id: str = '',
+        conversation_id: str = '',
+) -> AsyncIterator[tuple[str, str | QueuePosition | Finished]]:
+    """
+    Send the same messages to several models at once and stream all their answers.
+
+    See `stream_hedged` for the arguments.
+
+    Yields:
+        tuple[str, str | QueuePosition | Finished]: The model and its queue positions and text
+            deltas, interleaved as they arrive, then its `Finished` item with the error that
+            interrupted its answer, if any.
+    """
+
+    group = StreamGroup({
+        model: stream_completion(model, messages, temperature, max_tokens, session_id, conversation_id)
+        for model in models
+    })
+    try:
+        async for model, item in group:
+            yield model, item
+    finally:
+        await group.aclose()
+
+
+async def _stream_provider(
+        model: str,
+        messages: list[dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        session_id: str,
+        conversation_id: str,
+        attempts: list[Attempt],
+) -> AsyncIterator[str | QueuePosition]:
+    """
+    Stream the answer of the provider, with retries and fallback models, and cache it.
+
+    See `stream_completion` for the arguments.
+    """
+
+    cache = await ensure_response_cache()
+    policy = get_retry_policy()
+    buffer = StreamBuffer()
+    error = None
+    for candidate in policy.models(model):
+        for retry in range(policy.max_retries + 1):
+            attempt = Attempt(candidate, retry)
+            attempts.append(attempt)
+
+            try:
+                async for delta in _stream_model(
+                        candidate,
+                        messages,
+                        temperature,
+                        max_tokens,
+                        session_id,
+                        conversation_id,
+                        policy,
+                        attempt,
+                ):
+                    if isinstance(delta, str):
+                        buffer.append(delta)
+                    yield delta
+            except Exception as e:
+                attempt.finish(e)
+                metrics.ATTEMPTS.inc(model=candidate, outcome='error')
+                error = e
+                logger.warning('Attempt %d with %s failed: %r', retry, candidate, e)
+                # Part of the answer was streamed already: it cannot be restarted
+                if len(buffer):
+                    raise
+                if not is_retryable(e) or retry == policy.max_retries:
+                    break
+                await asyncio.sleep(policy.delay(retry))
+                continue
+
+            attempt.finish()
+            metrics.ATTEMPTS.inc(model=candidate, outcome='ok')
+            logger.debug('Answered by %s: %s', candidate, attempts)
+            # Only answers of the requested model are cached for it
+            if cache is not None and candidate == model and len(buffer):
+                await cache.astore(model, messages, temperature, max_tokens, buffer.getvalue())
+            return
+
+    raise error
+
+
+async def _stream_model(
+        model: str,
+        messages: list[dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+        session_id: str,
+        conversation_id: str,
+        policy: RetryPolicy,
+        attempt: Attempt,
+) -> AsyncIterator[str | QueuePosition]:
+    """
+    Stream the answer of a single provider call, enforcing the timeouts of the policy.
+
+    See `stream_completion` for the arguments; the time to the first token and the time
+    spent in the queue are recorded in `attempt`.
+    """
+
+    await ensure_litellm()
+    scheduler = get_scheduler()
+    ticket = scheduler.enqueue(model, session_id, estimate_tokens(model, messages, max_tokens))
+    response = None
+    finished = False
+    try:
+        async for position in scheduler.wait_turn(ticket):
+            yield position
+
+        attempt.queued = time.monotonic() - attempt.started
+        metrics.QUEUE_SECONDS.observe(attempt.queued, model=model)
+        response = await asyncio.wait_for(
+            load_litellm().acompletion(
+                model=model,
+                messages=messages,
+                response_format=None,
+                temperature=temperature,
+                max_tokens=max_tokens,
+                stream=True,
+                client=completion_client(model),
+                metadata={
+                    'session_id': session_id,  # Set langfuse Session ID
+                    'conversation_id': conversation_id,
+                },
+            ),
+            policy.connect_timeout,
+        )
+        chunks = aiter(response)
+        while True:
+            timeout = policy.first_token_timeout if attempt.first_token is None else policy.chunk_timeout
+            try:
+                chunk: 'ModelResponseStream' = await asyncio.wait_for(anext(chunks), timeout)
+            except StopAsyncIteration:
+                break
+
+            if 'choices' in chunk and chunk['choices'][0]['delta']:
+                delta_content = chunk['choices'][0]['delta'].content
+                if delta_content:
+                    if attempt.first_token is None:
+                        attempt.first_token = time.monotonic() - attempt.started
+                        get_latency_tracker().observe(model, attempt.first_token)
+                    yield str(delta_content)
+
+        finished = True
+    finally:
+        if response is not None and not finished:
+            await close_stream(response)
+        scheduler.release(ticket)
+
+
+async def precompute(
+        model: str,
+        messages: list[dict[str, str]],
+        temperature: float,
+        max_tokens: int,
+):
+    """
+    Ask the provider for an answer and keep it to be served instantly afterwards.
+
+    Precomputed answers do not expire; calling this again refreshes the answer.
+
+    Args:
+        model: The litellm model name.
+        messages: The messages sent to the model.
+        temperature: The sampling temperature.
+        max_tokens: The maximum number of tokens in the answer.
+    """
+
+    buffer = StreamBuffer()
+    async for delta in stream_completion(model, messages, temperature, max_tokens, refresh=True):
+        if isinstance(delta, str):
+            buffer.append(delta)
+
+    if len(buffer):
+        _precomputed[make_cache_key(model, messages, temperature, max_tokens)] = buffer.getvalue()
@@ -0,0 +1,69 @@
+"""
+The messages of the chat history.
+
+The history is sent to the client whenever it changes, and pickled with the session state by
+the disk and Redis state managers on every update. The messages are therefore plain
+dictionaries, which both encoders handle in C, typed with a `TypedDict`; a record class would
+go through a Python callback per message in each of them. They only hold what the client
+renders and the store id used to page the conversation: the bubbles are keyed by their
+position in the conversation, and the token counts are looked up when a context is built.
+"""
+import enum
+from typing import TypedDict
+
+
+class MessageRole(str, enum.Enum):
+    """
+    Define the roles of who generated the messages, as named by the chat completion APIs.
+
+    The roles are strings, so that they are encoded as their name to the client.
+    """
+
+    USER = 'user'
+    ASSISTANT = 'assistant'
+    SYSTEM = 'system'
+
+
+class Message(TypedDict, total=False):
+    """
+    A finalized message of the chat history.
+    """
+
+    role: MessageRole
+    content: str
+    # The store id of the message, 0 if it was not persisted
+    id: int
+    # The model that answered, when shown with the message
+    model: str
+    # Set on the answers compared side by side: `primary` or `alternative`
+    compare: str
+
+
+def new_message(role: str, content: str, **fields) -> Message:
+    """
+    Create a message.
+
+    Args:
+        role: Who wrote the message, a `MessageRole` or its name.
+        content: The text of the message.
+        **fields: The other fields of the message.
+
+    Returns:
+        Message: The message.
+    """
+
+    return Message(role=MessageRole(role), content=content, **fields)
+
+
+def to_prompt(message: Message) -> dict[str, str]:
+    """
+    Get a message as sent to the model.
+
+    Args:
+        message: The message.
+
+    Returns:
+        dict[str, str]: The role and content of the message.
+    """
+
+    return {'role': MessageRole(message['role']).value, 'content': message['content']}
@@ -0,0 +1,379 @@
+"""
+Latency and throughput metrics of the chat pipeline, in the Prometheus text format.
+
+The metrics are kept in process memory and served by the `/metrics` route of the backend
+(see `metrics_app`). They are labeled by model; per-session figures of the latest answer are
+shown by the optional debug panel instead, since session labels would grow without bound.
+
+With several backend workers, a request to the route is answered by any one of them, with its
+own figures only. Each worker then also serves its metrics on a port of its own, from
+`CHAT_METRICS_PORT`, so that a scraper collects every worker as a separate target (see
+`serve_worker_metrics`).
+"""
+import abc
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable
+
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+
+logger = logging.getLogger(__name__)
+
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Upper bounds of the state update histogram buckets, in seconds
+UPDATE_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+# Upper bounds of the throughput histogram buckets, in tokens per second
+THROUGHPUT_BUCKETS = (5, 10, 25, 50, 100, 200, 400, 800)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Metric(abc.ABC):
+    """
+    Base class of the metrics: a name, a help text and label names.
+
+    Subclasses implement `samples`.
+    """
+
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    @abc.abstractmethod
+    def samples(self) -> Iterable[str]:
+        """
+        Render the current values of the metric, one sample line per value.
+        """
+
+    def render(self) -> str:
+        """
+        Render the metric in the Prometheus text format.
+
+        Returns:
+            str: The HELP and TYPE lines followed by the samples.
+        """
+
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    A value that only increases.
+    """
+
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        """
+        Increase the counter.
+
+        Args:
+            amount: The increment.
+            **labels: The label values.
+        """
+
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = dict(self._values)
+        for key, value in values.items():
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Gauge(Metric):
+    """
+    A value read from a callback when the metrics are collected.
+    """
+
+    type = 'gauge'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labels: tuple[str, ...] = (),
+            collect: Callable[[], dict[tuple[str, ...], float]] | None = None,
+    ):
+        """
+        Args:
+            name: The metric name.
+            documentation: The help text.
+            labels: The label names.
+            collect: Returns the current value of each combination of label values.
+        """
+
+        super().__init__(name, documentation, labels)
+        self.collect = collect or dict
+
+    def samples(self) -> Iterable[str]:
+        for key, value in self.collect().items():
+            yield f'{self.name}{_format_labels(self.labels, key)} {value}'
+
+
+class Histogram(Metric):
+    """
+    The distribution of observed values in cumulative buckets.
+    """
+
+    type = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labels: tuple[str, ...] = (),
+            buckets: tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = buckets
+        # Label values -> (bucket counts, sum, count)
+        self._values: dict[tuple[str, ...], tuple[list[int], float, int]] = {}
+
+    def observe(self, value: float, **labels: str):
+        """
+        Record an observation.
+
+        Args:
+            value: The observed value.
+            **labels: The label values.
+        """
+
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> Iterable[str]:
+        with self._lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self._values.items()}
+        for key, (counts, total, count) in values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = f'le="{bound}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, key, le)} {bucket_count}'
+            le = 'le="+Inf"'
+            yield f'{self.name}_bucket{_format_labels(self.labels, key, le)} {count}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {total}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {count}'
+
+
+# Every metric created, in creation order
+REGISTRY: list[Metric] = []
+
+
+def render_metrics() -> str:
+    """
+    Render all the metrics in the Prometheus text format.
+
+    Returns:
+        str: The exposition text.
+    """
+
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+async def metrics_endpoint(request: Request) -> PlainTextResponse:
+    """
+    Serve the metrics to a Prometheus scraper.
+    """
+
+    return PlainTextResponse(render_metrics(), media_type='text/plain; version=0.0.4')
+
+
+# Mounted in front of the Reflex backend to add the /metrics route
+metrics_app = Starlette(routes=[Route('/metrics', metrics_endpoint)])
+
+
+@functools.cache
+def worker_metrics_port() -> int:
+    """
+    Get the first port of the per-worker metrics servers, from the `CHAT_METRICS_PORT`
+    environment variable.
+
+    Returns:
+        int: The port, 0 if the workers only serve their metrics on the `/metrics` route.
+    """
+
+    return int(os.getenv('CHAT_METRICS_PORT', 0))
+
+
+async def _serve_metrics_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        method, path, _ = request.split(b'\r\n', 1)[0].decode('latin-1').split(' ', 2)
+        if method == 'GET' and path.split('?', 1)[0] == '/metrics':
+            status, body = '200 OK', render_metrics().encode()
+        else:
+            status, body = '404 Not Found', b'Not Found\n'
+        writer.write(
+            f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body
+        )
+        await writer.drain()
+    except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError,
+            asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_worker_metrics():
+    """
+    Serve the metrics of this worker on the first free port from `CHAT_METRICS_PORT`, until
+    the backend shuts down.
+
+    The workers of the backend share its port, so that a scrape of `/metrics` reaches one of
+    them at random. Here each worker takes a port of its own, in the order they start: with
+    `n` workers, scraping the ports `CHAT_METRICS_PORT` to `CHAT_METRICS_PORT + n - 1`
+    collects all of them.
+
+    Raises:
+        OSError: If none of the ports is free.
+    """
+
+    first = worker_metrics_port()
+    workers = int(os.getenv('CHAT_WORKERS', 0)) or (2 * (os.cpu_count() or 1) + 1)
+    for port in range(first, first + workers):
+        try:
+            server = await asyncio.start_server(_serve_metrics_request, '0.0.0.0', port)
+        except OSError:
+            continue
+
+        logger.info('Serving the metrics of worker %d on port %d', os.getpid(), port)
+        async with server:
+            await server.serve_forever()
+
+    raise OSError(f'No free port for the worker metrics from {first} to {first + workers - 1}')
+
+
+QUEUE_SECONDS = Histogram(
+    'chat_queue_seconds', 'Time a provider call waited for a scheduler slot.', ('model',))
+TIME_TO_FIRST_TOKEN = Histogram(
+    'chat_time_to_first_token_seconds', 'Time from a question to the first answer token.', ('model',))
+GENERATION_SECONDS = Histogram(
+    'chat_generation_seconds', 'Time from a question to the end of the answer.', ('model',))
+TOKENS_PER_SECOND = Histogram(
+    'chat_tokens_per_second', 'Streaming rate of an answer after its first token.', ('model',),
+    buckets=THROUGHPUT_BUCKETS)
+STATE_UPDATE_SECONDS = Histogram(
+    'chat_state_update_seconds', 'Time to apply, serialize and send a streamed state update.', ('model',),
+    buckets=UPDATE_BUCKETS)
+ANSWERS = Counter('chat_answers_total', 'Answers by outcome.', ('model', 'outcome'))
+TOKENS = Counter('chat_tokens_total', 'Streamed answer chunks.', ('model',))
+STATE_UPDATES = Counter('chat_state_updates_total', 'Streamed state updates sent to clients.', ('model',))
+PUSHED_BYTES = Counter('chat_pushed_bytes_total', 'Bytes of streamed text sent to clients.', ('model',))
+ATTEMPTS = Counter('chat_provider_attempts_total', 'Provider calls by outcome.', ('model', 'outcome'))
+COALESCED = Counter(
+    'chat_coalesced_requests_total', 'Requests served by the provider stream of an identical one.', ('model',))
+PROMPT_TOKENS = Counter('chat_prompt_tokens_total', 'Prompt tokens sent with the questions.', ('model',))
+SUMMARY_SAVED_TOKENS = Counter(
+    'chat_summary_saved_tokens_total', 'Prompt tokens saved by the running summaries.', ('model',))
+SUMMARIES = Counter('chat_summaries_total', 'Running summary updates by outcome.', ('model', 'outcome'))
+HEDGE_WINS = Counter(
+    'chat_hedged_answers_total', 'Hedged questions by the model that answered first.', ('model',))
+
+
+class AnswerTimer:
+    """
+    Measure the latency and throughput of one answer and record them in the metrics.
+    """
+
+    def __init__(self, model: str):
+        """
+        Args:
+            model: The model asked, used as the metrics label.
+        """
+
+        self.model = model
+        self.started = time.monotonic()
+        self.first_token: float | None = None
+        self.tokens = 0
+        self.updates = 0
+        self.pushed_bytes = 0
+
+    def token(self):
+        """
+        Record a streamed chunk of the answer.
+        """
+
+        if self.first_token is None:
+            self.first_token = time.monotonic() - self.started
+            TIME_TO_FIRST_TOKEN.observe(self.first_token, model=self.model)
+        self.tokens += 1
+        TOKENS.inc(model=self.model)
+
+    def update(self, seconds: float, pushed_bytes: int):
+        """
+        Record a state update sent to the client while streaming.
+
+        Args:
+            seconds: Time spent applying, serializing and sending the update.
+            pushed_bytes: Size of the streamed text sent.
+        """
+
+        self.updates += 1
+        self.pushed_bytes += pushed_bytes
+        STATE_UPDATES.inc(model=self.model)
+        STATE_UPDATE_SECONDS.observe(seconds, model=self.model)
+        PUSHED_BYTES.inc(pushed_bytes, model=self.model)
+
+    def finish(self, outcome: str) -> str:
+        """
+        Record the end of the answer.
+
+        Args:
+            outcome: How the answer ended, e.g. `ok`, `error` or `cancelled`.
+
+        Returns:
+            str: A one-line summary of the answer's figures.
+        """
+
+        total = time.monotonic() - self.started
+        GENERATION_SECONDS.observe(total, model=self.model)
+        ANSWERS.inc(model=self.model, outcome=outcome)
+
+        summary = f'{self.model} · {outcome} · {total:.2f} s total'
+        if self.first_token is not None:
+            summary += f' · {self.first_token:.2f} s to first token'
+            streaming = total - self.first_token
+            if self.tokens > 1 and streaming > 0:
+                rate = (self.tokens - 1) / streaming
+                TOKENS_PER_SECOND.observe(rate, model=self.model)
+                summary += f' · {rate:.1f} tokens/s'
+
+        return f'{summary} · {self.updates} updates · {self.pushed_bytes / 1024:.1f} kB pushed'
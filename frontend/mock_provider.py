@@ -0,0 +1,130 @@
+"""
+A fake streaming LLM provider for offline load tests and benchmarks.
+
+The provider plugs into litellm's custom provider hook and answers any `mock/<name>` model
+with generated text, streamed with a configurable time to first token, inter-token delay,
+jitter and length. It makes no network calls, so the app can be measured without a provider
+account. It is registered when `CHAT_MOCK_PROVIDER` is set.
+"""
+import asyncio
+import os
+import random
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+import litellm
+from litellm import CustomLLM
+from litellm.types.utils import GenericStreamingChunk
+
+
+# The litellm provider name: models are named `mock/<anything>`
+PROVIDER = 'mock'
+# Words of the generated answers
+WORDS = (
+    'the model streams a synthetic answer so that the chat pipeline can be measured without '
+    'calling a real provider while keeping latency and length under control'
+).split()
+
+
+@dataclass
+class MockSettings:
+    """
+    Latency and length of the generated answers.
+    """
+
+    # Delay before the first token, in milliseconds
+    first_token_ms: float = 300.0
+    # Delay between two tokens, in milliseconds
+    token_ms: float = 20.0
+    # Delay added before the first token per 1000 prompt tokens, as providers take longer to
+    # process longer prompts, in milliseconds
+    prefill_ms: float = 0.0
+    # Relative random variation of each delay, e.g. 0.3 for +/-30%
+    jitter: float = 0.3
+    # Tokens per answer
+    tokens: int = 200
+
+    @classmethod
+    def from_env(cls) -> 'MockSettings':
+        """
+        Build the settings from the `CHAT_MOCK_*` environment variables.
+
+        Returns:
+            MockSettings: The configured settings.
+        """
+
+        return cls(
+            first_token_ms=float(os.getenv('CHAT_MOCK_FIRST_TOKEN_MS', cls.first_token_ms)),
+            token_ms=float(os.getenv('CHAT_MOCK_TOKEN_MS', cls.token_ms)),
+            prefill_ms=float(os.getenv('CHAT_MOCK_PREFILL_MS', cls.prefill_ms)),
+            jitter=float(os.getenv('CHAT_MOCK_JITTER', cls.jitter)),
+            tokens=int(os.getenv('CHAT_MOCK_TOKENS', cls.tokens)),
+        )
+
+
+class MockLLM(CustomLLM):
+    """
+    litellm custom provider streaming generated answers.
+    """
+
+    def __init__(self, settings: MockSettings | None = None):
+        super().__init__()
+        self.settings = settings or MockSettings.from_env()
+
+    def _delay(self, rng: random.Random, milliseconds: float) -> float:
+        jitter = self.settings.jitter
+        return max(0.0, milliseconds * rng.uniform(1 - jitter, 1 + jitter)) / 1000
+
+    async def astreaming(self, *args, **kwargs) -> AsyncIterator[GenericStreamingChunk]:
+        """
+        Stream a generated answer; the same question always gets the same text.
+        """
+
+        messages = kwargs.get('messages') or []
+        rng = random.Random(str(messages[-1]['content']) if messages else '')
+        settings = self.settings
+
+        # About 4 characters per token
+        prompt_tokens = sum(len(str(m.get('content') or '')) for m in messages) / 4
+        await asyncio.sleep(
+            self._delay(rng, settings.first_token_ms + settings.prefill_ms * prompt_tokens / 1000))
+        for i in range(settings.tokens):
+            if i:
+                await asyncio.sleep(self._delay(rng, settings.token_ms))
+
+            text = ('' if i == 0 else ' ') + rng.choice(WORDS)
+            if i % 15 == 14:
+                text += '.'
+            last = i == settings.tokens - 1
+            yield GenericStreamingChunk(
+                text=text,
+                tool_use=None,
+                is_finished=last,
+                finish_reason='stop' if last else '',
+                usage=None,
+                index=0,
+            )
+
+
+def register_mock_provider(settings: MockSettings | None = None):
+    """
+    Make the `mock/<name>` models available to litellm.
+
+    Args:
+        settings: Latency and length of the answers; read from the environment if omitted.
+    """
+
+    litellm.custom_provider_map = [
+        provider for provider in litellm.custom_provider_map if provider['provider'] != PROVIDER
+    ] + [{'provider': PROVIDER, 'custom_handler': MockLLM(settings)}]
+
+
+def mock_provider_enabled() -> bool:
+    """
+    Tell whether the mock provider is enabled by the `CHAT_MOCK_PROVIDER` variable.
+
+    Returns:
+        bool: True if the mock provider should be registered.
+    """
+
+    return os.getenv('CHAT_MOCK_PROVIDER', 'false').lower() in ('1', 'true', 'yes')
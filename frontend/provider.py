@@ -0,0 +1,111 @@
+"""
+Deferred loading of litellm.
+
+Importing litellm takes seconds: it loads the model cost map, downloading the latest one by
+default, and the SDKs of many providers. The app only imports it when the first completion
+needs it, or in the background once the backend has started (see `preload_litellm`), so that
+neither the workers nor `reflex` compiles pay this cost at startup.
+"""
+import asyncio
+import functools
+import logging
+import os
+import threading
+import time
+
+from frontend.http_pool import get_http_client
+
+
+logger = logging.getLogger(__name__)
+# Lets a single thread import litellm, when the preload and the first questions race for it
+_load_lock = threading.Lock()
+
+
+def offline_mode() -> bool:
+    """
+    Tell whether the `CHAT_OFFLINE` environment variable forbids network access at startup.
+
+    Returns:
+        bool: True if litellm should use its bundled model cost map.
+    """
+
+    return os.getenv('CHAT_OFFLINE', 'false').lower() in ('1', 'true', 'yes')
+
+
+def preload_enabled() -> bool:
+    """
+    Tell whether litellm is loaded in the background at startup, as set by the
+    `CHAT_PRELOAD_LITELLM` environment variable.
+
+    Returns:
+        bool: True if litellm should be loaded before the first question.
+    """
+
+    return os.getenv('CHAT_PRELOAD_LITELLM', 'true').lower() in ('1', 'true', 'yes')
+
+
+def load_litellm():
+    """
+    Import litellm and set up the providers, on first use.
+
+    A single thread imports it, however many call this at once. From the event loop, await
+    `ensure_litellm` first, since the import takes seconds.
+
+    Returns:
+        module: The litellm module.
+    """
+
+    with _load_lock:
+        return _import_litellm()
+
+
+@functools.cache
+def _import_litellm():
+    started = time.perf_counter()
+    if offline_mode():
+        # Read by litellm at import: use the bundled cost map instead of downloading it
+        os.environ['LITELLM_LOCAL_MODEL_COST_MAP'] = 'True'
+
+    import litellm
+
+    # Used by the providers called through the OpenAI SDK (see `http_pool.completion_client`)
+    litellm.aclient_session = get_http_client()
+
+    from frontend.mock_provider import mock_provider_enabled, register_mock_provider
+    if mock_provider_enabled():
+        register_mock_provider()
+
+    logger.info('Loaded litellm in %.2f s', time.perf_counter() - started)
+    return litellm
+
+
+def litellm_loaded() -> bool:
+    """
+    Tell whether litellm is loaded already.
+
+    Returns:
+        bool: True if `load_litellm` returns at once.
+    """
+
+    return _import_litellm.cache_info().currsize > 0
+
+
+async def ensure_litellm():
+    """
+    Load litellm in a thread unless it is loaded already.
+
+    Awaited before the event loop counts tokens or calls a provider, so that a question asked
+    before the preload finishes waits for it without blocking the other sessions.
+    """
+
+    if not litellm_loaded():
+        await asyncio.to_thread(load_litellm)
+
+
+async def preload_litellm():
+    """
+    Load litellm in a thread once the backend has started, so that the first question does
+    not wait for it.
+    """
+
+    await ensure_litellm()
@@ -0,0 +1,150 @@
+"""
+Timeouts, retries and model fallback of the provider calls.
+
+A stalled provider stream would otherwise pin the chat coroutine indefinitely, and a
+transient provider error would end the answer. Calls are retried with jittered exponential
+backoff while no token has been streamed yet, then the next model of the fallback list is
+tried. Every attempt is recorded, so that the latency of an answer can be broken down.
+"""
+import asyncio
+import functools
+import os
+import random
+import time
+from dataclasses import dataclass, field
+
+from frontend.provider import load_litellm
+
+
+@functools.cache
+def retryable_errors() -> tuple[type[BaseException], ...]:
+    """
+    Get the provider errors worth retrying: transient failures and rate limits.
+
+    Returns:
+        tuple[type[BaseException], ...]: The error types.
+    """
+
+    exceptions = load_litellm().exceptions
+    return (
+        asyncio.TimeoutError,
+        exceptions.APIConnectionError,
+        exceptions.InternalServerError,
+        exceptions.RateLimitError,
+        exceptions.ServiceUnavailableError,
+        exceptions.Timeout,
+    )
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Timeouts, retries and fallback models of the provider calls.
+    """
+
+    # Seconds to wait for the provider to accept the request
+    connect_timeout: float = 10.0
+    # Seconds to wait for the first token once the request is accepted
+    first_token_timeout: float = 30.0
+    # Seconds to wait for each following chunk
+    chunk_timeout: float = 30.0
+    # Retries per model before falling back to the next one
+    max_retries: int = 2
+    # Backoff before the first retry, doubled for each following one, in seconds
+    backoff: float = 0.5
+    # Upper bound of the backoff, in seconds
+    max_backoff: float = 8.0
+    # Models tried in order when the requested one keeps failing
+    fallback_models: list[str] = field(default_factory=list)
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        """
+        Build a policy from the `CHAT_*_TIMEOUT`, `CHAT_MAX_RETRIES`, `CHAT_RETRY_BACKOFF`
+        and `CHAT_FALLBACK_MODELS` environment variables.
+
+        Returns:
+            RetryPolicy: The configured policy.
+        """
+
+        return cls(
+            connect_timeout=float(os.getenv('CHAT_CONNECT_TIMEOUT', cls.connect_timeout)),
+            first_token_timeout=float(os.getenv('CHAT_FIRST_TOKEN_TIMEOUT', cls.first_token_timeout)),
+            chunk_timeout=float(os.getenv('CHAT_CHUNK_TIMEOUT', cls.chunk_timeout)),
+            max_retries=int(os.getenv('CHAT_MAX_RETRIES', cls.max_retries)),
+            backoff=float(os.getenv('CHAT_RETRY_BACKOFF', cls.backoff)),
+            fallback_models=[
+                m.strip() for m in os.getenv('CHAT_FALLBACK_MODELS', '').split(',') if m.strip()
+            ],
+        )
+
+    def models(self, model: str) -> list[str]:
+        """
+        Get the models to try for a request, in order.
+
+        Args:
+            model: The requested model.
+
+        Returns:
+            list[str]: The requested model followed by the other fallback models.
+        """
+
+        return [model] + [m for m in self.fallback_models if m != model]
+
+    def delay(self, retry: int) -> float:
+        """
+        Get the jittered backoff before a retry.
+
+        Args:
+            retry: The number of the retry, starting at 0.
+
+        Returns:
+            float: A random delay up to the exponential backoff, in seconds.
+        """
+
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** retry))
+
+
+def is_retryable(error: BaseException) -> bool:
+    """
+    Tell whether a failed provider call may succeed if retried.
+
+    Args:
+        error: The error raised by the call.
+
+    Returns:
+        bool: True for transient errors and rate limits.
+    """
+
+    return isinstance(error, retryable_errors())
+
+
+@dataclass
+class Attempt:
+    """
+    The record of one provider call.
+    """
+
+    model: str
+    # Retry number for this model, starting at 0
+    retry: int
+    started: float = field(default_factory=time.monotonic)
+    # Seconds spent waiting for a slot of the scheduler
+    queued: float = 0.0
+    # Seconds from the start to the first token, if one arrived
+    first_token: float | None = None
+    # Seconds from the start to the end of the call
+    duration: float | None = None
+    error: str | None = None
+
+    def finish(self, error: BaseException | None = None):
+        """
+        Record the end of the call.
+
+        Args:
+            error: The error that ended the call, if any.
+        """
+
+        self.duration = time.monotonic() - self.started
+        if error is not None:
+            self.error = repr(error)
@@ -0,0 +1,314 @@
+"""
+Process-wide scheduler for the LLM completion calls.
+
+Unbounded concurrent calls make the provider answer with rate limit errors, and then every
+user's latency collapses together. The scheduler caps the number of concurrent calls and the
+tokens per minute of each model, and queues the excess in a bounded queue. Slots are handed
+out round-robin over the waiting sessions, so one session cannot monopolize a model.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import AsyncIterator, NamedTuple
+
+from frontend.context import parse_model_map
+
+
+# Default number of concurrent calls per model
+DEFAULT_MAX_CONCURRENCY = 16
+# Default number of concurrent calls per session and model
+DEFAULT_MAX_PER_SESSION = 2
+# Default number of calls waiting for a slot, per model
+DEFAULT_MAX_QUEUE = 256
+# Seconds between two queue position updates of a waiting call
+POSITION_POLL_INTERVAL = 0.5
+
+
+class QueueFullError(Exception):
+    """
+    Raised when a call cannot be queued because the queue is full.
+    """
+
+    def __init__(self, model: str):
+        super().__init__(f'Too many requests to {model} right now, please try again shortly.')
+        self.model = model
+
+
+class QueuePosition(NamedTuple):
+    """
+    The position of a waiting call in the queue, reported while it waits.
+    """
+
+    position: int
+
+
+@dataclass(eq=False)
+class Ticket:
+    """
+    A call waiting for, or holding, a slot.
+    """
+
+    model: str
+    session_id: str
+    # Estimated prompt and answer tokens, counted against the tokens per minute budget
+    tokens: int
+    enqueued: float = field(default_factory=time.monotonic)
+    started: float | None = None
+    granted: asyncio.Event = field(default_factory=asyncio.Event)
+
+
+@dataclass
+class ModelQueue:
+    """
+    Slots, queue and token budget of one model.
+    """
+
+    max_concurrency: int
+    tokens_per_minute: int
+    active: int = 0
+    active_by_session: dict[str, int] = field(default_factory=dict)
+    # Waiting tickets per session; the order of the sessions is the round-robin order
+    waiting: OrderedDict[str, deque[Ticket]] = field(default_factory=OrderedDict)
+    queued: int = 0
+    # (time, tokens) of the calls started in the last minute
+    recent: deque[tuple[float, int]] = field(default_factory=deque)
+    # Statistics of the time spent waiting for a slot
+    wait_count: int = 0
+    wait_seconds: float = 0.0
+    retry_handle: asyncio.TimerHandle | None = None
+
+
+class LLMScheduler:
+    """
+    Bound the concurrency and the token rate of the calls to each model.
+    """
+
+    def __init__(
+            self,
+            max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+            max_per_session: int = DEFAULT_MAX_PER_SESSION,
+            tokens_per_minute: int = 0,
+            max_queue: int = DEFAULT_MAX_QUEUE,
+            model_concurrency: dict[str, int] | None = None,
+            model_tokens_per_minute: dict[str, int] | None = None,
+    ):
+        """
+        Args:
+            max_concurrency: Concurrent calls per model.
+            max_per_session: Concurrent calls per session and model.
+            tokens_per_minute: Token budget per model and minute; 0 means unlimited.
+            max_queue: Calls waiting per model before new ones are rejected.
+            model_concurrency: Concurrent calls of specific models.
+            model_tokens_per_minute: Token budgets of specific models.
+        """
+
+        self.max_concurrency = max_concurrency
+        self.max_per_session = max_per_session
+        self.tokens_per_minute = tokens_per_minute
+        self.max_queue = max_queue
+        self.model_concurrency = model_concurrency or {}
+        self.model_tokens_per_minute = model_tokens_per_minute or {}
+        self._models: dict[str, ModelQueue] = {}
+
+    @classmethod
+    def from_env(cls) -> 'LLMScheduler':
+        """
+        Build a scheduler from the `CHAT_MAX_*`, `CHAT_TOKENS_PER_MINUTE` and `CHAT_MODEL_*`
+        environment variables.
+
+        Returns:
+            LLMScheduler: The configured scheduler.
+        """
+
+        return cls(
+            max_concurrency=int(os.getenv('CHAT_MAX_CONCURRENCY', DEFAULT_MAX_CONCURRENCY)),
+            max_per_session=int(os.getenv('CHAT_MAX_PER_SESSION', DEFAULT_MAX_PER_SESSION)),
+            tokens_per_minute=int(os.getenv('CHAT_TOKENS_PER_MINUTE', 0)),
+            max_queue=int(os.getenv('CHAT_MAX_QUEUE', DEFAULT_MAX_QUEUE)),
+            model_concurrency=parse_model_map(os.getenv('CHAT_MODEL_CONCURRENCY', '')),
+            model_tokens_per_minute=parse_model_map(os.getenv('CHAT_MODEL_TOKENS_PER_MINUTE', '')),
+        )
+
+    def _queue(self, model: str) -> ModelQueue:
+        if model not in self._models:
+            self._models[model] = ModelQueue(
+                max_concurrency=self.model_concurrency.get(model, self.max_concurrency),
+                tokens_per_minute=self.model_tokens_per_minute.get(model, self.tokens_per_minute),
+            )
+
+        return self._models[model]
+
+    def enqueue(self, model: str, session_id: str, tokens: int) -> Ticket:
+        """
+        Ask for a slot to call a model.
+
+        The slot may be granted immediately; otherwise wait for it with `wait_turn`. Every
+        ticket must eventually be passed to `release`.
+
+        Args:
+            model: The litellm model name.
+            session_id: The session making the call.
+            tokens: The estimated prompt and answer tokens of the call.
+
+        Returns:
+            Ticket: The ticket of the call.
+
+        Raises:
+            QueueFullError: If the queue of the model is full.
+        """
+
+        queue = self._queue(model)
+        if queue.queued >= self.max_queue:
+            raise QueueFullError(model)
+
+        ticket = Ticket(model=model, session_id=session_id, tokens=tokens)
+        queue.waiting.setdefault(session_id, deque()).append(ticket)
+        queue.queued += 1
+        self._dispatch(queue)
+
+        return ticket
+
+    def position(self, ticket: Ticket) -> int:
+        """
+        Get the number of calls that will be granted a slot before a waiting ticket.
+
+        Args:
+            ticket: A waiting ticket.
+
+        Returns:
+            int: The number of calls ahead, or 0 if the ticket holds a slot.
+        """
+
+        queue = self._queue(ticket.model)
+        if ticket.granted.is_set() or ticket.session_id not in queue.waiting:
+            return 0
+
+        sessions = list(queue.waiting)
+        rank = sessions.index(ticket.session_id)
+        index = queue.waiting[ticket.session_id].index(ticket)
+        # Round-robin: each session ahead in the rotation gets one more turn
+        ahead = index
+        for i, session_id in enumerate(sessions):
+            if i != rank:
+                ahead += min(len(queue.waiting[session_id]), index + (i < rank))
+
+        return ahead
+
+    async def wait_turn(self, ticket: Ticket) -> AsyncIterator[QueuePosition]:
+        """
+        Wait until a ticket is granted a slot, reporting its queue position meanwhile.
+
+        Args:
+            ticket: The ticket returned by `enqueue`.
+
+        Yields:
+            QueuePosition: The position of the ticket whenever it changes.
+        """
+
+        last_position = None
+        while not ticket.granted.is_set():
+            position = self.position(ticket)
+            if position != last_position:
+                last_position = position
+                yield QueuePosition(position)
+
+            try:
+                await asyncio.wait_for(ticket.granted.wait(), POSITION_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, ticket: Ticket):
+        """
+        Give back the slot of a ticket, or withdraw it from the queue if still waiting.
+
+        Args:
+            ticket: The ticket returned by `enqueue`.
+        """
+
+        queue = self._queue(ticket.model)
+        if ticket.granted.is_set():
+            if ticket.started is None:
+                return
+            ticket.started = None
+            queue.active -= 1
+            queue.active_by_session[ticket.session_id] -= 1
+            if not queue.active_by_session[ticket.session_id]:
+                del queue.active_by_session[ticket.session_id]
+        else:
+            tickets = queue.waiting.get(ticket.session_id)
+            if tickets and ticket in tickets:
+                tickets.remove(ticket)
+                queue.queued -= 1
+                if not tickets:
+                    del queue.waiting[ticket.session_id]
+
+        self._dispatch(queue)
+
+    def _dispatch(self, queue: ModelQueue):
+        """
+        Grant slots to waiting tickets while the concurrency and token budgets allow it.
+        """
+
+        now = time.monotonic()
+        while queue.recent and now - queue.recent[0][0] >= 60:
+            queue.recent.popleft()
+
+        while queue.waiting and queue.active < queue.max_concurrency:
+            ticket = next(
+                (
+                    tickets[0] for session_id, tickets in queue.waiting.items()
+                    if queue.active_by_session.get(session_id, 0) < self.max_per_session
+                ),
+                None,
+            )
+
+            if ticket is None:
+                break
+
+            used = sum(tokens for _, tokens in queue.recent)
+            if queue.tokens_per_minute and queue.recent and used + ticket.tokens > queue.tokens_per_minute:
+                # Retry when the oldest call leaves the one-minute window
+                if queue.retry_handle is None or queue.retry_handle.cancelled():
+                    queue.retry_handle = asyncio.get_running_loop().call_later(
+                        60 - (now - queue.recent[0][0]), self._retry, queue
+                    )
+                break
+
+            # Serve the session, then move it to the back of the rotation
+            tickets = queue.waiting.pop(ticket.session_id)
+            tickets.popleft()
+            if tickets:
+                queue.waiting[ticket.session_id] = tickets
+            queue.queued -= 1
+            queue.active += 1
+            queue.active_by_session[ticket.session_id] = queue.active_by_session.get(ticket.session_id, 0) + 1
+            queue.recent.append((now, ticket.tokens))
+            queue.wait_count += 1
+            queue.wait_seconds += now - ticket.enqueued
+            ticket.started = now
+            ticket.granted.set()
+
+    def _retry(self, queue: ModelQueue):
+        queue.retry_handle = None
+        self._dispatch(queue)
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        """
+        Get the slot, queue and wait statistics of each model.
+
+        Returns:
+            dict[str, dict[str, float]]: Per model, the active calls, the queue depth, the
+                number of calls started and the total seconds they waited for a slot.
+        """
+
+        return {
+            model: {
+                'active': queue.active,
+                'queued': queue.queued,
+                'wait_count': queue.wait_count,
+                'wait_seconds': queue.wait_seconds,
+            }
+            for model, queue in self._models.items()
+        }
@@ -0,0 +1,303 @@
+"""
+Memory limits of the chat sessions held by the backend.
+
+Each session keeps at most a configured number of messages and bytes of history; older
+messages stay in the conversation store and are loaded back on scroll. Sessions left idle,
+and the least recently used ones once the resident history exceeds a high-water mark, are
+evicted: their loaded messages are released, through the public `rx.App.modify_state`, and
+loaded back from the conversation store when the session is shown again. The small remainder
+of the state is expired by the state manager itself.
+"""
+import asyncio
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import reflex as rx
+
+from frontend import metrics
+from frontend.messages import Message
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class SessionLimits:
+    """
+    Memory limits of the sessions.
+    """
+
+    # Messages of history kept per session (0 is unlimited)
+    max_messages: int = 200
+    # Bytes of history kept per session (0 is unlimited)
+    max_bytes: int = 2 ** 20
+    # Seconds of inactivity before a session is evicted (0 disables)
+    idle_timeout: float = 1800.0
+    # Bytes of history of all the sessions above which the least recently used are evicted
+    # (0 is unlimited)
+    memory_high_water: int = 256 * 2 ** 20
+    # Seconds between two eviction sweeps
+    sweep_interval: float = 60.0
+
+    @classmethod
+    def from_env(cls) -> 'SessionLimits':
+        """
+        Build the limits from the `CHAT_SESSION_*` environment variables.
+
+        Returns:
+            SessionLimits: The configured limits.
+        """
+
+        return cls(
+            max_messages=int(os.getenv('CHAT_SESSION_MAX_MESSAGES', cls.max_messages)),
+            max_bytes=int(os.getenv('CHAT_SESSION_MAX_BYTES', cls.max_bytes)),
+            idle_timeout=float(os.getenv('CHAT_SESSION_IDLE_TIMEOUT', cls.idle_timeout)),
+            memory_high_water=int(os.getenv('CHAT_SESSION_MEMORY_HIGH_WATER', cls.memory_high_water)),
+            sweep_interval=float(os.getenv('CHAT_SESSION_SWEEP_INTERVAL', cls.sweep_interval)),
+        )
+
+    def excess(self, history: list[Message]) -> int:
+        """
+        Count the oldest messages to drop for a history to fit the per-session limits.
+
+        The latest message is always kept.
+
+        Args:
+            history: The messages of the session, oldest first.
+
+        Returns:
+            int: The number of messages to drop from the start of the history.
+        """
+
+        drop = max(0, len(history) - self.max_messages) if self.max_messages else 0
+        if self.max_bytes:
+            size = history_bytes(history[drop:])
+            while size > self.max_bytes and drop < len(history) - 1:
+                size -= len(history[drop]['content'].encode())
+                drop += 1
+
+        return drop
+
+
+def history_bytes(history: list[Message]) -> int:
+    """
+    Measure the text of a history.
+
+    Args:
+        history: The messages.
+
+    Returns:
+        int: The number of bytes of the contents, encoded in UTF-8.
+    """
+
+    return sum(len(message['content'].encode()) for message in history)
+
+
+class SessionTracker:
+    """
+    Keep track of the activity and the history size of the sessions resident in the backend.
+    """
+
+    def __init__(self, limits: SessionLimits):
+        self.limits = limits
+        # Client token -> (last activity, bytes of history, whether an answer is generated),
+        # least recently active first
+        self._sessions: OrderedDict[str, tuple[float, int, bool]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def touch(self, token: str, size: int, busy: bool = False):
+        """
+        Record the activity of a session.
+
+        Args:
+            token: The client token of the session.
+            size: The bytes of history the session holds.
+            busy: Whether an answer is being generated, in which case the session is not
+                evicted.
+        """
+
+        with self._lock:
+            self._sessions[token] = (time.monotonic(), size, busy)
+            self._sessions.move_to_end(token)
+
+    def forget(self, token: str):
+        """
+        Stop tracking an evicted session.
+
+        Args:
+            token: The client token of the session.
+        """
+
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def is_busy(self, token: str) -> bool:
+        """
+        Tell whether a session is generating an answer.
+
+        Args:
+            token: The client token of the session.
+
+        Returns:
+            bool: True if the session is busy.
+        """
+
+        with self._lock:
+            return token in self._sessions and self._sessions[token][2]
+
+    def select_evictions(self) -> list[str]:
+        """
+        Select the sessions to evict: the idle ones, then the least recently active until the
+        resident history is below the high-water mark. The idle sessions without loaded
+        messages hold nothing to release, and are forgotten instead.
+
+        Returns:
+            list[str]: The client tokens of the sessions to evict.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            total = sum(size for _, size, _ in self._sessions.values())
+            selected = []
+            empty = []
+            for token, (last_active, size, busy) in self._sessions.items():
+                if busy:
+                    continue
+                idle = self.limits.idle_timeout and now - last_active > self.limits.idle_timeout
+                if not size:
+                    if idle:
+                        empty.append(token)
+                    continue
+                over = self.limits.memory_high_water and total > self.limits.memory_high_water
+                if not (idle or over):
+                    continue
+                selected.append(token)
+                total -= size
+            for token in empty:
+                del self._sessions[token]
+
+        return selected
+
+    def stats(self) -> tuple[int, int]:
+        """
+        Get the number of resident sessions and the bytes of history they hold.
+
+        Returns:
+            tuple[int, int]: The session count and the bytes of history.
+        """
+
+        with self._lock:
+            return len(self._sessions), sum(size for _, size, _ in self._sessions.values())
+
+
+# The limits of this process, and the sessions it holds
+LIMITS = SessionLimits.from_env()
+TRACKER = SessionTracker(LIMITS)
+
+metrics.Gauge(
+    'chat_resident_sessions', 'Sessions held in the memory of the backend.',
+    collect=lambda: {(): TRACKER.stats()[0]},
+)
+metrics.Gauge(
+    'chat_resident_history_bytes', 'Bytes of chat history held by the resident sessions.',
+    collect=lambda: {(): TRACKER.stats()[1]},
+)
+EVICTIONS = metrics.Counter(
+    'chat_session_evictions_total', 'Sessions selected for eviction, by outcome.', ('outcome',))
+
+
+def state_token(client_token: str, state_cls: type[rx.State]):
+    """
+    Get the token addressing the state of a session in `rx.App.modify_state`.
+
+    Args:
+        client_token: The client token of the session.
+        state_cls: The state class to modify.
+
+    Returns:
+        The token: a `rx.BaseStateToken`, or the legacy string of the Reflex versions before
+            it existed.
+    """
+
+    if hasattr(rx, 'BaseStateToken'):
+        return rx.BaseStateToken(ident=client_token, cls=state_cls)
+
+    return f'{client_token}_{state_cls.get_full_name()}'
+
+
+async def evict(rx_app: rx.App, state_cls: type[rx.State], token: str) -> bool:
+    """
+    Release the loaded messages of a session, unless it started generating an answer since it
+    was selected. A session found without loaded messages, e.g. recreated by Reflex after its
+    state expired, is forgotten.
+
+    Args:
+        rx_app: The Reflex app holding the sessions.
+        state_cls: The state class holding the history, with a `_release_history` method.
+        token: The client token of the session.
+
+    Returns:
+        bool: Whether the session was evicted.
+    """
+
+    # Waits for the events of the session being processed
+    async with rx_app.modify_state(state_token(token, state_cls)) as state:
+        if not isinstance(state, state_cls):
+            state = await state.get_state(state_cls)
+        if TRACKER.is_busy(token):
+            return False
+        if not state.chat_history:
+            TRACKER.forget(token)
+            return False
+        if not state._release_history():
+            return False
+
+    TRACKER.forget(token)
+    logger.debug('Evicted session %s', token)
+    return True
+
+
+async def evict_sessions(rx_app: rx.App, state_cls: type[rx.State]):
+    """
+    Periodically evict the idle sessions, and the least recently used ones above the memory
+    high-water mark.
+
+    With Redis, the states are not held by the workers, and the idle ones expire by themselves
+    (see `redis_token_expiration` in the Reflex config), so nothing is evicted.
+
+    Args:
+        rx_app: The Reflex app holding the sessions.
+        state_cls: The state class holding the history.
+
+    Raises:
+        RuntimeError: If every eviction of a sweep failed, which ends the task: the memory of
+            the sessions would otherwise grow without bound, unnoticed.
+    """
+
+    if rx.config.get_config().redis_url:
+        return
+
+    while True:
+        await asyncio.sleep(LIMITS.sweep_interval)
+
+        error = None
+        evicted = 0
+        selected = TRACKER.select_evictions()
+        for token in selected:
+            try:
+                if await evict(rx_app, state_cls, token):
+                    evicted += 1
+                    EVICTIONS.inc(outcome='evicted')
+                else:
+                    EVICTIONS.inc(outcome='skipped')
+            except Exception as e:
+                error = e
+                EVICTIONS.inc(outcome='failed')
+                logger.exception('Could not evict session %s', token)
+
+        if error is not None and not evicted:
+            raise RuntimeError(f'Could not evict any of {len(selected)} sessions') from error
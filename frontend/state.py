@@ -1,15 +1,35 @@
 """
 AI chat state with streaming response.
 """
+import asyncio
+import contextlib
+import logging
+import os
+import time
 import uuid
-from dataclasses import dataclass
 
-import litellm
 import reflex as rx
-from dotenv import load_dotenv
-from litellm.types.utils import ModelResponseStream
 
-load_dotenv()
+from frontend.context import ContextBuilder
+from frontend.fanout import Finished
+from frontend.history import DEFAULT_PAGE_SIZE, get_conversation_store
+from frontend.metrics import PROMPT_TOKENS, SUMMARIES, SUMMARY_SAVED_TOKENS, AnswerTimer
+from frontend.messages import Message, MessageRole, new_message, to_prompt
+from frontend.llm import (
+    estimate_tokens,
+    get_fanout_policy,
+    get_latency_tracker,
+    stream_compared,
+    stream_hedged,
+)
+from frontend.provider import ensure_litellm
+from frontend.scheduler import QueuePosition
+from frontend.sessions import LIMITS, TRACKER, history_bytes
+from frontend.streaming import FlushPolicy, MarkdownBlocks, StreamBuffer, StreamFlusher
+from frontend.summary import SummaryPolicy, summarize, summary_message
+
+
+logger = logging.getLogger(__name__)
 
 
 # To indicate that the streaming response has begun
@@ -18,17 +38,113 @@ STREAMING_MARKER = 'Just a moment...'
 CHAT_TEXT_INPUT = 'input-query'
 # Reference to the chat area component for scrolling
 CHAT_SCROLL_ELEMENT = 'chat-scroll-area'
+# The control loading older messages, at the top of the chat area
+OLDER_MESSAGES_ELEMENT = 'chat-older-messages'
+# The control showing the later loaded messages, at the bottom of the chat area
+NEWER_MESSAGES_ELEMENT = 'chat-newer-messages'
+# When to push streamed tokens to the client
+FLUSH_POLICY = FlushPolicy.from_env()
+# Selects the history sent with each question
+CONTEXT_BUILDER = ContextBuilder.from_env()
+# When the older turns of long conversations are summarized
+SUMMARY_POLICY = SummaryPolicy.from_env()
+# The model used unless the session selects another one
+DEFAULT_MODEL = os.getenv('CHAT_MODEL', 'gemini/gemini-2.0-flash-lite')
+# How the questions are answered: by the session model, hedged when it is slow (`auto`),
+# always hedged (`fastest`), or by every fan-out model side by side (`compare`)
+ANSWER_MODES = ('auto', 'fastest', 'compare')
+# Whether models are configured to hedge or compare the answers with
+FANOUT_ENABLED = bool(get_fanout_policy().models)
+# Sampling temperature of the answers
+TEMPERATURE = 0.01
+# Maximum number of tokens in an answer
+MAX_OUTPUT_TOKENS = 512
+# Messages loaded when a session reconnects, and then on each scroll to the top
+HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', DEFAULT_PAGE_SIZE))
+# Seconds to let the answers being generated finish when the backend shuts down
+# (below the 30 seconds Gunicorn waits for its workers; `docker stop` waits 10 seconds by
+# default, so give it a longer timeout with `docker stop -t` or `stop_grace_period`)
+DRAIN_TIMEOUT = float(os.getenv('CHAT_DRAIN_TIMEOUT', 25))
+# The answers being generated, by session id, so that they can be cancelled
+_active_generations: dict[str, asyncio.Task] = {}
+# Set while the backend shuts down: no new answer is started
+_draining = False
+
+
+def cancel_generation(session_id: str):
+    """
+    Cancel the answer being generated for a session, if any.
+
+    Args:
+        session_id: The id of the session.
+    """
+
+    task = _active_generations.pop(session_id, None)
+    if task is not None:
+        task.cancel()
 
 
-@dataclass
-class MessageRole:
+async def store_message(session_id: str, conversation_id: str, role: str, content: str) -> int:
     """
-    Define the roles of who generated the messages.
+    Persist a finalized message, unless the conversations are not persisted. The store is
+    written in a worker thread, so that the event loop keeps serving the other sessions.
+
+    Args:
+        session_id: The id of the browser session.
+        conversation_id: The id of the conversation the message belongs to.
+        role: Who wrote the message.
+        content: The text of the message.
+
+    Returns:
+        int: The store id of the message, or 0 if it was not persisted.
+    """
+
+    store = get_conversation_store()
+    if store is None:
+        return 0
+
+    return await asyncio.to_thread(store.append, session_id, conversation_id, role, content)
+
+
+def context_messages(history: list[Message]) -> list[dict[str, str]]:
     """
+    Get the messages of the history that are sent with the next question.
 
-    USER = 'user'
-    ASSISTANT = 'assistant'
-    SYSTEM = 'system'
+    Of the answers compared side by side, only the one of the session model is kept.
+
+    Args:
+        history: The messages of the conversation.
+
+    Returns:
+        list[dict[str, str]]: The role and content of the messages.
+    """
+
+    return [to_prompt(m) for m in history if m.get('compare') != 'alternative']
+
+
+@contextlib.asynccontextmanager
+async def drain_generations():
+    """
+    Lifespan task letting the answers being generated finish when the backend shuts down.
+
+    New questions are refused from then on; the answers still running after `DRAIN_TIMEOUT`
+    are cancelled, keeping the text received so far.
+    """
+
+    global _draining
+
+    yield
+
+    _draining = True
+    tasks = set(_active_generations.values())
+    if not tasks:
+        return
+
+    _, pending = await asyncio.wait(tasks, timeout=DRAIN_TIMEOUT)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.wait(pending)
 
 
 class SettingsState(rx.State):
@@ -49,14 +165,201 @@ class ChatState(rx.State):
 
     # The current question being asked
     question: str
+    # Questions submitted by the session, whether answered or refused: the client renders a
+    # submitted question until this count moves past the value it had at submission
+    submissions: int = 0
     # Whether the app is processing a question
     is_processing: bool = False
-    # Keep track of the chat history
-    chat_history: list[dict[str, str]] = []
-    model: str = 'gemini/gemini-2.0-flash-lite'
-    user_id: str = str(uuid.uuid4())
+    # The finalized messages loaded so far: the latest page of the conversation, and the older
+    # pages fetched on scroll
+    chat_history: list[Message] = []
+    # Whether the conversation has stored messages older than the loaded ones
+    has_older_messages: bool = False
+    # Position in the conversation of the first loaded message, counted from where the
+    # session started loading it; the bubbles are keyed by their position
+    history_offset: int = 0
+    # The running summary of the older turns, and the position of the first message it does
+    # not cover
+    _summary: str = ''
+    _summary_end: int = 0
+    # Whether the summary is being updated
+    _summarizing: bool = False
+    # The assistant message being streamed, kept apart from the history so that each
+    # streamed update only sends these vars: the completed markdown blocks, which the client
+    # renders once, and the unfinished trailing block
+    streaming_blocks: list[str] = []
+    streaming_content: str = ''
+    # The answers being streamed side by side in the compare mode, with their model
+    compare_answers: list[dict[str, str]] = []
+    # One of `ANSWER_MODES`
+    answer_mode: str = 'auto'
+    # Shown instead of the streaming marker while the question waits for a free slot
+    queue_status: str = ''
+    # Latency and throughput figures of the latest answer, for the debug panel
+    answer_stats: str = ''
+    model: str = DEFAULT_MODEL
+    # Identifies the browser session, assigned when the page loads; kept in the browser so
+    # that the session survives a restart of the backend
+    session_id: str = rx.SessionStorage(name='chat_session_id')
+    # Identifies the current conversation, renewed when the chat is cleared
+    conversation_id: str = rx.SessionStorage(name='chat_conversation_id')
+
+    async def start_session(self):
+        """
+        Assign the session and conversation ids if they are not set yet, and load the latest
+        messages of a stored conversation.
+        """
+
+        if not self.session_id:
+            self.session_id = uuid.uuid4().hex
+        if not self.conversation_id:
+            self.conversation_id = uuid.uuid4().hex
+        elif not self.chat_history:
+            await self.load_older_messages()
+        self._track_session()
+
+    async def load_older_messages(self):
+        """
+        Load the page of stored messages preceding the loaded ones, reading the store in a
+        worker thread.
+        """
+
+        store = get_conversation_store()
+        if store is None:
+            return
+
+        page, self.has_older_messages = await asyncio.to_thread(
+            store.load_page,
+            self.conversation_id,
+            # Compared answers other than the session model's are not stored
+            before=next((m['id'] for m in self.chat_history if m.get('id')), None),
+            limit=HISTORY_PAGE_SIZE,
+        )
+        if page:
+            latest = not self.chat_history
+            self.history_offset -= len(page)
+            self.chat_history = [
+                new_message(message.role, message.content, id=message.id) for message in page
+            ] + self.chat_history
+            if latest:
+                await self._load_summary()
+        self._track_session()
+
+    def _release_history(self) -> bool:
+        """
+        Release the loaded messages of an evicted session. They are loaded back from the
+        conversation store, with the running summary, once the session is shown again.
+
+        Returns:
+            bool: Whether the messages were released: not if they are not stored, or if the
+                running summary is being updated.
+        """
+
+        if get_conversation_store() is None or self._summarizing or not self.chat_history:
+            return False
+
+        self.chat_history = []
+        self.history_offset = 0
+        self._summary = ''
+        self._summary_end = 0
+        # Shown at the top of the empty chat, and clicked as soon as it is in view
+        self.has_older_messages = True
+        return True
+
+    async def _load_summary(self):
+        """
+        Load the running summary of a stored conversation.
+        """
+
+        store = get_conversation_store()
+        stored = None
+        if store is not None:
+            stored = await asyncio.to_thread(store.load_summary, self.conversation_id)
+        if stored is not None:
+            self._summary, through_id = stored
+            self._summary_end = self.history_offset + next(
+                (i for i, m in enumerate(self.chat_history) if m.get('id', 0) > through_id),
+                len(self.chat_history),
+            )
+
+    def _summary_covered(self) -> int:
+        """
+        Get the number of loaded messages, from the oldest, covered by the running summary.
+        """
+
+        return min(len(self.chat_history), max(0, self._summary_end - self.history_offset))
+
+    def _build_context(self, model: str) -> list[dict[str, str]]:
+        """
+        Select the messages sent with the latest question: the running summary, if any, then
+        the turns it does not cover, within the budget of the model.
+        """
+
+        covered = self._summary_covered()
+        messages = context_messages(self.chat_history[covered:])
+        if self._summary:
+            messages = [summary_message(self._summary)] + messages
+        messages = CONTEXT_BUILDER.build(model, messages, max_output_tokens=MAX_OUTPUT_TOKENS)
+
+        sent = estimate_tokens(model, messages, 0)
+        PROMPT_TOKENS.inc(sent, model=model)
+        if self._summary:
+            # Without the summary, the loaded messages it covers would take its place, within
+            # the budget; their token counts are cached from the previous questions
+            unsummarized = min(
+                CONTEXT_BUILDER.get_budget(model, MAX_OUTPUT_TOKENS),
+                sent
+                - estimate_tokens(model, [summary_message(self._summary)], 0)
+                + estimate_tokens(model, context_messages(self.chat_history[:covered]), 0),
+            )
+            SUMMARY_SAVED_TOKENS.inc(max(0, unsummarized - sent), model=model)
 
-    def get_history(self) -> list[dict[str, str]]:
+        return messages
+
+    async def _append_message(
+            self,
+            session_id: str,
+            conversation_id: str,
+            role: str,
+            content: str,
+            persist: bool = True,
+            **display: str,
+    ):
+        """
+        Add a finalized message to the history and the store, dropping the oldest messages
+        beyond the per-session limits.
+
+        The `display` fields, such as the `model` that answered, are only kept in the history.
+        """
+
+        self.chat_history.append(new_message(
+            role,
+            content,
+            id=await store_message(session_id, conversation_id, role, content) if persist else 0,
+            **display,
+        ))
+
+        drop = LIMITS.excess(self.chat_history)
+        if drop:
+            self.chat_history = self.chat_history[drop:]
+            self.history_offset += drop
+            # The dropped messages can be loaded back from the store on scroll
+            self.has_older_messages = get_conversation_store() is not None
+        self._track_session()
+
+    def _track_session(self):
+        """
+        Record the activity and the history size of the session, for the eviction of idle
+        sessions.
+        """
+
+        TRACKER.touch(
+            self.router.session.client_token,
+            history_bytes(self.chat_history),
+            busy=self.is_processing,
+        )
+
+    def get_history(self) -> list[Message]:
         """
         Get the conversation history.
 
@@ -68,53 +371,332 @@ class ChatState(rx.State):
 
     def clear_chat_history(self):
         """
-        Clear the chat history.
+        Clear the chat history, stopping the answer being generated if any.
         """
 
+        cancel_generation(self.session_id)
         self.chat_history = []
+        self.has_older_messages = False
+        self.history_offset = 0
+        self._summary = ''
+        self._summary_end = 0
+        self.streaming_blocks = []
+        self.streaming_content = ''
+        self.compare_answers = []
+        self.conversation_id = uuid.uuid4().hex
+        self._track_session()
+
+    def stop_generation(self):
+        """
+        Stop the answer being generated, keeping the text received so far.
+        """
+
+        cancel_generation(self.session_id)
 
+    def set_answer_mode(self, mode: str | list[str]):
+        """
+        Select how the next questions are answered.
+
+        Args:
+            mode: One of `ANSWER_MODES`, as selected in the segmented control.
+        """
+
+        if mode in ANSWER_MODES:
+            self.answer_mode = mode
+
+    @rx.event(background=True)
     async def handle_query_submission(self, form_data: dict):
         """
         Handle the Enter key press in the query form.
 
+        The answer is generated in a background task, so that other events of the session,
+        such as stopping the generation, are processed while it streams.
+
         Args:
             form_data: Data submitted via form.
         """
 
         query = form_data['input_query'].strip()
 
-        if query:
-            self.question = query
-            yield
+        if not query:
+            return
+
+        # The context is built with the tokenizers of litellm, which must not be imported on
+        # the event loop
+        await ensure_litellm()
 
+        async with self:
+            # Acknowledge the question in the same update that starts answering it, which
+            # replaces its optimistic rendering
+            self.submissions += 1
+            if self.is_processing or _draining:
+                return
+
+            await self.start_session()
+            self.question = query
             self.is_processing = True
-            yield
-
-            try:
-                self.chat_history.append({'role': MessageRole.USER, 'content': query})
-                self.chat_history.append(
-                    {'role': MessageRole.ASSISTANT, 'content': STREAMING_MARKER})
-                async for chunk in await litellm.acompletion(
-                        model=self.model,
-                        messages=self.chat_history,
-                        response_format=None,
-                        temperature=0.01,
-                        max_tokens=512,
-                        stream=True,
-                        metadata={'session_id': self.user_id},  # Set langfuse Session ID
-                ):  # type: ModelResponseStream
-                    if 'choices' in chunk and chunk['choices'][0]['delta']:
-                        delta_content = chunk['choices'][0]['delta'].content
-                        if delta_content:
-                            if self.chat_history[-1]['content'] == STREAMING_MARKER:
-                                self.chat_history[-1]['content'] = str(delta_content)
-                            else:
-                                self.chat_history[-1]['content'] += str(delta_content)
-
-                            yield
-            except Exception as e:
-                self.chat_history[-1]['content'] = f'An error occurred: {e}'
-                yield
-            finally:
+            await self._append_message(self.session_id, self.conversation_id, MessageRole.USER, query)
+            self.streaming_blocks = []
+            self.streaming_content = ''
+            # Built once, whichever models answer
+            messages = self._build_context(self.model)
+            model = self.model
+            answer_mode = self.answer_mode
+            session_id = self.session_id
+            conversation_id = self.conversation_id
+
+        _active_generations[session_id] = asyncio.current_task()
+        policy = get_fanout_policy()
+        compared = policy.compared_models(model) if answer_mode == 'compare' else [model]
+        timer = AnswerTimer(model)
+        # The answers by model, the session model first when compared
+        answers: dict[str, StreamBuffer] = {}
+        errors: dict[str, str] = {}
+        outcome = 'ok'
+
+        try:
+            if len(compared) > 1:
+                await self._stream_comparison(
+                    compared, messages, session_id, conversation_id, timer, answers, errors)
+            else:
+                await self._stream_answer(
+                    policy.hedged_models(model, get_latency_tracker(), force=answer_mode == 'fastest'),
+                    messages,
+                    session_id,
+                    conversation_id,
+                    timer,
+                    answers,
+                )
+        except asyncio.CancelledError:
+            # Stopped by the user: keep the partial answer
+            outcome = 'cancelled'
+        except Exception as e:
+            errors = {model: f'An error occurred: {e}'}
+            answers = {model: StreamBuffer()}
+            outcome = 'error'
+        finally:
+            if _active_generations.get(session_id) is asyncio.current_task():
+                del _active_generations[session_id]
+
+            async with self:
+                # Move the answers into the history in a single update, unless the chat was
+                # cleared in the meantime
+                if self.conversation_id == conversation_id:
+                    for i, (answering, buffer) in enumerate(answers.items()):
+                        content = errors.get(answering) or buffer.getvalue()
+                        if not content:
+                            continue
+                        display = {}
+                        if len(compared) > 1:
+                            display = {'model': answering, 'compare': 'alternative' if i else 'primary'}
+                        elif answering != model:
+                            # Another model won the race of a hedged question
+                            display = {'model': answering}
+                        await self._append_message(
+                            session_id,
+                            conversation_id,
+                            MessageRole.ASSISTANT,
+                            content,
+                            persist=not i,
+                            **display,
+                        )
+                self.streaming_blocks = []
+                self.streaming_content = ''
+                self.compare_answers = []
+                self.queue_status = ''
                 self.is_processing = False
-                yield
+                self._track_session()
+                self.answer_stats = timer.finish(outcome)
+
+        # Once the answer is shown, so that the next question may already use the summary
+        if outcome == 'ok':
+            await self._update_summary(model, session_id, conversation_id)
+
+    async def _update_summary(self, model: str, session_id: str, conversation_id: str):
+        """
+        Fold the older turns into the running summary, once those not yet summarized exceed
+        the threshold of the model.
+
+        Args:
+            model: The model of the conversation.
+            session_id: The id of the browser session.
+            conversation_id: The id of the conversation.
+        """
+
+        async with self:
+            if self._summarizing or self.conversation_id != conversation_id:
+                return
+
+            covered = self._summary_covered()
+            fold = SUMMARY_POLICY.fold_count(model, self.chat_history[covered:])
+            if not fold:
+                return
+
+            self._summarizing = True
+            summary = self._summary
+            folded = context_messages(self.chat_history[covered:covered + fold])
+            end = self.history_offset + covered + fold
+            through_id = max((m.get('id', 0) for m in self.chat_history[covered:covered + fold]), default=0)
+
+        summarizer = SUMMARY_POLICY.model or model
+        updated = ''
+        try:
+            updated = await summarize(
+                summarizer,
+                summary,
+                folded,
+                SUMMARY_POLICY.max_tokens,
+                session_id=session_id,
+                conversation_id=conversation_id,
+            )
+            SUMMARIES.inc(model=summarizer, outcome='ok' if updated else 'empty')
+        except Exception as e:
+            logger.warning('Could not summarize the conversation with %s: %r', summarizer, e)
+            SUMMARIES.inc(model=summarizer, outcome='error')
+        finally:
+            async with self:
+                self._summarizing = False
+                # Unless the chat was cleared in the meantime
+                if updated and self.conversation_id == conversation_id:
+                    self._summary = updated
+                    self._summary_end = end
+                    store = get_conversation_store()
+                    if store is not None and through_id:
+                        await asyncio.to_thread(store.save_summary, conversation_id, updated, through_id)
+
+    async def _stream_answer(
+            self,
+            models: list[str],
+            messages: list[dict[str, str]],
+            session_id: str,
+            conversation_id: str,
+            timer: AnswerTimer,
+            answers: dict[str, StreamBuffer],
+    ):
+        """
+        Stream the answer of the first model to respond, block by block.
+
+        Args:
+            models: The models racing to answer, the session model first.
+            messages: The messages sent to the models.
+            session_id: The id of the browser session.
+            conversation_id: The id of the conversation.
+            timer: Records the figures of the answer.
+            answers: Receives the text of the answer, under the model answering.
+        """
+
+        buffer = StreamBuffer()
+        blocks = MarkdownBlocks()
+        # The chunks received since the last flush, so that a flush only scans the new text
+        pending: list[str] = []
+        blocks_bytes = 0
+        flusher = StreamFlusher(FLUSH_POLICY)
+
+        async with contextlib.aclosing(stream_hedged(
+                models=models,
+                messages=messages,
+                temperature=TEMPERATURE,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                session_id=session_id,
+                conversation_id=conversation_id,
+        )) as stream:
+            async for answering, delta_content in stream:
+                if isinstance(delta_content, QueuePosition):
+                    async with self:
+                        self.queue_status = (
+                            f'Waiting for a free slot ({delta_content.position} ahead of you)...'
+                        )
+                    continue
+
+                if not answers:
+                    answers[answering] = buffer
+                    # The figures of a hedged question are those of the model answering
+                    timer.model = answering
+                buffer.append(delta_content)
+                pending.append(delta_content)
+                timer.token()
+
+                if flusher.should_flush(delta_content):
+                    update_started = time.monotonic()
+                    completed, tail = blocks.update(''.join(pending))
+                    pending.clear()
+                    async with self:
+                        self.queue_status = ''
+                        if completed:
+                            self.streaming_blocks.extend(completed)
+                        self.streaming_content = tail
+                    # The whole list of blocks is sent when it changes
+                    if completed:
+                        blocks_bytes += sum(len(block.encode()) for block in completed)
+                    timer.update(
+                        time.monotonic() - update_started,
+                        len(tail.encode()) + (blocks_bytes if completed else 0),
+                    )
+
+    async def _stream_comparison(
+            self,
+            models: list[str],
+            messages: list[dict[str, str]],
+            session_id: str,
+            conversation_id: str,
+            timer: AnswerTimer,
+            answers: dict[str, StreamBuffer],
+            errors: dict[str, str],
+    ):
+        """
+        Stream the answers of several models side by side.
+
+        A model failing only ends its own answer, with the error in its place.
+
+        Args:
+            models: The models answering, the session model first.
+            messages: The messages sent to the models.
+            session_id: The id of the browser session.
+            conversation_id: The id of the conversation.
+            timer: Records the figures of the answers, under the session model.
+            answers: Receives the text of the answers, by model.
+            errors: Receives the error messages of the models that failed.
+        """
+
+        answers.update((model, StreamBuffer()) for model in models)
+        flusher = StreamFlusher(FLUSH_POLICY)
+        async with self:
+            self.compare_answers = [{'model': model, 'content': ''} for model in models]
+
+        async with contextlib.aclosing(stream_compared(
+                models=models,
+                messages=messages,
+                temperature=TEMPERATURE,
+                max_tokens=MAX_OUTPUT_TOKENS,
+                session_id=session_id,
+                conversation_id=conversation_id,
+        )) as stream:
+            async for answering, item in stream:
+                if isinstance(item, QueuePosition):
+                    if answering == models[0]:
+                        async with self:
+                            self.queue_status = (
+                                f'Waiting for a free slot ({item.position} ahead of you)...'
+                            )
+                    continue
+
+                if isinstance(item, Finished):
+                    if item.error is not None:
+                        errors[answering] = f'An error occurred: {item.error}'
+                else:
+                    answers[answering].append(item)
+                    timer.token()
+
+                if isinstance(item, Finished) or flusher.should_flush(item):
+                    update_started = time.monotonic()
+                    compare_answers = [
+                        {'model': model, 'content': errors.get(model) or answers[model].getvalue()}
+                        for model in models
+                    ]
+                    async with self:
+                        self.queue_status = ''
+                        self.compare_answers = compare_answers
+                    timer.update(
+                        time.monotonic() - update_started,
+                        sum(len(answer['content'].encode()) for answer in compare_answers),
+                    )
@@ -0,0 +1,221 @@
+"""
+Helpers for pushing streamed LLM output to the client.
+
+Every `yield` from a Reflex event handler diffs and sends the dirty state vars over the
+websocket, so pushing after each token is expensive. The flush policy defined here decides
+when enough new text has accumulated to make a state update worthwhile.
+"""
+import os
+import re
+import time
+from dataclasses import dataclass
+from typing import Callable
+
+
+# Characters that end a sentence (or a markdown line) for the purpose of flushing
+SENTENCE_BOUNDARIES = ('.', '!', '?', ':', ';', '\n')
+# A code fence line, as specified by CommonMark: a run of at least 3 backticks or tildes, then
+# the info string. Any indentation is accepted, since the list items nesting a fence are not
+# tracked
+CODE_FENCE = re.compile(r' *(`{3,}|~{3,})(.*)')
+
+
+@dataclass
+class FlushPolicy:
+    """
+    Decide when accumulated streaming text is pushed to the client.
+
+    A flush happens as soon as any enabled trigger fires. A trigger set to zero (or False)
+    is disabled.
+    """
+
+    # Flush when this many milliseconds have passed since the last flush
+    interval_ms: int = 100
+    # Flush when this many tokens (stream chunks) have accumulated
+    max_tokens: int = 24
+    # Flush when a chunk ends a sentence
+    sentence_boundary: bool = True
+
+    @classmethod
+    def from_env(cls) -> 'FlushPolicy':
+        """
+        Build a policy from the `CHAT_FLUSH_*` environment variables.
+
+        Returns:
+            FlushPolicy: The configured policy, with defaults for the unset variables.
+        """
+
+        return cls(
+            interval_ms=int(os.getenv('CHAT_FLUSH_INTERVAL_MS', cls.interval_ms)),
+            max_tokens=int(os.getenv('CHAT_FLUSH_MAX_TOKENS', cls.max_tokens)),
+            sentence_boundary=os.getenv(
+                'CHAT_FLUSH_SENTENCE_BOUNDARY', str(cls.sentence_boundary)
+            ).lower() in ('1', 'true', 'yes'),
+        )
+
+
+class StreamFlusher:
+    """
+    Track the text streamed since the last flush and apply a `FlushPolicy` to it.
+    """
+
+    def __init__(self, policy: FlushPolicy, clock: Callable[[], float] = time.monotonic):
+        """
+        Args:
+            policy: The flush policy to apply.
+            clock: A monotonic clock returning seconds; replaceable for benchmarks.
+        """
+
+        self.policy = policy
+        self.clock = clock
+        # Number of chunks received since the last flush
+        self.pending = 0
+        # Number of flushes so far
+        self.flushes = 0
+        self._last_flush = clock()
+
+    def should_flush(self, delta: str) -> bool:
+        """
+        Register a streamed chunk and tell whether the client should be updated now.
+
+        The very first chunk is always flushed so that the time to first token is not
+        delayed by coalescing. When this returns True, the flush is assumed to happen.
+
+        Args:
+            delta: The text of the chunk just received.
+
+        Returns:
+            bool: True if the accumulated text should be pushed to the client.
+        """
+
+        self.pending += 1
+        policy = self.policy
+        now = self.clock()
+
+        flush = (
+            self.flushes == 0
+            or (policy.max_tokens and self.pending >= policy.max_tokens)
+            or (policy.interval_ms and (now - self._last_flush) * 1000 >= policy.interval_ms)
+            or (policy.sentence_boundary and delta.rstrip(' ').endswith(SENTENCE_BOUNDARIES))
+        )
+
+        if flush:
+            self.mark_flushed(now)
+
+        return bool(flush)
+
+    def mark_flushed(self, now: float | None = None):
+        """
+        Record that the pending text has been pushed to the client.
+
+        Args:
+            now: The time of the flush; defaults to the current clock value.
+        """
+
+        self.pending = 0
+        self.flushes += 1
+        self._last_flush = self.clock() if now is None else now
+
+
+class StreamBuffer:
+    """
+    Accumulate streamed chunks in a list and join them only when the text is needed.
+
+    Appending to a string stored in a dict or an attribute copies the whole string each
+    time, which makes assembling a long answer quadratic. Here each chunk is appended in
+    constant time and the text is joined when it is read.
+    """
+
+    def __init__(self):
+        self._chunks: list[str] = []
+        self._length = 0
+
+    def append(self, chunk: str):
+        """
+        Add a streamed chunk to the buffer.
+
+        Args:
+            chunk: The text to append.
+        """
+
+        self._chunks.append(chunk)
+        self._length += len(chunk)
+
+    def getvalue(self) -> str:
+        """
+        Join the chunks received so far.
+
+        Each call copies the whole text, so reading it on every flush is still quadratic in
+        the length of the answer: read it once the stream ends, or where the whole text is
+        sent anyway, and pass only the new chunks to `MarkdownBlocks` while streaming.
+
+        Returns:
+            str: The accumulated text.
+        """
+
+        if len(self._chunks) > 1:
+            self._chunks = [''.join(self._chunks)]
+
+        return self._chunks[0] if self._chunks else ''
+
+    def __len__(self) -> int:
+        return self._length
+
+
+class MarkdownBlocks:
+    """
+    Split streamed markdown into completed blocks and the unfinished trailing block.
+
+    A block ends at a blank line outside of a fenced code block. Completed blocks do not
+    change anymore, so the client can render each of them once; only the trailing block is
+    parsed again on every update. Only the trailing block is kept, and only the text added to
+    it is scanned, so an update costs the length of the trailing block rather than that of the
+    whole answer.
+    """
+
+    def __init__(self):
+        # The trailing block, and the offset in it of the first line not scanned yet
+        self._tail = ''
+        self._scanned = 0
+        # The run of backticks or tildes opening the code block being streamed, if any
+        self._fence = ''
+
+    def update(self, text: str) -> tuple[list[str], str]:
+        """
+        Scan the text streamed since the last call.
+
+        Args:
+            text: The text appended to the stream since the last call.
+
+        Returns:
+            tuple[list[str], str]: The blocks completed since the last call, and the trailing
+                block.
+        """
+
+        tail = self._tail + text
+        block_start = 0
+        completed = []
+        while True:
+            end = tail.find('\n', self._scanned)
+            if end == -1:
+                break
+
+            line = tail[self._scanned:end].rstrip('\r')
+            self._scanned = end + 1
+            fence = CODE_FENCE.fullmatch(line)
+            if fence:
+                run, info = fence.groups()
+                if not self._fence:
+                    # The info string of a backtick fence cannot hold backticks
+                    if run[0] == '~' or '`' not in info:
+                        self._fence = run
+                # Closed by a run of the same character at least as long, without info string
+                elif run[0] == self._fence[0] and len(run) >= len(self._fence) and not info.strip():
+                    self._fence = ''
+            elif not line.strip() and not self._fence and tail[block_start:end].strip():
+                completed.append(tail[block_start:self._scanned])
+                block_start = self._scanned
+
+        self._tail = tail[block_start:]
+        self._scanned -= block_start
+        return completed, self._tail
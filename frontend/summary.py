@@ -0,0 +1,149 @@
+"""
+Rolling summary of the older turns of long conversations.
+
+Resending the whole history on every turn makes the prompt grow with each turn, and the cost
+of a session with the square of its length. Once the turns not yet summarized exceed a token
+threshold, the older ones are folded into a running summary after the answer is shown, off
+the critical path of the next question. The next questions are sent with the summary followed
+by the recent turns.
+"""
+import os
+from dataclasses import dataclass, field
+
+from frontend.context import count_message_tokens, parse_model_map
+from frontend.llm import stream_completion
+from frontend.streaming import StreamBuffer
+
+
+# Instructions of the summarizing model
+SUMMARY_INSTRUCTIONS = (
+    'You maintain the running summary of a conversation between a user and an assistant. '
+    'Merge the previous summary, if any, with the new turns into a single concise summary. '
+    'Keep the facts, names, numbers, decisions and open questions needed to continue the '
+    'conversation; drop pleasantries and repetitions. Answer with the summary only.'
+)
+# Introduces the summary in the messages sent with a question
+SUMMARY_PREFIX = 'Summary of the earlier conversation:\n'
+
+
+@dataclass
+class SummaryPolicy:
+    """
+    When and how the older turns of a conversation are summarized.
+    """
+
+    # Tokens of the turns not yet summarized above which the older ones are folded into the
+    # summary (0 disables the summaries)
+    trigger_tokens: int = 4000
+    # Per-model thresholds, overriding `trigger_tokens`
+    triggers: dict[str, int] = field(default_factory=dict)
+    # Latest messages always sent as they are
+    keep_messages: int = 6
+    # Maximum number of tokens in the summary
+    max_tokens: int = 400
+    # Model writing the summaries, the model of the conversation if empty
+    model: str = ''
+
+    @classmethod
+    def from_env(cls) -> 'SummaryPolicy':
+        """
+        Build the policy from the `CHAT_SUMMARY_*` environment variables.
+
+        Returns:
+            SummaryPolicy: The configured policy.
+        """
+
+        return cls(
+            trigger_tokens=int(os.getenv('CHAT_SUMMARY_TRIGGER_TOKENS', cls.trigger_tokens)),
+            triggers=parse_model_map(os.getenv('CHAT_SUMMARY_TRIGGERS', '')),
+            keep_messages=int(os.getenv('CHAT_SUMMARY_KEEP_MESSAGES', cls.keep_messages)),
+            max_tokens=int(os.getenv('CHAT_SUMMARY_MAX_TOKENS', cls.max_tokens)),
+            model=os.getenv('CHAT_SUMMARY_MODEL', cls.model),
+        )
+
+    def fold_count(self, model: str, messages: list[dict[str, str]]) -> int:
+        """
+        Get the number of messages to fold into the summary.
+
+        The kept messages start with a question, so that a turn is never split.
+
+        Args:
+            model: The model of the conversation.
+            messages: The messages not yet summarized, oldest first.
+
+        Returns:
+            int: The number of oldest messages to fold, 0 if the threshold is not reached.
+        """
+
+        trigger = self.triggers.get(model, self.trigger_tokens)
+        if not trigger or len(messages) <= self.keep_messages:
+            return 0
+
+        tokens = sum(count_message_tokens(model, m['role'], m['content']) for m in messages)
+        if tokens <= trigger:
+            return 0
+
+        fold = len(messages) - self.keep_messages
+        while fold > 0 and messages[fold]['role'] != 'user':
+            fold -= 1
+
+        return fold
+
+
+def summary_message(summary: str) -> dict[str, str]:
+    """
+    Get the message standing for the summarized turns in the messages sent with a question.
+
+    Args:
+        summary: The running summary.
+
+    Returns:
+        dict[str, str]: A system message, which the context builder always keeps.
+    """
+
+    return {'role': 'system', 'content': SUMMARY_PREFIX + summary}
+
+
+async def summarize(
+        model: str,
+        summary: str,
+        messages: list[dict[str, str]],
+        max_tokens: int,
+        session_id: str = '',
+        conversation_id: str = '',
+) -> str:
+    """
+    Fold turns into the running summary of a conversation.
+
+    The call goes through the completion pipeline, so it is scheduled, retried and cached
+    like the answers.
+
+    Args:
+        model: The litellm model writing the summary.
+        summary: The previous summary, empty if none.
+        messages: The turns to fold, oldest first.
+        max_tokens: The maximum number of tokens in the summary.
+        session_id: The id of the browser session.
+        conversation_id: The id of the conversation.
+
+    Returns:
+        str: The new summary, empty if the model did not answer.
+    """
+
+    transcript = '\n\n'.join(f'{m["role"].capitalize()}: {m["content"]}' for m in messages)
+    if summary:
+        transcript = f'Previous summary:\n{summary}\n\nNew turns:\n{transcript}'
+
+    buffer = StreamBuffer()
+    async for delta in stream_completion(
+            model,
+            [{'role': 'system', 'content': SUMMARY_INSTRUCTIONS}, {'role': 'user', 'content': transcript}],
+            temperature=0.0,
+            max_tokens=max_tokens,
+            session_id=session_id,
+            conversation_id=conversation_id,
+    ):
+        if isinstance(delta, str):
+            buffer.append(delta)
+
+    return buffer.getvalue().strip()
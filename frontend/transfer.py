@@ -0,0 +1,325 @@
+"""
+Export and import of the stored conversations as gzipped JSON lines.
+
+Each line holds one message with the ids of its session and conversation, the messages of a
+conversation following each other in chronological order. Both directions stream: the export
+reads the store a batch at a time and compresses the lines as they are produced, and the import
+decompresses and parses the upload as it arrives, storing it a batch at a time, so a large
+archive is never held in memory.
+
+The routes are served by the backend only when `CHAT_TRANSFER_TOKEN` is set, and require it as
+a bearer token, since they expose every conversation:
+
+    curl -H "Authorization: Bearer $CHAT_TRANSFER_TOKEN" -o conversations.jsonl.gz \\
+        http://localhost:9000/conversations/export
+    curl -H "Authorization: Bearer $CHAT_TRANSFER_TOKEN" --data-binary @conversations.jsonl.gz \\
+        http://localhost:9000/conversations/import
+"""
+import hmac
+import json
+import os
+import time
+import zlib
+from typing import BinaryIO, Iterable, Iterator
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from frontend.history import TRANSFER_BATCH_SIZE, ExportedMessage, get_conversation_store
+
+
+# First bytes of a gzip stream
+GZIP_MAGIC = b'\x1f\x8b'
+# Bytes read from a file, or decompressed, at a time
+CHUNK_SIZE = 64 * 1024
+# Longest line accepted on import, in bytes
+MAX_LINE_BYTES = 16 * 1024 * 1024
+# Roles of the imported messages
+ROLES = ('user', 'assistant', 'system')
+
+
+def transfer_token() -> str:
+    """
+    Get the bearer token of the export and import routes, from the `CHAT_TRANSFER_TOKEN`
+    environment variable.
+
+    Returns:
+        str: The token, empty if the routes are disabled.
+    """
+
+    return os.getenv('CHAT_TRANSFER_TOKEN', '')
+
+
+def encode_message(message: ExportedMessage) -> bytes:
+    """
+    Encode a stored message as a line of the archive.
+
+    Args:
+        message: The message.
+
+    Returns:
+        bytes: The JSON object of the message, followed by a newline.
+    """
+
+    return json.dumps({
+        'session_id': message.session_id,
+        'conversation_id': message.conversation_id,
+        'role': message.role,
+        'content': message.content,
+        'created': message.created,
+    }, ensure_ascii=False).encode() + b'\n'
+
+
+def parse_message(line: bytes | str, number: int) -> tuple[str, str, str, str, float]:
+    """
+    Parse and check a line of an archive.
+
+    Args:
+        line: The JSON object of the message.
+        number: The number of the line, for the error messages.
+
+    Returns:
+        tuple[str, str, str, str, float]: The session id, conversation id, role, content and
+            creation time of the message, as stored. The session id defaults to empty and the
+            creation time to now.
+
+    Raises:
+        ValueError: If the line is not a valid message.
+    """
+
+    try:
+        record = json.loads(line)
+    except ValueError as e:
+        raise ValueError(f'Line {number}: invalid JSON ({e})') from None
+    if not isinstance(record, dict):
+        raise ValueError(f'Line {number}: expected a JSON object')
+
+    conversation_id = record.get('conversation_id')
+    if not isinstance(conversation_id, str) or not conversation_id:
+        raise ValueError(f'Line {number}: missing conversation_id')
+    if record.get('role') not in ROLES:
+        raise ValueError(f'Line {number}: role must be one of {", ".join(ROLES)}')
+    if not isinstance(record.get('content'), str):
+        raise ValueError(f'Line {number}: content must be a string')
+    session_id = record.get('session_id', '')
+    if not isinstance(session_id, str):
+        raise ValueError(f'Line {number}: session_id must be a string')
+    created = record.get('created')
+    if created is None:
+        created = time.time()
+    elif not isinstance(created, (int, float)) or isinstance(created, bool):
+        raise ValueError(f'Line {number}: created must be a number')
+
+    return session_id, conversation_id, record['role'], record['content'], float(created)
+
+
+class LineDecoder:
+    """
+    Split a byte stream into lines as it arrives, decompressing it first if it is gzipped.
+    """
+
+    def __init__(self):
+        self._head = b''
+        self._decompressor = None
+        self._plain = False
+        self._pending = b''
+
+    def _split(self, data: bytes) -> Iterator[bytes]:
+        lines = (self._pending + data).split(b'\n')
+        self._pending = lines.pop()
+        if len(self._pending) > MAX_LINE_BYTES:
+            raise ValueError(f'Line longer than {MAX_LINE_BYTES} bytes')
+        yield from lines
+
+    def feed(self, chunk: bytes) -> Iterator[bytes]:
+        """
+        Add the next bytes of the stream.
+
+        Args:
+            chunk: The bytes.
+
+        Yields:
+            bytes: The lines completed by the bytes, without their newline.
+
+        Raises:
+            ValueError: If a line is too long, or the gzip stream is corrupted.
+        """
+
+        if self._decompressor is None and not self._plain:
+            self._head += chunk
+            if len(self._head) < len(GZIP_MAGIC):
+                return
+            chunk, self._head = self._head, b''
+            if chunk.startswith(GZIP_MAGIC):
+                self._decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            else:
+                self._plain = True
+
+        if self._decompressor is None:
+            yield from self._split(chunk)
+            return
+
+        try:
+            while chunk:
+                # Bounded, so that a small upload cannot expand into a large buffer
+                yield from self._split(self._decompressor.decompress(chunk, CHUNK_SIZE))
+                chunk = self._decompressor.unconsumed_tail
+                if not chunk and self._decompressor.eof and self._decompressor.unused_data:
+                    # Concatenated archives are read as one
+                    chunk = self._decompressor.unused_data
+                    self._decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        except zlib.error as e:
+            raise ValueError(f'Corrupted gzip stream ({e})') from None
+
+    def close(self) -> Iterator[bytes]:
+        """
+        End the stream.
+
+        Yields:
+            bytes: The last line, if the stream does not end with a newline.
+
+        Raises:
+            ValueError: If the gzip stream is truncated.
+        """
+
+        if self._head:
+            yield from self._split(self._head)
+            self._head = b''
+        if self._decompressor is not None:
+            if not self._decompressor.eof:
+                raise ValueError('Truncated gzip stream')
+            yield from self._split(self._decompressor.flush())
+        if self._pending:
+            yield self._pending
+            self._pending = b''
+
+
+def read_messages(file: BinaryIO) -> Iterator[tuple[str, str, str, str, float]]:
+    """
+    Read the messages of an archive, gzipped or not, a chunk at a time.
+
+    Args:
+        file: The archive, opened in binary mode.
+
+    Yields:
+        tuple[str, str, str, str, float]: The messages, as returned by `parse_message`.
+
+    Raises:
+        ValueError: If the archive holds an invalid line.
+    """
+
+    decoder = LineDecoder()
+    number = 0
+
+    def parse(lines: Iterable[bytes]) -> Iterator[tuple[str, str, str, str, float]]:
+        nonlocal number
+        for line in lines:
+            number += 1
+            if line.strip():
+                yield parse_message(line, number)
+
+    while chunk := file.read(CHUNK_SIZE):
+        yield from parse(decoder.feed(chunk))
+    yield from parse(decoder.close())
+
+
+def export_archive(conversation_id: str | None = None) -> Iterator[bytes]:
+    """
+    Produce the gzipped archive of the stored conversations.
+
+    Args:
+        conversation_id: Only export this conversation.
+
+    Yields:
+        bytes: The chunks of the gzip stream, each covering a batch of messages.
+    """
+
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    batch = []
+    for message in get_conversation_store().iter_messages(conversation_id):
+        batch.append(encode_message(message))
+        if len(batch) >= TRANSFER_BATCH_SIZE:
+            if chunk := compressor.compress(b''.join(batch)):
+                yield chunk
+            batch = []
+    yield compressor.compress(b''.join(batch)) + compressor.flush()
+
+
+def _authorized(request: Request) -> bool:
+    scheme, _, token = request.headers.get('authorization', '').partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(token.encode(), transfer_token().encode())
+
+
+async def export_endpoint(request: Request) -> Response:
+    """
+    Stream the stored conversations, or the one given by the `conversation_id` query
+    parameter, as a gzipped JSON lines download.
+    """
+
+    if not _authorized(request):
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+    if get_conversation_store() is None:
+        return JSONResponse({'error': 'The conversations are not persisted'}, status_code=409)
+
+    # A sync iterator, so the store is read in the thread pool rather than the event loop
+    return StreamingResponse(
+        export_archive(request.query_params.get('conversation_id')),
+        media_type='application/gzip',
+        headers={'Content-Disposition': 'attachment; filename="conversations.jsonl.gz"'},
+    )
+
+
+async def import_endpoint(request: Request) -> Response:
+    """
+    Store the messages of an uploaded archive, gzipped or not, as it is received.
+
+    The messages are added at the end of their conversations, with new ids. They are stored a
+    batch at a time: if a line is invalid, the batches before it are kept, and the response
+    tells how many messages were imported.
+    """
+
+    if not _authorized(request):
+        return JSONResponse({'error': 'Unauthorized'}, status_code=401)
+    store = get_conversation_store()
+    if store is None:
+        return JSONResponse({'error': 'The conversations are not persisted'}, status_code=409)
+
+    decoder = LineDecoder()
+    batch = []
+    imported = 0
+    conversations = set()
+    number = 0
+
+    async def add(lines: Iterable[bytes]):
+        nonlocal batch, imported, number
+        for line in lines:
+            number += 1
+            if not line.strip():
+                continue
+            message = parse_message(line, number)
+            conversations.add(message[1])
+            batch.append(message)
+            if len(batch) >= TRANSFER_BATCH_SIZE:
+                # Written in the thread pool, so that the event loop keeps serving the chat
+                imported += await run_in_threadpool(store.append_many, batch)
+                batch = []
+
+    try:
+        async for chunk in request.stream():
+            await add(decoder.feed(chunk))
+        await add(decoder.close())
+        imported += await run_in_threadpool(store.append_many, batch)
+    except ValueError as e:
+        return JSONResponse({'error': str(e), 'messages': imported}, status_code=400)
+
+    return JSONResponse({'messages': imported, 'conversations': len(conversations)})
+
+
+# Mounted in front of the Reflex backend, when enabled, to add the export and import routes
+transfer_app = Starlette(routes=[
+    Route('/conversations/export', export_endpoint, methods=['GET']),
+    Route('/conversations/import', import_endpoint, methods=['POST']),
+])
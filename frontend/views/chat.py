@@ -5,13 +5,18 @@ This module defines the chat interface for an AI chat application. It includes c
 to display chat bubbles, manage the chat area, and an action bar for user inputs.
 """
 import reflex as rx
+from reflex.experimental.client_state import ClientStateVar
 
 from frontend.components.badge import made_with_reflex
+from frontend.components.debug import debug_panel
+from frontend.messages import Message, MessageRole
 from frontend.state import (
     ChatState,
-    MessageRole,
     CHAT_SCROLL_ELEMENT,
     CHAT_TEXT_INPUT,
+    NEWER_MESSAGES_ELEMENT,
+    OLDER_MESSAGES_ELEMENT,
+    STREAMING_MARKER,
 )
 
 
@@ -22,80 +27,385 @@ CHAT_BUBBLE_STYLE = {
     'min-width': '10%',  # Set a minimum width for aesthetic consistency
     'word-wrap': 'break-word',  # Ensure long words break properly
 }
+# Lets the browser skip rendering the mounted messages outside the visible part of the chat area
+OFFSCREEN_MESSAGE_STYLE = {
+    'content-visibility': 'auto',
+    'contain-intrinsic-size': 'auto 120px',  # Placeholder height until first rendered
+}
+# The text typed in the input field, kept in the browser until it is submitted
+DRAFT = ClientStateVar.create('chat_draft', '')
+# The question submitted, and the value of `ChatState.submissions` when it was: the question is
+# rendered in the browser until the backend acknowledges it
+PENDING_QUESTION = ClientStateVar.create('chat_pending_question', '')
+PENDING_AT = ClientStateVar.create('chat_pending_at', -1)
+# Whether a submitted question waits for the backend
+IS_PENDING = (PENDING_AT.value == ChatState.submissions) & (PENDING_QUESTION.value.strip() != '')
+# Messages of the loaded history mounted at a time, and by how many the window moves when one of
+# its ends is scrolled into view
+MESSAGE_WINDOW = 100
+MESSAGE_WINDOW_STEP = MESSAGE_WINDOW // 2
+# Loaded messages after the window, 0 while it shows the latest ones and follows new messages
+WINDOW_END = ClientStateVar.create('chat_window_end', 0)
+# Bounds of the window in the loaded history
+_LOADED = ChatState.chat_history.length()
+_WINDOW_STOP = rx.cond(_LOADED > WINDOW_END.value, _LOADED - WINDOW_END.value, 0)
+_WINDOW_START = rx.cond(_WINDOW_STOP > MESSAGE_WINDOW, _WINDOW_STOP - MESSAGE_WINDOW, 0)
+# Clicks a control whenever it is scrolled into view
+CLICK_ON_SCROLL_SCRIPT = """
+const element = document.getElementById('{element}');
+if (element) {{
+    new IntersectionObserver((entries) => {{
+        if (entries.some((entry) => entry.isIntersecting)) element.click();
+    }}).observe(element);
+}}
+"""
 
 
-def message_display(message: dict) -> rx.Component:
+@rx.memo
+def markdown_block(content: rx.Var[str]) -> rx.Component:
     """
-    Display a single chat message as a bubble.
+    Render a completed markdown block of the answer being streamed.
+
+    The block is a memoized React component, so it is parsed once rather than on every
+    streamed update.
 
     Args:
-        message (dict): A dictionary containing the message content and role (user or assistant).
+        content (rx.Var[str]): The markdown text of the block.
 
     Returns:
-        rx.Component: A Reflex component representing the chat bubble for the message.
+        rx.Component: The rendered block.
     """
 
-    def user_message():
-        """
-        Create a user message bubble aligned to the right.
+    return rx.markdown(
+        content,
+        class_name='[&>p]:!my-2.5 text-left',  # Text aligns to the left
+    )
 
-        Returns:
-            rx.Component: The user message bubble with left-aligned text.
-        """
-        return rx.box(
-            rx.flex(
-                rx.box(
-                    rx.markdown(
-                        message['content'],
-                        class_name='[&>p]:!my-2.5 text-left',  # Text aligns to the left
-                    ),
-                    class_name=(
-                        'relative bg-slate-3 px-5 py-2 rounded-3xl text-slate-12 self-end'
-                    ),
-                    style=CHAT_BUBBLE_STYLE,
-                ),
-                rx.image(
-                    src='customer-experience-and-blue-client-21010.svg',
-                    class_name='h-6',
-                ),
-                class_name='flex flex-row items-center gap-2 self-end',  # Aligns icon and bubble
-            ),
-            class_name='relative px-5 py-2 self-end',
-        )
 
-    def assistant_message():
-        """
-        Create an assistant message bubble aligned to the left.
+def assistant_message(
+        content: rx.Var | str | rx.Component,
+        pulse: bool = False,
+        label: rx.Var | None = None,
+) -> rx.Component:
+    """
+    Create an assistant message bubble aligned to the left.
 
-        Returns:
-            rx.Component: The assistant message bubble with left-aligned text.
-        """
+    Args:
+        content (rx.Var | str | rx.Component): The markdown content of the message, or its
+            rendered body.
+        pulse (bool): Whether to animate the assistant icon while the answer is streamed.
+        label (rx.Var | None): The model that answered, shown above the content when set.
 
-        return rx.box(
-            rx.image(
-                src='artificial-intelligence-assistant-22110.svg',
-                class_name='h-6' + rx.cond(ChatState.is_processing, ' animate-pulse', ''),
+    Returns:
+        rx.Component: The assistant message bubble with left-aligned text.
+    """
+
+    if not isinstance(content, rx.Component):
+        content = rx.markdown(
+            content,
+            class_name='[&>p]:!my-2.5 text-left',  # Text aligns to the left
+        )
+    if label is not None:
+        content = rx.fragment(
+            rx.cond(label, rx.text(label, class_name='pt-2 text-slate-10 text-xs')),
+            content,
+        )
+
+    return rx.box(
+        rx.image(
+            src='artificial-intelligence-assistant-22110.svg',
+            class_name='h-6' + (' animate-pulse' if pulse else ''),
+        ),
+        rx.box(
+            content,
+            class_name=(
+                'relative bg-accent-4 px-5 py-2 rounded-3xl text-slate-12 self-start'
             ),
+            style=CHAT_BUBBLE_STYLE,
+        ),
+        class_name='flex flex-row gap-6',
+    )
+
+
+def user_message(content: rx.Var | str) -> rx.Component:
+    """
+    Create a user message bubble aligned to the right.
+
+    Args:
+        content (rx.Var | str): The markdown content of the message.
+
+    Returns:
+        rx.Component: The user message bubble with left-aligned text.
+    """
+
+    return rx.box(
+        rx.flex(
             rx.box(
                 rx.markdown(
-                    message['content'],
+                    content,
                     class_name='[&>p]:!my-2.5 text-left',  # Text aligns to the left
                 ),
                 class_name=(
-                    'relative bg-accent-4 px-5 py-2 rounded-3xl text-slate-12 self-start'
+                    'relative bg-slate-3 px-5 py-2 rounded-3xl text-slate-12 self-end'
                 ),
                 style=CHAT_BUBBLE_STYLE,
             ),
-            class_name='flex flex-row gap-6',
-        )
+            rx.image(
+                src='customer-experience-and-blue-client-21010.svg',
+                class_name='h-6',
+            ),
+            class_name='flex flex-row items-center gap-2 self-end',  # Aligns icon and bubble
+        ),
+        class_name='relative px-5 py-2 self-end',
+    )
+
+
+@rx.memo
+def message_bubble(
+        role: rx.Var[str],
+        content: rx.Var[str],
+        model: rx.Var[str],
+        compare: rx.Var[str],
+) -> rx.Component:
+    """
+    Display a finalized chat message as a bubble.
+
+    The bubble is a memoized React component: it only renders again, and parses its markdown
+    again, when its props change, not on every state update of the page. The browser also
+    skips the rendering of the mounted bubbles scrolled out of view.
+
+    Args:
+        role (rx.Var[str]): Who wrote the message (user or assistant).
+        content (rx.Var[str]): The markdown content of the message.
+        model (rx.Var[str]): The model that answered, if not the session model.
+        compare (rx.Var[str]): Set on the answers compared side by side.
+
+    Returns:
+        rx.Component: The chat bubble for the message.
+    """
 
     return rx.box(
         rx.cond(
-            message['role'] == MessageRole.USER,
-            user_message(),
-            assistant_message(),
+            role == MessageRole.USER,
+            user_message(content),
+            assistant_message(content, label=model),
+        ),
+        # Consecutive compared answers share a row of the chat area
+        class_name=rx.cond(
+            compare,
+            'flex flex-col flex-1 gap-8 pb-10 min-w-[18rem] group',
+            'flex flex-col gap-8 pb-10 w-full group',
+        ),
+        style=OFFSCREEN_MESSAGE_STYLE,
+    )
+
+
+def message_display(message: rx.Var[Message], position: rx.Var[int]) -> rx.Component:
+    """
+    Display a single chat message as a bubble.
+
+    The bubble is keyed by the position of the message in the conversation rather than in
+    the loaded history, so that React keeps the mounted bubbles when older messages are
+    loaded before them.
+
+    Args:
+        message (rx.Var[Message]): A finalized message of the chat history.
+        position (rx.Var[int]): The position of the message in the conversation.
+
+    Returns:
+        rx.Component: A Reflex component representing the chat bubble for the message.
+    """
+
+    return rx.fragment(
+        message_bubble(
+            role=message['role'],
+            content=message['content'],
+            model=message['model'],
+            compare=message['compare'],
+        ),
+        key=position,
+    )
+
+
+def streaming_message_display() -> rx.Component:
+    """
+    Display the assistant message that is being streamed.
+
+    The in-flight text lives in its own state vars, so streamed updates do not resend the
+    finalized chat history. The completed markdown blocks are rendered once each, and only
+    the trailing block is parsed again on every update; the finalized answer is rendered as a
+    whole in the history. Compared answers are streamed side by side, each as a whole.
+
+    Returns:
+        rx.Component: The streaming chat bubble, shown only while a question is processed.
+    """
+
+    has_text = (ChatState.streaming_blocks.length() > 0) | (ChatState.streaming_content != '')
+    waiting = markdown_block(
+        content=rx.cond(ChatState.queue_status, ChatState.queue_status, STREAMING_MARKER),
+    )
+    return rx.cond(
+        ChatState.is_processing,
+        rx.cond(
+            ChatState.compare_answers.length() > 0,
+            rx.box(
+                rx.foreach(
+                    ChatState.compare_answers,
+                    lambda answer: rx.box(
+                        assistant_message(
+                            rx.cond(
+                                answer['content'] != '',
+                                markdown_block(content=answer['content']),
+                                waiting,
+                            ),
+                            pulse=True,
+                            label=answer['model'],
+                        ),
+                        class_name='flex-1 min-w-[18rem]',
+                    ),
+                ),
+                class_name='flex flex-row flex-wrap gap-x-4 gap-y-8 pb-10 w-full',
+            ),
+            rx.box(
+                assistant_message(
+                    rx.cond(
+                        has_text,
+                        rx.fragment(
+                            rx.foreach(
+                                ChatState.streaming_blocks,
+                                lambda block: markdown_block(content=block),
+                            ),
+                            markdown_block(content=ChatState.streaming_content),
+                        ),
+                        waiting,
+                    ),
+                    pulse=True,
+                ),
+                class_name='flex flex-col gap-8 pb-10 w-full group',
+            ),
+        ),
+    )
+
+
+def submit_events(question: rx.Var | str, handler=ChatState.handle_query_submission) -> list:
+    """
+    Get the events submitting a question: the question is rendered in the browser at once,
+    and a single event asks the backend to answer it.
+
+    Args:
+        question (rx.Var | str): The question.
+        handler: The backend event answering it, bound to its arguments if needed.
+
+    Returns:
+        list: The event chain.
+    """
+
+    return [
+        PENDING_QUESTION.set_value(question),
+        PENDING_AT.set_value(ChatState.submissions),
+        DRAFT.set_value(''),
+        # Back to the latest messages, where the answer is shown
+        WINDOW_END.set_value(0),
+        handler,
+    ]
+
+
+def pending_message_display() -> rx.Component:
+    """
+    Display the question submitted and the streaming marker until the backend acknowledges
+    the question, so that it shows without waiting for a round trip.
+
+    Returns:
+        rx.Component: The question and the marker, shown only while the question is pending.
+    """
+
+    return rx.cond(
+        IS_PENDING,
+        rx.box(
+            user_message(PENDING_QUESTION.value),
+            assistant_message(STREAMING_MARKER, pulse=True),
+            class_name='flex flex-col gap-8 pb-10 w-full group',
+        ),
+    )
+
+
+def window_control(label: str, element: str, on_click, class_name: str) -> rx.Component:
+    """
+    Create a control moving the window of mounted messages, clicked when scrolled into view.
+
+    Args:
+        label (str): The text of the control.
+        element (str): The id of the control.
+        on_click: The events moving the window.
+        class_name (str): The classes of the control.
+
+    Returns:
+        rx.Component: The control.
+    """
+
+    return rx.button(
+        label,
+        id=element,
+        variant='ghost',
+        size='1',
+        on_click=on_click,
+        on_mount=rx.call_script(CLICK_ON_SCROLL_SCRIPT.format(element=element)),
+        class_name='mx-auto text-slate-10 ' + class_name,
+    )
+
+
+def older_messages_loader() -> rx.Component:
+    """
+    Show the earlier messages when the top of the chat area is reached: the loaded messages
+    before the window, or else the previous page of the conversation store.
+
+    Returns:
+        rx.Component: A control showing the earlier messages, while there are.
+    """
+
+    return rx.cond(
+        _WINDOW_START > 0,
+        window_control(
+            'Show earlier messages',
+            OLDER_MESSAGES_ELEMENT,
+            WINDOW_END.set_value(WINDOW_END.value + rx.cond(
+                _WINDOW_START > MESSAGE_WINDOW_STEP, MESSAGE_WINDOW_STEP, _WINDOW_START)),
+            'mb-6',
+        ),
+        rx.cond(
+            ChatState.has_older_messages,
+            window_control(
+                'Load earlier messages',
+                OLDER_MESSAGES_ELEMENT,
+                ChatState.load_older_messages,
+                'mb-6',
+            ),
+        ),
+    )
+
+
+def newer_messages_loader() -> rx.Component:
+    """
+    Show the later loaded messages when the bottom of the chat area is reached, after
+    scrolling up through the history.
+
+    Returns:
+        rx.Component: A control showing the later messages, while the window is not at the
+            latest ones.
+    """
+
+    return rx.cond(
+        _WINDOW_STOP < _LOADED,
+        window_control(
+            'Show later messages',
+            NEWER_MESSAGES_ELEMENT,
+            WINDOW_END.set_value(rx.cond(
+                _LOADED - _WINDOW_STOP > MESSAGE_WINDOW_STEP,
+                _LOADED - _WINDOW_STOP - MESSAGE_WINDOW_STEP,
+                0,
+            )),
+            'mt-6 w-full',
         ),
-        class_name='flex flex-col gap-8 pb-10 group',
     )
 
 
@@ -103,19 +413,29 @@ def chat() -> rx.Component:
     """
     Create the chat area component.
 
-    This component displays the chat history in a scrollable area.
+    This component displays the loaded chat history, followed by the streaming answer, in a
+    scrollable area. Only a window of `MESSAGE_WINDOW` messages of the history is mounted, so
+    that the page holds a bounded number of bubbles however long the conversation: the window
+    moves up when scrolling to its top, and then older messages are loaded from the store, and
+    moves back down when scrolling to its bottom. The messages fill the width of the area,
+    except compared answers, which share a row.
 
     Returns:
         rx.Component: The scrollable chat area containing all chat bubbles.
     """
 
     return rx.scroll_area(
-        rx.vstack(
+        rx.box(
+            older_messages_loader(),
             rx.foreach(
-                ChatState.chat_history,
-                lambda message: message_display(message),
+                ChatState.chat_history[_WINDOW_START:_WINDOW_STOP],
+                lambda message, index: message_display(
+                    message, ChatState.history_offset + _WINDOW_START + index),
             ),
-            class_name='w-full flex flex-col items-stretch',  # Allows full-width flexibility
+            newer_messages_loader(),
+            pending_message_display(),
+            streaming_message_display(),
+            class_name='w-full flex flex-row flex-wrap gap-x-4 gap-y-3',  # Allows full-width flexibility
         ),
         scrollbars='vertical',
         class_name='w-full h-full',  # Ensures proper scrolling behavior
@@ -127,7 +447,8 @@ def action_bar() -> rx.Component:
     """
     Create the action bar component.
 
-    This component includes an input field for user queries and a send button to submit them.
+    This component includes an input field for user queries and a send button to submit them,
+    which turns into a stop button while an answer is generated.
 
     Returns:
         rx.Component: The action bar for user interactions.
@@ -137,31 +458,36 @@ def action_bar() -> rx.Component:
         rx.form(
             rx.input(
                 placeholder='Ask me anything',
-                on_blur=ChatState.set_question,
+                # Kept in the browser: typing sends no event to the backend
+                on_change=DRAFT.set,
                 id=CHAT_TEXT_INPUT,
                 class_name='box-border bg-slate-3 px-4 py-2 pr-14 rounded-full w-full outline-none focus:outline-accent-10 h-[48px] text-slate-12 placeholder:text-slate-9',
             ),
+            # Always rendered, and disabled while a question is answered: a disabled submit
+            # button keeps Enter from submitting the form, which would clear the question typed
+            # while the backend refuses it
             rx.button(
-                rx.cond(
-                    ChatState.is_processing,
-                    rx.icon(
-                        tag='loader-circle',
-                        size=19,
-                        color='white',
-                        class_name='animate-spin',
-                    ),
-                    rx.icon(tag='arrow-up', size=19, color='white'),
-                ),
-                class_name='top-1/2 right-4 absolute bg-accent-9 hover:bg-accent-10 disabled:hover:bg-accent-9 opacity-65 disabled:opacity-50 p-1.5 rounded-full transition-colors -translate-y-1/2 cursor-pointer disabled:cursor-default',
-                disabled=rx.cond(
-                    ChatState.is_processing, True, False
+                rx.icon(tag='arrow-up', size=19, color='white'),
+                class_name=rx.cond(ChatState.is_processing, 'hidden', '') + ' top-1/2 right-4 absolute bg-accent-9 hover:bg-accent-10 disabled:hover:bg-accent-9 opacity-65 disabled:opacity-50 p-1.5 rounded-full transition-colors -translate-y-1/2 cursor-pointer disabled:cursor-default',
+                type='submit',
+                disabled=IS_PENDING | ChatState.is_processing,
+            ),
+            rx.cond(
+                ChatState.is_processing,
+                # Stop the answer being generated
+                rx.button(
+                    rx.icon(tag='square', size=15, color='white', fill='white'),
+                    class_name='top-1/2 right-4 absolute bg-accent-9 hover:bg-accent-10 opacity-65 hover:opacity-100 p-2 rounded-full transition-colors -translate-y-1/2 cursor-pointer',
+                    on_click=ChatState.stop_generation,
+                    type='button',
                 ),
-                type='submit'
             ),
             class_name='relative w-full',
-            on_submit=[ChatState.handle_query_submission, ],
+            on_submit=submit_events(DRAFT.value),
             reset_on_submit=True,
         ),
+        # Figures of the latest answer, when enabled
+        debug_panel(),
         # Made with Reflex link
         made_with_reflex(),
         class_name='flex flex-col justify-center items-center gap-6 w-full',
@@ -1,6 +1,16 @@
 import reflex as rx
 
 from frontend.state import ChatState
+from frontend.views.chat import IS_PENDING, submit_events
+
+
+# The example prompts shown before the first question: icon, title, prompt and color
+TEMPLATE_CARDS = [
+    ("message-circle", "Ask a question", "What is the capital of France?", "grass"),
+    ("calculator", "Solve a math problem", "What is the square root of 144?", "tomato"),
+    ("globe", "Get a fun fact", "Tell me an interesting fact about dolphins.", "blue"),
+    ("book", "Recommend a book", "What's a good mystery novel for beginners?", "amber"),
+]
 
 
 def template_card(icon: str, title: str, description: str, color: str) -> rx.Component:
@@ -9,10 +19,8 @@ def template_card(icon: str, title: str, description: str, color: str) -> rx.Com
         rx.text(title, class_name="font-medium text-slate-11 text-sm"),
         rx.text(description, class_name="text-slate-10 text-xs"),
         class_name="relative align-top flex flex-col gap-2 border-slate-4 bg-slate-1 hover:bg-slate-3 shadow-sm px-3 pt-3 pb-4 border rounded-2xl text-[15px] text-start transition-colors",
-        on_click=[
-            ChatState.set_question(description),
-            ChatState.handle_query_submission({'input_query': description})
-        ],
+        on_click=submit_events(
+            description, ChatState.handle_query_submission({'input_query': description})),
     )
 
 
@@ -23,30 +31,7 @@ def templates() -> rx.Component:
             class_name="opacity-70 w-auto h-[80px] pointer-events-none",
         ),
         rx.box(
-            template_card(
-                "message-circle",
-                "Ask a question",
-                "What is the capital of France?",
-                "grass",
-            ),
-            template_card(
-                "calculator",
-                "Solve a math problem",
-                "What is the square root of 144?",
-                "tomato",
-            ),
-            template_card(
-                "globe",
-                "Get a fun fact",
-                "Tell me an interesting fact about dolphins.",
-                "blue",
-            ),
-            template_card(
-                "book",
-                "Recommend a book",
-                "What's a good mystery novel for beginners?",
-                "amber",
-            ),
+            *[template_card(*card) for card in TEMPLATE_CARDS],
             class_name="gap-4 grid grid-cols-1 md:grid-cols-2 lg:grid-cols-4 w-full",
         ),
         class_name="top-1/3 left-1/2 absolute flex flex-col justify-center items-center gap-10 w-full max-w-4xl transform -translate-x-1/2 -translate-y-1/2 px-6 z-50",
@@ -54,5 +39,5 @@ def templates() -> rx.Component:
             "animation": "reveal 0.35s ease-out",
             "@keyframes reveal": {"0%": {"opacity": "0"}, "100%": {"opacity": "1"}},
         },
-        display=rx.cond(ChatState.chat_history, "none", "flex"),
+        display=rx.cond(ChatState.chat_history | IS_PENDING, "none", "flex"),
     )
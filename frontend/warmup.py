@@ -0,0 +1,68 @@
+"""
+Startup warm-up of the answers to the template prompts.
+
+The template cards are the most clicked entry point of the app and their prompts are known
+in advance. When enabled, their answers are computed once per configured model at startup,
+served instantly from then on, and refreshed in the background on a schedule.
+"""
+import asyncio
+import logging
+import os
+
+from frontend.llm import precompute
+from frontend.provider import ensure_litellm
+from frontend.state import CONTEXT_BUILDER, DEFAULT_MODEL, MAX_OUTPUT_TOKENS, TEMPERATURE
+from frontend.views.templates import TEMPLATE_CARDS
+
+
+logger = logging.getLogger(__name__)
+
+# Seconds between two refreshes of the precomputed answers
+DEFAULT_REFRESH_INTERVAL = 3600
+
+
+def warmup_enabled() -> bool:
+    """
+    Tell whether the warm-up is enabled by the `CHAT_WARMUP` environment variable.
+
+    Returns:
+        bool: True if the template answers should be precomputed.
+    """
+
+    return os.getenv('CHAT_WARMUP', 'false').lower() in ('1', 'true', 'yes')
+
+
+async def warm_up_templates():
+    """
+    Precompute the template answers for each model, then refresh them periodically.
+
+    The models are listed in `CHAT_WARMUP_MODELS` (comma-separated, defaulting to the app's
+    model) and the refresh interval in seconds is `CHAT_WARMUP_REFRESH` (0 disables it).
+    """
+
+    models = [
+        m.strip() for m in os.getenv('CHAT_WARMUP_MODELS', DEFAULT_MODEL).split(',') if m.strip()
+    ]
+    refresh_interval = float(os.getenv('CHAT_WARMUP_REFRESH', DEFAULT_REFRESH_INTERVAL))
+    # The messages are built with the tokenizers of litellm, which must not be imported on the
+    # event loop
+    await ensure_litellm()
+
+    while True:
+        for model in models:
+            for _, _, prompt, _ in TEMPLATE_CARDS:
+                # Send exactly what the chat state sends for a first question
+                messages = CONTEXT_BUILDER.build(
+                    model,
+                    [{'role': 'user', 'content': prompt}],
+                    max_output_tokens=MAX_OUTPUT_TOKENS,
+                )
+                try:
+                    await precompute(model, messages, TEMPERATURE, MAX_OUTPUT_TOKENS)
+                except Exception as e:
+                    logger.warning('Could not precompute %r for %s: %s', prompt, model, e)
+
+        if not refresh_interval:
+            return
+
+        await asyncio.sleep(refresh_interval)
@@ -1,11 +1,26 @@
+import os
+
 import reflex as rx
 
 from frontend.style import create_colors_dict
 
 
+# Backend workers when Redis is configured (Reflex defaults to 2 per CPU plus 1). Reflex runs
+# the backend with Granian, or with Gunicorn if it is installed alongside Uvicorn; the count is
+# passed to whichever runs it, through the environment inherited by the server. Without Redis,
+# the workers would not share the sessions, so the backend keeps a single one
+if (workers := os.getenv('CHAT_WORKERS')) and os.getenv('REDIS_URL'):
+    os.environ.setdefault('GRANIAN_WORKERS', workers)
+    if '--workers' not in os.getenv('GUNICORN_CMD_ARGS', ''):
+        os.environ['GUNICORN_CMD_ARGS'] = f'--workers {workers} ' + os.getenv('GUNICORN_CMD_ARGS', '')
+
 config = rx.Config(
     app_name='frontend',
     backend_port=9000,
+    # Shared state of the backend workers; without it, the backend runs a single worker
+    redis_url=os.getenv('REDIS_URL') or None,
+    # Read by the Reflex versions that start Gunicorn with their own worker count
+    gunicorn_workers=int(os.getenv('CHAT_WORKERS', 0)) or None,
     tailwind={
         'darkMode': 'class',
         'theme': {